@@ -0,0 +1,7 @@
+"""
+Общие модули ботов rgz, lab-5 и lab-6: метрики, сторож цикла событий,
+запись апдейтов, антифлуд и маршрутизация чтения по репликам.
+
+Боты и сервисы добавляют корень репозитория в sys.path и импортируют
+модули как common.<модуль>.
+"""
@@ -0,0 +1,231 @@
+"""
+Защита от флуда: лишние апдейты чата отбрасываются до обработчиков и БД
+
+Middleware стоит первым на апдейтах диспетчера, до фильтров, FSM и
+обработчиков, поэтому отброшенный апдейт не стоит ни одного запроса к БД.
+Отбрасываются:
+- повторно доставленные апдейты (тот же update_id);
+- дубликаты: то же сообщение или та же inline-кнопка чата, пока предыдущий
+  такой же апдейт еще обрабатывается или пришел меньше
+  ANTIFLOOD_DUPLICATE_WINDOW секунд назад - на них ответит первый апдейт;
+- апдейты сверх лимита чата: у каждого чата корзина токенов на
+  ANTIFLOOD_BURST апдейтов, пополняемая со скоростью ANTIFLOOD_RATE в секунду.
+При превышении лимита чат получает предупреждение, но не чаще раза в
+ANTIFLOOD_NOTICE_INTERVAL секунд, чтобы ответы не стали тем же флудом.
+Отброшенное нажатие inline-кнопки подтверждается (answerCallbackQuery),
+иначе у пользователя остается индикатор загрузки на кнопке.
+
+Защита выключена по умолчанию, а лимиты заданы с запасом: обычный
+пользователь, быстро листающий страницы, в них не упирается. Включать ее
+стоит для ботов, которым действительно досаждает флуд.
+
+Подключение:
+    antiflood = AntiFlood()
+    antiflood.setup(dp)
+
+Настройки (переменные окружения):
+- ANTIFLOOD: включить защиту (false)
+- ANTIFLOOD_RATE: сколько апдейтов в секунду в среднем разрешено чату (3.0)
+- ANTIFLOOD_BURST: сколько апдейтов подряд разрешено сверх среднего (20)
+- ANTIFLOOD_DUPLICATE_WINDOW: окно подавления одинаковых апдейтов, секунды (2)
+- ANTIFLOOD_NOTICE_INTERVAL: как часто предупреждать чат о лимите, секунды (10)
+- ANTIFLOOD_MAX_CHATS: для скольких чатов хранить состояние (10000)
+- ANTIFLOOD_LOG_INTERVAL: период вывода счетчиков в лог в секундах, 0 - только при остановке (60)
+"""
+import asyncio
+import logging
+import os
+import time
+from collections import Counter, OrderedDict
+
+ANTIFLOOD = os.getenv('ANTIFLOOD', 'false').lower() == 'true'
+ANTIFLOOD_RATE = float(os.getenv('ANTIFLOOD_RATE', '3.0'))
+ANTIFLOOD_BURST = float(os.getenv('ANTIFLOOD_BURST', '20'))
+ANTIFLOOD_DUPLICATE_WINDOW = float(os.getenv('ANTIFLOOD_DUPLICATE_WINDOW', '2'))
+ANTIFLOOD_NOTICE_INTERVAL = float(os.getenv('ANTIFLOOD_NOTICE_INTERVAL', '10'))
+ANTIFLOOD_MAX_CHATS = int(os.getenv('ANTIFLOOD_MAX_CHATS', '10000'))
+ANTIFLOOD_LOG_INTERVAL = float(os.getenv('ANTIFLOOD_LOG_INTERVAL', '60'))
+
+NOTICE_TEXT = "Слишком много запросов. Подождите несколько секунд и повторите."
+
+# Сколько последних update_id помнить для отсева повторной доставки
+SEEN_UPDATES = 1000
+# Сколько чатов с отброшенными апдейтами показывать в отчете
+REPORT_TOP = 5
+
+logger = logging.getLogger(__name__)
+
+
+class ChatState:
+    """Корзина токенов и последние апдейты одного чата"""
+    __slots__ = ('tokens', 'updated_at', 'notified_at', 'last_key', 'last_at', 'in_flight')
+
+    def __init__(self, burst: float, now: float):
+        self.tokens = burst
+        self.updated_at = now
+        self.notified_at = None
+        self.last_key = None
+        self.last_at = 0.0
+        self.in_flight = set()
+
+    def take(self, now: float, rate: float, burst: float) -> bool:
+        self.tokens = min(burst, self.tokens + (now - self.updated_at) * rate)
+        self.updated_at = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+def _content_key(update):
+    """По чему апдейты считаются одинаковыми: текст, файл сообщения или данные кнопки"""
+    message = update.message
+    if message is not None:
+        if message.text is not None:
+            return 'message', message.text
+        media = message.photo[-1] if message.photo else (
+            message.document or message.video or message.animation or message.audio
+            or message.voice or message.video_note or message.sticker
+        )
+        if media is not None:
+            return 'file', media.file_unique_id
+        # Контакт, геопозиция и прочее без файла одинаковыми с другими сообщениями не считаются
+        return 'message_id', message.message_id
+    if update.callback_query is not None:
+        return 'callback', update.callback_query.data
+    return None
+
+
+class AntiFlood:
+    """Outer middleware апдейтов: лимит на чат и подавление дубликатов"""
+
+    def __init__(self, rate: float = ANTIFLOOD_RATE, burst: float = ANTIFLOOD_BURST,
+                 duplicate_window: float = ANTIFLOOD_DUPLICATE_WINDOW,
+                 notice_interval: float = ANTIFLOOD_NOTICE_INTERVAL, max_chats: int = ANTIFLOOD_MAX_CHATS):
+        self.rate = rate
+        self.burst = burst
+        self.duplicate_window = duplicate_window
+        self.notice_interval = notice_interval
+        self.max_chats = max_chats
+        self._chats = OrderedDict()
+        self._seen = OrderedDict()
+        self._report_task = None
+
+        self.passed = 0
+        self.limited = 0
+        self.duplicates = 0
+        self.redelivered = 0
+        self.notices = 0
+        self.offenders = Counter()
+
+    def setup(self, dp):
+        """Регистрирует middleware первым обработчиком апдейтов, если включен ANTIFLOOD"""
+        if not ANTIFLOOD:
+            return
+        dp.update.outer_middleware(self)
+        dp.startup.register(self.on_startup)
+        dp.shutdown.register(self.on_shutdown)
+
+    def _state(self, chat_id: int, now: float) -> ChatState:
+        state = self._chats.pop(chat_id, None)
+        if state is None:
+            state = ChatState(self.burst, now)
+        self._chats[chat_id] = state
+        # Давно не писавшие чаты вытесняются; их корзина и так была бы полной
+        while len(self._chats) > self.max_chats:
+            self._chats.popitem(last=False)
+        return state
+
+    def _redelivered(self, update_id: int) -> bool:
+        if update_id in self._seen:
+            return True
+        self._seen[update_id] = None
+        if len(self._seen) > SEEN_UPDATES:
+            self._seen.popitem(last=False)
+        return False
+
+    async def _drop(self, update):
+        """Отбрасывает апдейт; нажатие кнопки подтверждается без текста"""
+        if update.callback_query is None:
+            return None
+        try:
+            await update.callback_query.answer()
+        except Exception as e:
+            # Повторно доставленный или устаревший callback уже нельзя подтвердить
+            logger.debug("Не удалось подтвердить отброшенное нажатие: %s", e)
+        return None
+
+    async def _notify(self, update, state: ChatState, now: float):
+        if state.notified_at is not None and now - state.notified_at < self.notice_interval:
+            return await self._drop(update)
+        state.notified_at = now
+        self.notices += 1
+        try:
+            if update.callback_query is not None:
+                await update.callback_query.answer(NOTICE_TEXT)
+            elif update.message is not None:
+                await update.message.answer(NOTICE_TEXT)
+        except Exception as e:
+            logger.warning("Не удалось отправить предупреждение о лимите: %s", e)
+
+    async def __call__(self, handler, event, data):
+        chat = data.get('event_chat')
+        if chat is None:
+            return await handler(event, data)
+
+        if self._redelivered(event.update_id):
+            self.redelivered += 1
+            return await self._drop(event)
+
+        now = time.monotonic()
+        state = self._state(chat.id, now)
+        key = _content_key(event)
+        if key is not None and (key in state.in_flight or (
+                key == state.last_key and now - state.last_at < self.duplicate_window)):
+            self.duplicates += 1
+            self.offenders[chat.id] += 1
+            return await self._drop(event)
+
+        if not state.take(now, self.rate, self.burst):
+            self.limited += 1
+            self.offenders[chat.id] += 1
+            await self._notify(event, state, now)
+            return None
+
+        self.passed += 1
+        state.last_key, state.last_at = key, now
+        if key is None:
+            return await handler(event, data)
+        state.in_flight.add(key)
+        try:
+            return await handler(event, data)
+        finally:
+            state.in_flight.discard(key)
+
+    def log_report(self):
+        logger.info(
+            "Антифлуд: пропущено %d, отброшено по лимиту %d, дубликатов %d, повторных доставок %d, "
+            "предупреждений %d",
+            self.passed, self.limited, self.duplicates, self.redelivered, self.notices
+        )
+        for chat_id, dropped in self.offenders.most_common(REPORT_TOP):
+            logger.warning("Антифлуд: чат %s, отброшено апдейтов: %d", chat_id, dropped)
+        self.offenders.clear()
+
+    async def _report_loop(self, interval: float):
+        reported = 0
+        while True:
+            await asyncio.sleep(interval)
+            dropped = self.limited + self.duplicates + self.redelivered
+            if dropped != reported:
+                reported = dropped
+                self.log_report()
+
+    async def on_startup(self):
+        if ANTIFLOOD_LOG_INTERVAL > 0:
+            self._report_task = asyncio.create_task(self._report_loop(ANTIFLOOD_LOG_INTERVAL))
+
+    async def on_shutdown(self):
+        if self._report_task is not None:
+            self._report_task.cancel()
+        self.log_report()
@@ -0,0 +1,271 @@
+"""
+Маршрутизация чтения между основной БД и репликами
+
+Запросы на чтение уходят на реплики по кругу, запись - на основную БД.
+Реплика пропускается, если ее отставание больше REPLICA_MAX_LAG секунд или
+к ней не удалось подключиться; если подходящих реплик нет, чтение идет на
+основную БД.
+
+Чтение своих записей. После коммита сервис узнает LSN записи (commit_lsn) и
+отмечает записанные ключи: их данные читаются только с реплики, уже
+применившей этот LSN (pg_last_wal_replay_lsn), или с основной БД. Между
+сервисами LSN передается в заголовке X-DB-LSN: сервис возвращает LSN своей
+записи в ответе (init_lsn_headers), клиент (ConsistentSession) запоминает самый
+новый LSN и отправляет его во всех следующих запросах к любому сервису, а
+сервис-получатель не читает с реплик, которые до него еще не дошли. Так бот
+видит изменения, сделанные одним сервисом, при чтении через другой.
+
+Подключение в сервисе:
+    init_lsn_headers(app)
+    db_router = ReplicaRouter(DB_CONFIG, connect)
+    conn = db_router.read_connection(key)   # key - пользователь, чьи данные читаются;
+                                            # можно передать несколько ключей
+    ...
+    conn.commit()
+    db_router.wrote(key, commit_lsn(conn))  # после коммита записи данных key
+                                            # (без LSN - чтение key несколько секунд с основной БД)
+
+Подключение в клиенте сервисов:
+    session = ConsistentSession()
+
+Настройки (переменные окружения):
+- DB_REPLICAS: реплики через запятую в виде host или host:port; пользователь,
+  пароль и имя БД берутся из DB_CONFIG. Не задана - все запросы идут в DB_CONFIG
+- REPLICA_MAX_LAG: допустимое отставание реплики в секундах (1.0)
+- REPLICA_LAG_CHECK_INTERVAL: как часто проверять отставание реплики, секунды (1.0)
+- REPLICA_RETRY_INTERVAL: через сколько секунд снова пробовать недоступную реплику (10)
+- READ_YOUR_WRITES_SECONDS: сколько секунд после записи читать данные ключа с основной БД (5)
+"""
+import logging
+import os
+import re
+import threading
+import time
+from contextvars import ContextVar
+
+import psycopg2
+import requests
+
+DB_REPLICAS = os.getenv('DB_REPLICAS', '')
+REPLICA_MAX_LAG = float(os.getenv('REPLICA_MAX_LAG', '1.0'))
+REPLICA_LAG_CHECK_INTERVAL = float(os.getenv('REPLICA_LAG_CHECK_INTERVAL', '1.0'))
+REPLICA_RETRY_INTERVAL = float(os.getenv('REPLICA_RETRY_INTERVAL', '10'))
+READ_YOUR_WRITES_SECONDS = float(os.getenv('READ_YOUR_WRITES_SECONDS', '5'))
+
+# Отставание реплики: 0, если все полученное WAL уже применено (основная БД простаивает),
+# иначе время с момента последней примененной транзакции
+REPLICA_LAG_QUERY = '''
+    SELECT COALESCE(
+        CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+             ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+        END, 0)
+'''
+
+# Заголовок с LSN записи: в ответе - LSN сделанной записи, в запросе - LSN,
+# который должна применить реплика, чтобы с нее можно было читать
+LSN_HEADER = 'X-DB-LSN'
+LSN_FORMAT = re.compile(r'^[0-9A-Fa-f]{1,8}/[0-9A-Fa-f]{1,8}$')
+
+# LSN из заголовка текущего запроса к сервису
+required_lsn = ContextVar('required_lsn', default=None)
+# LSN самой новой записи, сделанной при обработке текущего запроса
+written_lsn = ContextVar('written_lsn', default=None)
+
+logger = logging.getLogger(__name__)
+
+
+def lsn_value(lsn: str) -> int:
+    """LSN вида 16/B374D848 в виде числа для сравнения"""
+    high, _, low = lsn.partition('/')
+    return (int(high, 16) << 32) + int(low, 16)
+
+
+def newest_lsn(*lsns):
+    """Самый новый из LSN (None пропускаются)"""
+    return max((lsn for lsn in lsns if lsn), key=lsn_value, default=None)
+
+
+def commit_lsn(conn) -> str:
+    """LSN записи, закоммиченной на соединении с основной БД.
+
+    Запоминается как LSN текущего запроса и уходит клиенту в заголовке ответа.
+    """
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT pg_current_wal_lsn()::text")
+        lsn = cursor.fetchone()[0]
+    conn.commit()
+    written_lsn.set(newest_lsn(written_lsn.get(), lsn))
+    return lsn
+
+
+def connection_lsn(conn) -> int:
+    """До какого LSN видны данные через соединение: примененный WAL реплики или WAL основной БД"""
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT COALESCE(pg_last_wal_replay_lsn(), pg_current_wal_lsn())::text")
+        return lsn_value(cursor.fetchone()[0])
+
+
+def init_lsn_headers(app):
+    """Прием LSN из заголовка запроса и возврат LSN сделанной записи в заголовке ответа"""
+    from flask import request
+
+    @app.before_request
+    def read_required_lsn():
+        lsn = request.headers.get(LSN_HEADER)
+        required_lsn.set(lsn if lsn and LSN_FORMAT.match(lsn) else None)
+        written_lsn.set(None)
+
+    @app.after_request
+    def send_written_lsn(response):
+        lsn = written_lsn.get()
+        if lsn is not None:
+            response.headers[LSN_HEADER] = lsn
+        return response
+
+
+class ConsistentSession(requests.Session):
+    """Сессия requests клиента сервисов: передает LSN самой новой записи, о которой сообщили сервисы.
+
+    LSN общий для всех сессий процесса: запись через один сервис видна при чтении через другой.
+    """
+    _lsn = None
+    _lock = threading.Lock()
+
+    def request(self, method, url, *args, **kwargs):
+        lsn = ConsistentSession._lsn
+        if lsn is not None:
+            kwargs['headers'] = {**(kwargs.get('headers') or {}), LSN_HEADER: lsn}
+        response = super().request(method, url, *args, **kwargs)
+        written = response.headers.get(LSN_HEADER)
+        if written and LSN_FORMAT.match(written):
+            with ConsistentSession._lock:
+                ConsistentSession._lsn = newest_lsn(ConsistentSession._lsn, written)
+        return response
+
+
+def replica_configs(primary_config: dict, replicas: str = DB_REPLICAS) -> list:
+    """Параметры подключения к репликам: как у основной БД, но со своими host и port"""
+    configs = []
+    for item in replicas.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        host, _, port = item.partition(':')
+        config = dict(primary_config, host=host)
+        if port:
+            config['port'] = port
+        configs.append(config)
+    return configs
+
+
+class Replica:
+    __slots__ = ('config', 'lag', 'checked_at', 'down_until')
+
+    def __init__(self, config: dict):
+        self.config = config
+        self.lag = 0.0
+        self.checked_at = None
+        self.down_until = 0.0
+
+    @property
+    def name(self) -> str:
+        return f"{self.config.get('host')}:{self.config.get('port')}"
+
+
+class ReplicaRouter:
+    """Выбор соединения для чтения: реплика с допустимым отставанием или основная БД"""
+
+    def __init__(self, primary_config: dict, connect=None, replicas: str = DB_REPLICAS,
+                 max_lag: float = REPLICA_MAX_LAG):
+        self.primary_config = primary_config
+        self._connect = connect or (lambda config: psycopg2.connect(**config))
+        self.replicas = [Replica(config) for config in replica_configs(primary_config, replicas)]
+        self.max_lag = max_lag
+        self._next = 0
+        self._writes = {}
+        self._lock = threading.Lock()
+        self.primary_reads = 0
+        self.replica_reads = 0
+
+    def primary_connection(self):
+        return self._connect(self.primary_config)
+
+    def wrote(self, key, lsn: str = None):
+        """Отмечает запись данных key (с LSN из commit_lsn): ближайшее время они читаются
+        с реплики, применившей lsn, а без lsn - с основной БД"""
+        if key is None or not self.replicas:
+            return
+        now = time.monotonic()
+        with self._lock:
+            self._writes[key] = (now, lsn)
+            # Устаревшие отметки удаляются, чтобы словарь не рос бесконечно
+            if len(self._writes) > 10000:
+                self._writes = {
+                    written_key: written for written_key, written in self._writes.items()
+                    if now - written[0] < READ_YOUR_WRITES_SECONDS
+                }
+
+    def _read_requirement(self, keys) -> tuple:
+        """Нужна ли основная БД и какой LSN должна применить реплика для чтения keys"""
+        lsns = [required_lsn.get()]
+        now = time.monotonic()
+        for key in keys:
+            written = self._writes.get(key) if key is not None else None
+            if written is None or now - written[0] >= READ_YOUR_WRITES_SECONDS:
+                continue
+            if written[1] is None:
+                return True, None
+            lsns.append(written[1])
+        return False, newest_lsn(*lsns)
+
+    def _candidates(self) -> list:
+        with self._lock:
+            start = self._next
+            self._next = (self._next + 1) % len(self.replicas)
+        return self.replicas[start:] + self.replicas[:start]
+
+    def read_connection(self, *keys):
+        """Соединение для чтения данных keys (или общих данных, если ключи не заданы)"""
+        use_primary, min_lsn = self._read_requirement(keys) if self.replicas else (True, None)
+        if not use_primary:
+            now = time.monotonic()
+            for replica in self._candidates():
+                if replica.down_until > now:
+                    continue
+                lag_known = replica.checked_at is not None and now - replica.checked_at < REPLICA_LAG_CHECK_INTERVAL
+                if lag_known and replica.lag > self.max_lag:
+                    continue
+
+                conn = None
+                try:
+                    conn = self._connect(replica.config)
+                    if not lag_known:
+                        with conn.cursor() as cursor:
+                            cursor.execute(REPLICA_LAG_QUERY)
+                            replica.lag = float(cursor.fetchone()[0])
+                        conn.rollback()
+                        replica.checked_at = now
+                        if replica.lag > self.max_lag:
+                            logger.warning("Реплика %s отстает на %.1f с, чтение идет на основную БД",
+                                           replica.name, replica.lag)
+                            conn.close()
+                            continue
+                    if min_lsn is not None:
+                        caught_up = connection_lsn(conn) >= lsn_value(min_lsn)
+                        conn.rollback()
+                        if not caught_up:
+                            # Нужная запись до реплики еще не дошла
+                            conn.close()
+                            continue
+                except psycopg2.Error as e:
+                    if conn is not None:
+                        conn.close()
+                    logger.warning("Реплика %s недоступна: %s", replica.name, e)
+                    replica.down_until = now + REPLICA_RETRY_INTERVAL
+                    continue
+
+                self.replica_reads += 1
+                return conn
+
+        self.primary_reads += 1
+        return self.primary_connection()
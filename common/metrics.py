@@ -0,0 +1,257 @@
+"""
+Метрики обработчиков бота: время выполнения, число запросов к БД и HTTP-вызовов
+
+Подключение:
+    metrics = HandlerMetrics()
+    metrics.setup(dp)
+
+Учет обращений в рамках апдейта:
+- psycopg2.connect(..., connection_factory=CountingConnection) - запросы к БД;
+- aiohttp.ClientSession(trace_configs=[http_trace_config()]) - HTTP-вызовы aiohttp;
+- CountingSession вместо requests.Session - HTTP-вызовы requests.
+
+Настройки (переменные окружения):
+- SLOW_UPDATE_MS: порог медленного апдейта в миллисекундах (по умолчанию 500)
+- METRICS_WINDOW: сколько последних замеров хранить на обработчик для перцентилей
+- METRICS_PORT: если задан, на этом порту поднимается endpoint /metrics
+- METRICS_LOG_INTERVAL: период (в секундах) вывода сводки в лог, 0 - не выводить
+"""
+import asyncio
+import logging
+import os
+import time
+from collections import defaultdict, deque
+from contextvars import ContextVar
+
+import aiohttp
+import psycopg2.extensions
+import requests
+from aiogram import BaseMiddleware
+from aiohttp import web
+
+SLOW_UPDATE_MS = float(os.getenv('SLOW_UPDATE_MS', '500'))
+METRICS_WINDOW = int(os.getenv('METRICS_WINDOW', '1000'))
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = os.getenv('METRICS_PORT')
+METRICS_LOG_INTERVAL = float(os.getenv('METRICS_LOG_INTERVAL', '0'))
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+logger = logging.getLogger(__name__)
+
+# Счетчики текущего апдейта; у каждой задачи asyncio свое значение
+_current_stats = ContextVar('update_stats', default=None)
+
+
+class UpdateStats:
+    """Счетчики запросов к БД и HTTP-вызовов в рамках одного апдейта"""
+    __slots__ = ('db_queries', 'db_ms', 'http_calls', 'http_ms')
+
+    def __init__(self):
+        self.db_queries = 0
+        self.db_ms = 0.0
+        self.http_calls = 0
+        self.http_ms = 0.0
+
+
+def count_db_query(elapsed_ms: float):
+    stats = _current_stats.get()
+    if stats is not None:
+        stats.db_queries += 1
+        stats.db_ms += elapsed_ms
+
+
+def count_http_call(elapsed_ms: float):
+    stats = _current_stats.get()
+    if stats is not None:
+        stats.http_calls += 1
+        stats.http_ms += elapsed_ms
+
+
+class _CountingCursor:
+    """Обертка над курсором psycopg2, считающая выполненные запросы"""
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        try:
+            return self._cursor.execute(query, vars)
+        finally:
+            count_db_query((time.perf_counter() - start) * 1000)
+
+    def executemany(self, query, vars_list):
+        start = time.perf_counter()
+        try:
+            return self._cursor.executemany(query, vars_list)
+        finally:
+            count_db_query((time.perf_counter() - start) * 1000)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __enter__(self):
+        self._cursor.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        return self._cursor.__exit__(*exc_info)
+
+
+class CountingConnection(psycopg2.extensions.connection):
+    """Соединение, курсоры которого учитываются в метриках апдейта.
+
+    Использование: psycopg2.connect(..., connection_factory=CountingConnection)
+    """
+
+    def cursor(self, *args, **kwargs):
+        return _CountingCursor(super().cursor(*args, **kwargs))
+
+
+class CountingSession(requests.Session):
+    """Сессия requests, учитывающая исходящие HTTP-вызовы в метриках апдейта"""
+
+    def request(self, method, url, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().request(method, url, *args, **kwargs)
+        finally:
+            count_http_call((time.perf_counter() - start) * 1000)
+
+
+def http_trace_config() -> aiohttp.TraceConfig:
+    """TraceConfig для aiohttp.ClientSession, считающий исходящие HTTP-вызовы"""
+
+    async def on_request_start(session, context, params):
+        context.started_at = time.perf_counter()
+
+    async def on_request_done(session, context, params):
+        count_http_call((time.perf_counter() - context.started_at) * 1000)
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(on_request_start)
+    trace_config.on_request_end.append(on_request_done)
+    trace_config.on_request_exception.append(on_request_done)
+    return trace_config
+
+
+def _percentile(sorted_values, quantile: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(quantile * len(sorted_values)))
+    return sorted_values[index]
+
+
+class HandlerMetrics(BaseMiddleware):
+    """Middleware, замеряющий время обработчиков и число обращений к БД/HTTP"""
+
+    def __init__(self, slow_ms: float = SLOW_UPDATE_MS, window: int = METRICS_WINDOW):
+        self.slow_ms = slow_ms
+        self.durations = defaultdict(lambda: deque(maxlen=window))
+        self.calls = defaultdict(int)
+        self.slow_calls = defaultdict(int)
+        self.db_queries = defaultdict(int)
+        self.http_calls = defaultdict(int)
+        self._log_task = None
+        self._runner = None
+
+    def setup(self, dp):
+        """Регистрирует middleware и фоновые задачи экспорта в диспетчере"""
+        dp.message.middleware(self)
+        dp.callback_query.middleware(self)
+        dp.startup.register(self.on_startup)
+        dp.shutdown.register(self.on_shutdown)
+
+    async def __call__(self, handler, event, data):
+        stats = UpdateStats()
+        token = _current_stats.set(stats)
+        start = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            _current_stats.reset(token)
+            handler_object = data.get('handler')
+            name = handler_object.callback.__name__ if handler_object else 'unknown'
+            self.record(name, elapsed_ms, stats)
+
+    def record(self, name: str, elapsed_ms: float, stats: UpdateStats):
+        self.durations[name].append(elapsed_ms)
+        self.calls[name] += 1
+        self.db_queries[name] += stats.db_queries
+        self.http_calls[name] += stats.http_calls
+
+        if elapsed_ms >= self.slow_ms:
+            self.slow_calls[name] += 1
+            other_ms = max(0.0, elapsed_ms - stats.db_ms - stats.http_ms)
+            logger.warning(
+                "Медленный апдейт: %s %.1f мс (БД: %d запр. %.1f мс, HTTP: %d выз. %.1f мс, прочее: %.1f мс)",
+                name, elapsed_ms, stats.db_queries, stats.db_ms,
+                stats.http_calls, stats.http_ms, other_ms
+            )
+
+    def snapshot(self) -> dict:
+        """Сводка по обработчикам: число вызовов, перцентили, средние DB/HTTP"""
+        result = {}
+        for name, samples in list(self.durations.items()):
+            values = sorted(samples)
+            calls = self.calls[name]
+            result[name] = {
+                "calls": calls,
+                "slow": self.slow_calls[name],
+                "quantiles": {q: _percentile(values, q) for q in QUANTILES},
+                "db_per_update": self.db_queries[name] / calls,
+                "http_per_update": self.http_calls[name] / calls,
+            }
+        return result
+
+    def render_prometheus(self) -> str:
+        lines = []
+        for name, item in sorted(self.snapshot().items()):
+            for quantile, value in item["quantiles"].items():
+                lines.append(f'handler_duration_ms{{handler="{name}",quantile="{quantile}"}} {value:.3f}')
+            lines.append(f'handler_calls_total{{handler="{name}"}} {item["calls"]}')
+            lines.append(f'handler_slow_total{{handler="{name}"}} {item["slow"]}')
+            lines.append(f'handler_db_queries_total{{handler="{name}"}} {self.db_queries[name]}')
+            lines.append(f'handler_http_calls_total{{handler="{name}"}} {self.http_calls[name]}')
+        return "\n".join(lines) + "\n"
+
+    def log_summary(self):
+        for name, item in sorted(self.snapshot().items()):
+            q = item["quantiles"]
+            logger.info(
+                "metrics %s: n=%d p50=%.1f p95=%.1f p99=%.1f мс, медленных=%d, БД/апд=%.2f, HTTP/апд=%.2f",
+                name, item["calls"], q[0.5], q[0.95], q[0.99], item["slow"],
+                item["db_per_update"], item["http_per_update"]
+            )
+
+    async def _log_loop(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            self.log_summary()
+
+    async def _handle_metrics(self, request):
+        return web.Response(text=self.render_prometheus(), content_type='text/plain')
+
+    async def on_startup(self):
+        if METRICS_LOG_INTERVAL > 0:
+            self._log_task = asyncio.create_task(self._log_loop(METRICS_LOG_INTERVAL))
+
+        if METRICS_PORT:
+            app = web.Application()
+            app.router.add_get('/metrics', self._handle_metrics)
+            self._runner = web.AppRunner(app)
+            await self._runner.setup()
+            await web.TCPSite(self._runner, METRICS_HOST, int(METRICS_PORT)).start()
+            logger.info("Метрики доступны на http://%s:%s/metrics", METRICS_HOST, METRICS_PORT)
+
+    async def on_shutdown(self):
+        if self._log_task:
+            self._log_task.cancel()
+        if self._runner:
+            await self._runner.cleanup()
+        self.log_summary()
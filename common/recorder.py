@@ -0,0 +1,128 @@
+"""
+Запись входящих апдейтов бота для последующего воспроизведения (replay.py)
+
+Каждый апдейт, пришедший в диспетчер, дописывается в журнал RECORD_UPDATES
+одной JSON-строкой {"ts": <unix time>, "update": {...}} - до фильтров и
+обработчиков, поэтому в запись попадают и апдейты, которые бот не обработал.
+Журнал с расширением .gz пишется сжатым.
+
+Данные пользователей обезличиваются: идентификаторы пользователей и чатов
+заменяются псевдонимами (HMAC от RECORD_SALT, одинаковый id в пределах записи
+дает одинаковый псевдоним), имена заменяются заглушкой, username, телефоны и
+геопозиция удаляются. Текст сообщений и callback_data сохраняются как есть:
+без них воспроизведение не повторит поведение бота. Идентификаторы внутри
+текста (например, в админских командах) не заменяются.
+
+Подключение:
+    recorder = UpdateRecorder()
+    recorder.setup(dp)
+
+Настройки (переменные окружения):
+- RECORD_UPDATES: путь к журналу; не задан - запись выключена
+- RECORD_SALT: ключ псевдонимов; не задан - случайный на каждый запуск бота
+- RECORD_ANONYMIZE: обезличивать апдейты (true); false - только для тестовых ботов
+"""
+import gzip
+import hashlib
+import hmac
+import json
+import logging
+import os
+import time
+
+RECORD_UPDATES = os.getenv('RECORD_UPDATES', '')
+RECORD_SALT = os.getenv('RECORD_SALT', '')
+RECORD_ANONYMIZE = os.getenv('RECORD_ANONYMIZE', 'true').lower() == 'true'
+
+# Сжатый журнал сбрасывается на диск через столько апдейтов
+GZIP_FLUSH_EVERY = 100
+
+# Объекты, поле id которых - идентификатор пользователя или чата
+ID_OWNERS = {'from', 'chat', 'user', 'sender_chat', 'forward_from', 'forward_from_chat', 'new_chat_member',
+             'old_chat_member', 'via_bot'}
+# Поля-идентификаторы в любом объекте
+ID_FIELDS = {'chat_id', 'user_id'}
+# Поля с персональными данными, которые заменяются или удаляются
+NAME_PLACEHOLDERS = {'first_name': 'User', 'title': 'Chat'}
+DROPPED_FIELDS = {'last_name', 'username', 'phone_number', 'contact', 'location', 'venue', 'bio'}
+
+logger = logging.getLogger(__name__)
+
+
+class Anonymizer:
+    """Замена идентификаторов и персональных данных в апдейте"""
+
+    def __init__(self, salt: str = RECORD_SALT):
+        self._key = (salt or os.urandom(16).hex()).encode()
+
+    def pseudonym(self, value: int) -> int:
+        digest = hmac.new(self._key, str(abs(value)).encode(), hashlib.sha256).hexdigest()
+        # Знак сохраняется: у групп и каналов id отрицательный
+        return (int(digest[:12], 16) % 10 ** 12 + 1) * (-1 if value < 0 else 1)
+
+    def anonymize(self, value, owner: str = None):
+        if isinstance(value, list):
+            return [self.anonymize(item, owner) for item in value]
+        if not isinstance(value, dict):
+            return value
+
+        result = {}
+        for key, item in value.items():
+            if key in DROPPED_FIELDS:
+                continue
+            if key in NAME_PLACEHOLDERS and isinstance(item, str):
+                result[key] = NAME_PLACEHOLDERS[key]
+            elif isinstance(item, int) and (key in ID_FIELDS or (key == 'id' and owner in ID_OWNERS)):
+                result[key] = self.pseudonym(item)
+            else:
+                result[key] = self.anonymize(item, key)
+        return result
+
+
+class UpdateRecorder:
+    """Outer middleware, дописывающий каждый входящий апдейт в журнал"""
+
+    def __init__(self, path: str = RECORD_UPDATES, anonymize: bool = RECORD_ANONYMIZE):
+        self.path = path
+        self.anonymizer = Anonymizer() if anonymize else None
+        self.recorded = 0
+        self._file = None
+
+    def setup(self, dp):
+        """Регистрирует middleware, если задан RECORD_UPDATES"""
+        if not self.path:
+            return
+        dp.update.outer_middleware(self)
+        dp.shutdown.register(self.on_shutdown)
+
+    def _open(self):
+        if self.path.endswith('.gz'):
+            # Новый запуск дописывает отдельный gzip-поток; такой файл читается целиком
+            return gzip.open(self.path, 'at', encoding='utf-8')
+        return open(self.path, 'a', encoding='utf-8', buffering=1)
+
+    def record(self, update: dict):
+        if self.anonymizer is not None:
+            update = self.anonymizer.anonymize(update)
+        if self._file is None:
+            self._file = self._open()
+            logger.info("Запись апдейтов в %s", self.path)
+        self._file.write(json.dumps({'ts': round(time.time(), 3), 'update': update},
+                                    ensure_ascii=False, separators=(',', ':')) + '\n')
+        self.recorded += 1
+        if self.path.endswith('.gz') and self.recorded % GZIP_FLUSH_EVERY == 0:
+            self._file.flush()
+
+    async def __call__(self, handler, event, data):
+        try:
+            self.record(event.model_dump(mode='json', exclude_none=True, by_alias=True))
+        except Exception as e:
+            # Сбой записи не должен мешать обработке апдейта
+            logger.error("Не удалось записать апдейт: %s", e)
+        return await handler(event, data)
+
+    async def on_shutdown(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            logger.info("Записано апдейтов: %d", self.recorded)
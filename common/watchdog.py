@@ -0,0 +1,188 @@
+"""
+Сторож цикла событий: задержка цикла и поиск блокирующих вызовов
+
+Фоновая задача просыпается каждые LOOP_WATCHDOG_INTERVAL_MS и замеряет, на
+сколько позже положенного она получила управление - это задержка цикла
+событий. Отдельный поток следит за этими пробуждениями: если цикл не
+отвечает дольше LOOP_WATCHDOG_THRESHOLD_MS, поток снимает стек основного
+потока, то есть того кода, который сейчас держит цикл (например, синхронный
+запрос к БД или requests внутри обработчика). Зависания группируются по
+месту в коде бота; в лог выводятся самые тяжелые места с числом зависаний
+и примером стека.
+
+Подключение:
+    watchdog = LoopWatchdog()
+    watchdog.setup(dp)
+
+Настройки (переменные окружения):
+- LOOP_WATCHDOG: включить сторож (false)
+- LOOP_WATCHDOG_THRESHOLD_MS: с какой задержки цикл считается заблокированным (100)
+- LOOP_WATCHDOG_INTERVAL_MS: период замера задержки (50)
+- LOOP_WATCHDOG_REPORT_INTERVAL: период вывода отчета в лог в секундах, 0 - только при остановке (60)
+- LOOP_WATCHDOG_TOP: сколько мест показывать в отчете (5)
+"""
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+
+LOOP_WATCHDOG = os.getenv('LOOP_WATCHDOG', 'false').lower() == 'true'
+LOOP_WATCHDOG_THRESHOLD_MS = float(os.getenv('LOOP_WATCHDOG_THRESHOLD_MS', '100'))
+LOOP_WATCHDOG_INTERVAL_MS = float(os.getenv('LOOP_WATCHDOG_INTERVAL_MS', '50'))
+LOOP_WATCHDOG_REPORT_INTERVAL = float(os.getenv('LOOP_WATCHDOG_REPORT_INTERVAL', '60'))
+LOOP_WATCHDOG_TOP = int(os.getenv('LOOP_WATCHDOG_TOP', '5'))
+
+# Сколько последних замеров задержки хранить для перцентилей
+LAG_WINDOW = 2000
+# Сколько кадров стека сохранять в примере
+STACK_DEPTH = 8
+
+# Код ботов - файлы репозитория (каталог над common); по ним определяется место зависания
+CODE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+logger = logging.getLogger(__name__)
+
+
+class Offender:
+    """Место в коде, на котором цикл событий зависал"""
+    __slots__ = ('count', 'total_ms', 'max_ms', 'stack')
+
+    def __init__(self, stack: str):
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.stack = stack
+
+
+def _blocking_site(frame) -> tuple:
+    """Место зависания (самый глубокий кадр кода бота) и пример стека"""
+    frames = traceback.extract_stack(frame)
+    own = [
+        item for item in frames
+        if item.filename.startswith(CODE_DIR) and item.filename != __file__
+    ]
+    site = own[-1] if own else frames[-1]
+    filename = os.path.relpath(site.filename, CODE_DIR) if own else os.path.basename(site.filename)
+    key = f"{filename}:{site.lineno} {site.name}"
+    stack = "".join(traceback.format_list(frames[-STACK_DEPTH:]))
+    return key, stack
+
+
+def _percentile(sorted_values, quantile: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(quantile * len(sorted_values)))]
+
+
+class LoopWatchdog:
+    """Замер задержки цикла событий и поиск кода, который его блокирует"""
+
+    def __init__(self, threshold_ms: float = LOOP_WATCHDOG_THRESHOLD_MS,
+                 interval_ms: float = LOOP_WATCHDOG_INTERVAL_MS):
+        self.threshold = threshold_ms / 1000
+        self.interval = interval_ms / 1000
+        self.lags = deque(maxlen=LAG_WINDOW)
+        self.offenders = {}
+        self.stalls = 0
+        self._expected_at = None
+        self._captured = None
+        self._lock = threading.Lock()
+        self._loop_thread_id = None
+        self._stopped = threading.Event()
+        self._tasks = []
+        self._thread = None
+
+    def setup(self, dp):
+        """Запускает сторож вместе с диспетчером, если он включен LOOP_WATCHDOG"""
+        if not LOOP_WATCHDOG:
+            return
+        dp.startup.register(self.on_startup)
+        dp.shutdown.register(self.on_shutdown)
+
+    async def _heartbeat(self):
+        while True:
+            expected_at = self._expected_at = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, time.monotonic() - expected_at)
+            self.lags.append(lag * 1000)
+            if lag >= self.threshold:
+                self._record_stall(lag * 1000, expected_at)
+
+    def _record_stall(self, lag_ms: float, expected_at: float):
+        with self._lock:
+            captured, self._captured = self._captured, None
+        # Стек берется, только если он снят во время этого же зависания;
+        # короткое зависание поток мог не успеть застать
+        if captured is not None and captured[0] == expected_at:
+            _, key, stack = captured
+        else:
+            key, stack = "не определено (стек не снят)", ""
+
+        self.stalls += 1
+        offender = self.offenders.get(key)
+        if offender is None:
+            offender = self.offenders[key] = Offender(stack)
+        offender.count += 1
+        offender.total_ms += lag_ms
+        if lag_ms > offender.max_ms:
+            offender.max_ms = lag_ms
+            offender.stack = stack or offender.stack
+
+    def _watch(self):
+        """Поток-наблюдатель: снимает стек цикла событий, если тот не проснулся вовремя"""
+        poll = max(self.threshold / 4, 0.005)
+        while not self._stopped.wait(poll):
+            expected_at = self._expected_at
+            if expected_at is None or time.monotonic() - expected_at < self.threshold:
+                continue
+            with self._lock:
+                if self._captured is not None and self._captured[0] == expected_at:
+                    continue
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+            key, stack = _blocking_site(frame)
+            with self._lock:
+                self._captured = (expected_at, key, stack)
+
+    async def _report_loop(self, interval: float):
+        reported = 0
+        while True:
+            await asyncio.sleep(interval)
+            if self.stalls != reported:
+                reported = self.stalls
+                self.log_report()
+
+    def log_report(self):
+        lags = sorted(self.lags)
+        logger.info(
+            "Цикл событий: задержка p50=%.1f p99=%.1f max=%.1f мс, зависаний дольше %.0f мс: %d",
+            _percentile(lags, 0.5), _percentile(lags, 0.99), lags[-1] if lags else 0.0,
+            self.threshold * 1000, self.stalls
+        )
+        worst = sorted(self.offenders.items(), key=lambda item: item[1].total_ms, reverse=True)
+        for key, offender in worst[:LOOP_WATCHDOG_TOP]:
+            logger.warning(
+                "Блокирующий вызов %s: %d раз, всего %.0f мс, максимум %.0f мс\n%s",
+                key, offender.count, offender.total_ms, offender.max_ms, offender.stack
+            )
+
+    async def on_startup(self):
+        self._loop_thread_id = threading.get_ident()
+        self._stopped.clear()
+        self._tasks = [asyncio.create_task(self._heartbeat())]
+        if LOOP_WATCHDOG_REPORT_INTERVAL > 0:
+            self._tasks.append(asyncio.create_task(self._report_loop(LOOP_WATCHDOG_REPORT_INTERVAL)))
+        self._thread = threading.Thread(target=self._watch, name='loop-watchdog', daemon=True)
+        self._thread.start()
+        logger.info("Сторож цикла событий включен: порог %.0f мс", self.threshold * 1000)
+
+    async def on_shutdown(self):
+        self._stopped.set()
+        for task in self._tasks:
+            task.cancel()
+        self.log_report()
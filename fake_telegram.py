@@ -0,0 +1,363 @@
+"""
+Локальный Bot API сервер и нагрузочный драйвер для сквозных замеров ботов
+
+Сервер реализует методы getUpdates (long polling), sendMessage,
+editMessageText, answerCallbackQuery, setMyCommands, а также getMe и
+deleteWebhook, которые aiogram вызывает при запуске. Задержка ответа,
+ограничения частоты и ответы 429 настраиваются; неподдерживаемые методы
+отвечают 400, чтобы пробел в эмуляции был виден сразу.
+
+Драйвер в том же процессе имитирует чаты: каждый чат по очереди отправляет
+шаги сценария, ждет ответа бота и переходит к следующему шагу. Время шага -
+от появления апдейта на сервере до первого sendMessage/editMessageText бота
+в этот чат, то есть весь путь polling - обработчик - ответ.
+
+Запуск:
+    python fake_telegram.py --chats 1000 --steps /start /balance --port 8081
+    # в другом терминале бот, направленный на локальный сервер:
+    TELEGRAM_API_URL=http://127.0.0.1:8081 python rgz/bot.py
+
+Шаг вида cb:ДАННЫЕ отправляется как нажатие inline-кнопки с callback_data
+ДАННЫЕ под последним сообщением бота в чате. Драйвер ждет, пока бот начнет
+опрашивать сервер (--wait-bot), затем запускает чаты, растягивая старт на --ramp
+секунд, и выводит отчет: ответы и таймауты, пропускную способность,
+перцентили времени шага и ожидания апдейта в очереди, вызовы Bot API и 429.
+
+Ограничения как у Telegram: --global-rate 30 --chat-rate 1.
+"""
+import argparse
+import asyncio
+import json
+import math
+import random
+import time
+from collections import Counter, defaultdict
+
+from aiohttp import web
+
+BOT_USER = {"id": 123456, "is_bot": True, "first_name": "Fake", "username": "fake_bot"}
+
+# Сколько апдейтов отдавать в getUpdates, если limit не задан (как у Telegram)
+DEFAULT_UPDATES_LIMIT = 100
+
+# Методы, ответ которых считается ответом бота пользователю
+REPLY_METHODS = {'sendMessage', 'editMessageText'}
+
+
+def _percentile(sorted_values, quantile: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(quantile * len(sorted_values)))]
+
+
+def _format_latency(values) -> str:
+    values = sorted(values)
+    return (f"p50 {_percentile(values, 0.5):.1f}, p95 {_percentile(values, 0.95):.1f}, "
+            f"p99 {_percentile(values, 0.99):.1f}, max {values[-1] if values else 0.0:.1f} мс")
+
+
+class TokenBucket:
+    """Ограничение частоты: rate запросов в секунду с запасом burst"""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+
+    def take(self) -> float:
+        """Списывает токен; если токенов нет - возвращает, через сколько секунд он появится"""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class FakeTelegram:
+    """Состояние поддельного Bot API: очередь апдейтов, сообщения бота и счетчики"""
+
+    def __init__(self, latency_ms: float = 0.0, jitter_ms: float = 0.0, global_rate: float = 0.0,
+                 chat_rate: float = 0.0, chat_burst: float = 3.0, error_rate: float = 0.0,
+                 retry_after: int = 1):
+        self.latency = latency_ms / 1000
+        self.jitter = jitter_ms / 1000
+        self.global_bucket = TokenBucket(global_rate, global_rate) if global_rate > 0 else None
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.chat_buckets = {}
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+
+        self.updates = []
+        self.next_update_id = 1
+        self._updates_changed = asyncio.Condition()
+        self._pushed_at = {}
+        self.queue_waits = []
+        self.polls = 0
+        self.delivered = 0
+        self.polling = asyncio.Event()
+
+        self.message_ids = defaultdict(int)
+        self.last_messages = {}
+        self.reply_queues = {}
+        self.calls = Counter()
+        self.rejected = Counter()
+
+    # --- апдейты ---
+
+    async def push_update(self, kind: str, payload: dict) -> int:
+        update_id = self.next_update_id
+        self.next_update_id += 1
+        self._pushed_at[update_id] = time.monotonic()
+        async with self._updates_changed:
+            self.updates.append({"update_id": update_id, kind: payload})
+            self._updates_changed.notify_all()
+        return update_id
+
+    def user_message(self, chat_id: int, text: str) -> dict:
+        self.message_ids[chat_id] += 1
+        return {
+            "message_id": self.message_ids[chat_id], "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private", "first_name": "User"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": "User"},
+            "text": text,
+        }
+
+    def callback_query(self, chat_id: int, data: str) -> dict:
+        query = {
+            "id": f"{chat_id}-{self.next_update_id}", "chat_instance": str(chat_id), "data": data,
+            "from": {"id": chat_id, "is_bot": False, "first_name": "User"},
+        }
+        if chat_id in self.last_messages:
+            query["message"] = self.last_messages[chat_id]
+        return query
+
+    async def get_updates(self, params: dict) -> list:
+        offset = int(params.get('offset') or 0)
+        limit = int(params.get('limit') or DEFAULT_UPDATES_LIMIT)
+        timeout = float(params.get('timeout') or 0)
+        self.polls += 1
+        self.polling.set()
+
+        async with self._updates_changed:
+            # Апдейты с id меньше offset подтверждены ботом и удаляются
+            if offset:
+                self.updates = [update for update in self.updates if update["update_id"] >= offset]
+            if not self.updates and timeout > 0:
+                try:
+                    await asyncio.wait_for(self._updates_changed.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+            batch = self.updates[:limit]
+
+        now = time.monotonic()
+        for update in batch:
+            pushed_at = self._pushed_at.pop(update["update_id"], None)
+            if pushed_at is not None:
+                self.queue_waits.append((now - pushed_at) * 1000)
+                self.delivered += 1
+        return batch
+
+    # --- ответы бота ---
+
+    def _bot_message(self, params: dict, message_id: int = None) -> dict:
+        chat_id = int(params['chat_id'])
+        if message_id is None:
+            self.message_ids[chat_id] += 1
+            message_id = self.message_ids[chat_id]
+        message = {
+            "message_id": message_id, "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private", "first_name": "User"},
+            "from": BOT_USER, "text": params.get('text', ''),
+        }
+        markup = params.get('reply_markup')
+        if markup:
+            if isinstance(markup, str):
+                markup = json.loads(markup)
+            if 'inline_keyboard' in markup:
+                message["reply_markup"] = markup
+        self.last_messages[chat_id] = message
+        return message
+
+    def _notify_reply(self, params: dict):
+        chat_id = params.get('chat_id')
+        queue = self.reply_queues.get(int(chat_id)) if chat_id else None
+        if queue is not None:
+            queue.put_nowait(time.monotonic())
+
+    def _limited(self, params: dict) -> float:
+        """Через сколько секунд можно повторить запрос, если он превысил лимиты; 0 - не превысил"""
+        if self.error_rate and random.random() < self.error_rate:
+            return self.retry_after
+        if self.global_bucket is not None:
+            wait = self.global_bucket.take()
+            if wait:
+                return wait
+        chat_id = params.get('chat_id')
+        if self.chat_rate > 0 and chat_id:
+            bucket = self.chat_buckets.get(chat_id)
+            if bucket is None:
+                bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+            return bucket.take()
+        return 0.0
+
+    async def call(self, method: str, params: dict):
+        """Выполняет метод Bot API; возвращает (HTTP-статус, тело ответа)"""
+        self.calls[method] += 1
+        if method == 'getUpdates':
+            return 200, {"ok": True, "result": await self.get_updates(params)}
+
+        if self.latency or self.jitter:
+            await asyncio.sleep(self.latency + random.uniform(0, self.jitter))
+
+        if method in REPLY_METHODS:
+            wait = self._limited(params)
+            if wait:
+                self.rejected[method] += 1
+                retry_after = max(1, math.ceil(wait))
+                return 429, {"ok": False, "error_code": 429, "parameters": {"retry_after": retry_after},
+                             "description": f"Too Many Requests: retry after {retry_after}"}
+
+        if method == 'sendMessage':
+            result = self._bot_message(params)
+        elif method == 'editMessageText':
+            if 'chat_id' not in params:
+                result = True
+            else:
+                result = self._bot_message(params, int(params['message_id']))
+        elif method in ('answerCallbackQuery', 'setMyCommands', 'deleteWebhook'):
+            result = True
+        elif method == 'getMe':
+            result = BOT_USER
+        else:
+            return 400, {"ok": False, "error_code": 400,
+                         "description": f"Bad Request: метод {method} не поддерживается локальным сервером"}
+
+        if method in REPLY_METHODS:
+            self._notify_reply(params)
+        return 200, {"ok": True, "result": result}
+
+    async def handle(self, request: web.Request) -> web.Response:
+        params = dict(request.query)
+        if request.can_read_body:
+            if request.content_type == 'application/json':
+                params.update(await request.json())
+            else:
+                params.update(await request.post())
+        status, body = await self.call(request.match_info['method'], params)
+        return web.json_response(body, status=status)
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_route('*', '/bot{token}/{method}', self.handle)
+        return app
+
+
+class ChatResult:
+    __slots__ = ('latencies', 'timeouts')
+
+    def __init__(self):
+        self.latencies = []
+        self.timeouts = 0
+
+
+async def drive_chat(fake: FakeTelegram, chat_id: int, steps: list, result: ChatResult,
+                     reply_timeout: float, settle: float, think: float):
+    """Один пользователь: шаг сценария, ожидание ответа бота, следующий шаг"""
+    replies = fake.reply_queues[chat_id] = asyncio.Queue()
+    for step in steps:
+        if step.startswith('cb:'):
+            await fake.push_update('callback_query', fake.callback_query(chat_id, step[3:]))
+        else:
+            await fake.push_update('message', fake.user_message(chat_id, step))
+        sent_at = time.monotonic()
+
+        try:
+            replied_at = await asyncio.wait_for(replies.get(), reply_timeout)
+            result.latencies.append((replied_at - sent_at) * 1000)
+        except asyncio.TimeoutError:
+            result.timeouts += 1
+            continue
+
+        # Остальные сообщения бота на этот шаг не должны засчитаться следующему
+        while True:
+            try:
+                await asyncio.wait_for(replies.get(), settle)
+            except asyncio.TimeoutError:
+                break
+        if think:
+            await asyncio.sleep(think)
+
+
+async def run(args):
+    fake = FakeTelegram(args.latency, args.jitter, args.global_rate, args.chat_rate, args.chat_burst,
+                        args.error_rate, args.retry_after)
+    runner = web.AppRunner(fake.app(), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, args.host, args.port).start()
+    print(f"Bot API сервер: http://{args.host}:{args.port}, ожидание бота (TELEGRAM_API_URL)...")
+
+    try:
+        await asyncio.wait_for(fake.polling.wait(), args.wait_bot)
+    except asyncio.TimeoutError:
+        print("Бот не начал опрашивать сервер")
+        await runner.cleanup()
+        return
+
+    results = [ChatResult() for _ in range(args.chats)]
+
+    async def start_chat(index: int):
+        if args.ramp:
+            await asyncio.sleep(args.ramp * index / args.chats)
+        await drive_chat(fake, args.first_chat_id + index, args.steps, results[index],
+                         args.reply_timeout, args.settle / 1000, args.think / 1000)
+
+    started = time.monotonic()
+    await asyncio.gather(*(start_chat(index) for index in range(args.chats)))
+    wall = time.monotonic() - started
+    await runner.cleanup()
+
+    latencies = [latency for result in results for latency in result.latencies]
+    timeouts = sum(result.timeouts for result in results)
+    sent = args.chats * len(args.steps)
+    print(f"Чатов: {args.chats}, шагов: {sent}, с ответом: {len(latencies)}, без ответа: {timeouts}")
+    print(f"Время: {wall:.2f} с, {len(latencies) / wall if wall else 0:.1f} ответов/с")
+    print(f"Время шага (апдейт - ответ бота): {_format_latency(latencies)}")
+    print(f"Ожидание апдейта в очереди до getUpdates: {_format_latency(fake.queue_waits)}")
+    print(f"getUpdates: {fake.polls}, апдейтов на вызов: {fake.delivered / fake.polls if fake.polls else 0:.1f}")
+    print("Вызовы Bot API: " + ", ".join(f"{name} {count}" for name, count in fake.calls.most_common()))
+    if fake.rejected:
+        print("Отклонено с 429: " + ", ".join(f"{name} {count}" for name, count in fake.rejected.most_common()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Локальный Bot API сервер и нагрузка на бота")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--chats', type=int, default=100, help="сколько чатов имитировать")
+    parser.add_argument('--first-chat-id', type=int, default=1000000, help="id первого чата")
+    parser.add_argument('--steps', nargs='+', default=['/start'],
+                        help="сценарий чата: тексты сообщений, cb:ДАННЫЕ - нажатие inline-кнопки")
+    parser.add_argument('--ramp', type=float, default=0.0, help="за сколько секунд запустить все чаты")
+    parser.add_argument('--think', type=float, default=0.0, help="пауза пользователя между шагами, мс")
+    parser.add_argument('--settle', type=float, default=50.0,
+                        help="сколько ждать остальных сообщений бота после первого ответа, мс")
+    parser.add_argument('--reply-timeout', type=float, default=10.0, help="ожидание ответа на шаг, с")
+    parser.add_argument('--wait-bot', type=float, default=60.0, help="ожидание первого getUpdates от бота, с")
+    parser.add_argument('--latency', type=float, default=0.0, help="задержка ответа методов Bot API, мс")
+    parser.add_argument('--jitter', type=float, default=0.0, help="случайная добавка к задержке, до N мс")
+    parser.add_argument('--global-rate', type=float, default=0.0, help="лимит сообщений бота в секунду, 0 - нет")
+    parser.add_argument('--chat-rate', type=float, default=0.0, help="лимит сообщений в чат в секунду, 0 - нет")
+    parser.add_argument('--chat-burst', type=float, default=3.0, help="запас сообщений в чат сверх лимита")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="доля ответов 429 независимо от лимитов")
+    parser.add_argument('--retry-after', type=int, default=1, help="retry_after в случайных ответах 429, с")
+    args = parser.parse_args()
+
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,23 +1,57 @@
+import logging
 import os
+import sys
+
 import psycopg2
 from aiogram import Bot, Dispatcher, types
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.filters.command import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, BotCommand, BotCommandScopeChat
 from aiogram.utils.keyboard import ReplyKeyboardBuilder
 
+# Общие модули ботов лежат в каталоге common в корне репозитория
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common.antiflood import AntiFlood
+from common.metrics import CountingConnection, HandlerMetrics
+from common.recorder import UpdateRecorder
+from common.watchdog import LoopWatchdog
+
+logging.basicConfig(level=logging.INFO)
+
 # Получаем токен бота и данные для подключения к БД из переменных окружения
 bot_token = os.getenv('TELEGRAM_BOT_TOKEN')
+# Адрес Bot API; для нагрузочных замеров - локальный сервер (fake_telegram.py)
+telegram_api_url = os.getenv('TELEGRAM_API_URL')
 db_host = os.getenv('DB_HOST')
 db_name = os.getenv('DB_NAME')
 db_user = os.getenv('DB_USER')
 db_password = os.getenv('DB_PASSWORD')
 
 # Инициализация бота и диспетчера
-bot = Bot(token=bot_token)
+bot = Bot(token=bot_token, session=AiohttpSession(api=TelegramAPIServer.from_base(telegram_api_url))
+          if telegram_api_url else None)
 dp = Dispatcher()
 
+# Метрики обработчиков (время, запросы к БД)
+metrics = HandlerMetrics()
+metrics.setup(dp)
+
+# Сторож цикла событий: задержка цикла и блокирующие вызовы (LOOP_WATCHDOG=true)
+watchdog = LoopWatchdog()
+watchdog.setup(dp)
+
+# Запись входящих апдейтов для replay.py (RECORD_UPDATES)
+recorder = UpdateRecorder()
+recorder.setup(dp)
+
+# Лимит апдейтов на чат и подавление дубликатов до обработчиков и БД (ANTIFLOOD)
+antiflood = AntiFlood()
+antiflood.setup(dp)
+
 # Определение состояний для FSM
 class CurrencyStates(StatesGroup):
     waiting_for_currency_name = State()
@@ -37,7 +71,8 @@ def get_db_connection():
             host=db_host,
             database=db_name,
             user=db_user,
-            password=db_password
+            password=db_password,
+            connection_factory=CountingConnection
         )
         return conn
     except Exception as e:
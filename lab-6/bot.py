@@ -1,21 +1,80 @@
+import logging
 import os
+import sys
+import threading
+import time
+from urllib.parse import quote
+
 import requests
 from aiogram import Bot, Dispatcher, types
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.filters.command import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton
 from aiogram.utils.keyboard import ReplyKeyboardBuilder
 
+# Общие модули ботов лежат в каталоге common в корне репозитория
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common.antiflood import AntiFlood
+from common.db_routing import ConsistentSession
+from common.metrics import CountingSession, HandlerMetrics
+from common.recorder import UpdateRecorder
+from common.watchdog import LoopWatchdog
+from resilience import ServiceClient
+from tracing import TracingSession, UpdateTracer
+
+logging.basicConfig(level=logging.INFO)
+
 # Конфигурация
 BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
+# Адрес Bot API; для нагрузочных замеров - локальный сервер (fake_telegram.py)
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL')
 CURRENCY_SERVICE_URL = os.getenv('CURRENCY_SERVICE_URL', "http://localhost:5001")
 DATA_SERVICE_URL = os.getenv('DATA_SERVICE_URL', "http://localhost:5002")
 ROLE_SERVICE_URL = os.getenv('ROLE_SERVICE_URL', "http://localhost:5003")
 
-bot = Bot(token=BOT_TOKEN)
+# Локальная копия ролей, обновляемая через ленту изменений /roles/changes
+ROLE_SYNC = os.getenv('ROLE_SYNC', 'true').lower() == 'true'
+ROLE_SYNC_TIMEOUT = float(os.getenv('ROLE_SYNC_TIMEOUT', '25'))
+
+bot = Bot(token=BOT_TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL))
+          if TELEGRAM_API_URL else None)
 dp = Dispatcher()
 
+# Метрики обработчиков (время, HTTP-вызовы к сервисам)
+metrics = HandlerMetrics()
+metrics.setup(dp)
+
+# Сторож цикла событий: задержка цикла и блокирующие вызовы (LOOP_WATCHDOG=true)
+watchdog = LoopWatchdog()
+watchdog.setup(dp)
+
+# Трассировка апдейтов через сервисы (TRACE_LOG); разбор - python trace_report.py
+tracer = UpdateTracer()
+tracer.setup(dp)
+
+# Запись входящих апдейтов для replay.py (RECORD_UPDATES)
+recorder = UpdateRecorder()
+recorder.setup(dp)
+
+# Лимит апдейтов на чат и подавление дубликатов до обработчиков и БД (ANTIFLOOD)
+antiflood = AntiFlood()
+antiflood.setup(dp)
+
+
+class ServiceSession(TracingSession, ConsistentSession, CountingSession):
+    """Сессия клиентов сервисов: учет в метриках апдейта, передача trace id и LSN записи в заголовках"""
+
+
+# Клиенты сервисов: circuit breaker, бюджет повторов и hedged GET поверх
+# сессий с keep-alive, учетом в метриках и трассировкой
+currency_service = ServiceClient('currency-manager', CURRENCY_SERVICE_URL, ServiceSession)
+data_service = ServiceClient('data_manager', DATA_SERVICE_URL, ServiceSession)
+role_service = ServiceClient('role_manager', ROLE_SERVICE_URL, ServiceSession)
+
 # Состояния FSM
 class CurrencyStates(StatesGroup):
     waiting_for_currency_name = State()
@@ -28,17 +87,108 @@ class ConvertStates(StatesGroup):
     waiting_for_currency_to_convert = State()
     waiting_for_amount_to_convert = State()
 
+class RoleSync:
+    """Локальная карта ролей, которую фоновый поток держит актуальной long-poll запросами"""
+
+    def __init__(self, base_url: str, poll_timeout: float):
+        self.base_url = base_url
+        self.poll_timeout = poll_timeout
+        self.roles = {}
+        self.version = 0
+        self.synced_at = None
+
+    def run(self):
+        # Отдельная сессия: requests.Session не рассчитана на работу из нескольких потоков
+        session = requests.Session()
+        while True:
+            try:
+                response = session.get(
+                    f"{self.base_url}/roles/changes",
+                    params={"since": self.version, "timeout": self.poll_timeout},
+                    timeout=self.poll_timeout + 5
+                )
+                response.raise_for_status()
+                data = response.json()
+                for change in data['changes']:
+                    self.roles[change['user_id']] = change['role']
+                self.version = data['version']
+                self.synced_at = time.monotonic()
+            except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+                logging.warning(f"Ошибка синхронизации ролей: {e}")
+                time.sleep(1)
+
+    def start(self):
+        threading.Thread(target=self.run, name='role-sync', daemon=True).start()
+
+    def role(self, user_id) -> str | None:
+        """Роль из локальной карты или None, если карта еще не загружена или устарела"""
+        if self.synced_at is None or time.monotonic() - self.synced_at > self.poll_timeout * 2:
+            return None
+        return self.roles.get(str(user_id), 'user')
+
+
+role_sync = RoleSync(ROLE_SERVICE_URL, ROLE_SYNC_TIMEOUT)
+
 async def check_admin(user_id: int) -> bool:
     """Проверяет, является ли пользователь администратором"""
+    role = role_sync.role(user_id)
+    if role is not None:
+        return role == 'admin'
+
     try:
-        response = requests.get(
-            f"{ROLE_SERVICE_URL}/check_role",
-            params={"user_id": user_id},
-            timeout=3
+        response = await role_service.get(
+            "/check_role",
+            params={"user_id": user_id}
         )
         return response.status_code == 200 and response.json().get('role') == 'admin'
-    except requests.exceptions.RequestException:
+    except requests.exceptions.RequestException as e:
+        logging.warning(f"Не удалось проверить роль пользователя {user_id}: {e}")
+        return False
+
+# Последний полученный список валют и его ETag для условных запросов
+_currencies_cache = {"etag": None, "currencies": []}
+
+async def fetch_currencies() -> list | None:
+    """Список валют из сервиса данных или None, если сервис ответил ошибкой.
+
+    Запрос отправляется с If-None-Match: пока таблица валют не менялась,
+    сервис отвечает 304 без тела и используется сохраненный список.
+    """
+    headers = {}
+    if _currencies_cache["etag"]:
+        headers["If-None-Match"] = _currencies_cache["etag"]
+
+    response = await data_service.get("/currencies", headers=headers)
+    if response.status_code == 304:
+        return _currencies_cache["currencies"]
+    if response.status_code != 200:
+        return None
+
+    currencies = response.json().get('currencies', [])
+    _currencies_cache.update(etag=response.headers.get('ETag'), currencies=currencies)
+    return currencies
+
+async def currency_exists(currency: str) -> bool | None:
+    """Проверка существования валюты HEAD-запросом к /currencies/<код>.
+
+    None - сервис не смог ответить, проверка не выполнена.
+    """
+    response = await data_service.head(f"/currencies/{quote(currency, safe='')}")
+    if response.status_code == 200:
+        return True
+    if response.status_code == 404:
         return False
+    return None
+
+async def bootstrap(user_id: int) -> dict | None:
+    """Роль пользователя и список валют одним запросом к сервису данных.
+
+    Возвращает {"role", "version", "currencies"} или None, если сервис ответил ошибкой.
+    """
+    response = await data_service.get("/bootstrap", params={"user_id": user_id})
+    if response.status_code != 200:
+        return None
+    return response.json()
 
 # Обработчик /start
 @dp.message(Command("start"))
@@ -98,10 +248,9 @@ async def cmd_set_role(message: types.Message, state: FSMContext):
     role = args[2].lower()
 
     try:
-        response = requests.post(
-            f"{ROLE_SERVICE_URL}/set_role",
-            json={"user_id": user_id, "role": role},
-            timeout=3
+        response = await role_service.post(
+            "/set_role",
+            json={"user_id": user_id, "role": role}
         )
 
         if response.status_code == 200:
@@ -127,13 +276,16 @@ async def add_currency_start(message: types.Message, state: FSMContext):
 async def process_currency_name(message: types.Message, state: FSMContext):
     currency = message.text.upper()
 
-    response = requests.get(f"{DATA_SERVICE_URL}/currencies")
-    if response.status_code == 200:
-        currencies = [c['currency'] for c in response.json().get('currencies', [])]
-        if currency in currencies:
-            await message.answer(f"❌ Валюта {currency} уже существует")
-            await state.clear()
-            return
+    try:
+        exists = await currency_exists(currency)
+    except requests.exceptions.RequestException:
+        await message.answer("❌ Сервис данных недоступен")
+        return
+
+    if exists:
+        await message.answer(f"❌ Валюта {currency} уже существует")
+        await state.clear()
+        return
 
     await state.update_data(currency_name=currency)
     await message.answer(f"Введите курс {currency} к рублю:")
@@ -145,10 +297,9 @@ async def process_currency_rate(message: types.Message, state: FSMContext):
         rate = float(message.text.replace(',', '.'))
         data = await state.get_data()
 
-        response = requests.post(
-            f"{CURRENCY_SERVICE_URL}/load",
-            json={"currency_name": data['currency_name'], "rate": rate},
-            timeout=3
+        response = await currency_service.post(
+            "/load",
+            json={"currency_name": data['currency_name'], "rate": rate}
         )
 
         if response.status_code == 200:
@@ -169,16 +320,22 @@ async def process_currency_rate(message: types.Message, state: FSMContext):
 # Удаление валюты
 @dp.message(lambda message: message.text == "Удалить валюту")
 async def delete_currency_start(message: types.Message, state: FSMContext):
-    if not await check_admin(message.from_user.id):
-        await message.answer("❌ Эта команда доступна только администраторам")
+    # Роль и список валют одним запросом
+    try:
+        data = await bootstrap(message.from_user.id)
+    except requests.exceptions.RequestException:
+        await message.answer("❌ Сервис данных недоступен")
         return
 
-    response = requests.get(f"{DATA_SERVICE_URL}/currencies")
-    if response.status_code != 200:
+    if data is None:
         await message.answer("❌ Не удалось получить список валют")
         return
 
-    currencies = [c['currency'] for c in response.json().get('currencies', [])]
+    if data['role'] != 'admin':
+        await message.answer("❌ Эта команда доступна только администраторам")
+        return
+
+    currencies = [c['currency'] for c in data['currencies']]
     if not currencies:
         await message.answer("ℹ️ Нет доступных валют для удаления")
         return
@@ -194,10 +351,9 @@ async def process_delete_currency(message: types.Message, state: FSMContext):
     currency = message.text.upper()
 
     try:
-        response = requests.post(
-            f"{CURRENCY_SERVICE_URL}/delete",
-            json={"currency_name": currency},
-            timeout=3
+        response = await currency_service.post(
+            "/delete",
+            json={"currency_name": currency}
         )
 
         if response.status_code == 200:
@@ -214,16 +370,22 @@ async def process_delete_currency(message: types.Message, state: FSMContext):
 # Изменение курса
 @dp.message(lambda message: message.text == "Изменить курс")
 async def update_currency_start(message: types.Message, state: FSMContext):
-    if not await check_admin(message.from_user.id):
-        await message.answer("❌ Эта команда доступна только администраторам")
+    # Роль и список валют одним запросом
+    try:
+        data = await bootstrap(message.from_user.id)
+    except requests.exceptions.RequestException:
+        await message.answer("❌ Сервис данных недоступен")
         return
 
-    response = requests.get(f"{DATA_SERVICE_URL}/currencies")
-    if response.status_code != 200:
+    if data is None:
         await message.answer("❌ Не удалось получить список валют")
         return
 
-    currencies = [c['currency'] for c in response.json().get('currencies', [])]
+    if data['role'] != 'admin':
+        await message.answer("❌ Эта команда доступна только администраторам")
+        return
+
+    currencies = [c['currency'] for c in data['currencies']]
     if not currencies:
         await message.answer("ℹ️ Нет доступных валют для изменения")
         return
@@ -237,6 +399,18 @@ async def update_currency_start(message: types.Message, state: FSMContext):
 @dp.message(CurrencyStates.waiting_for_currency_to_update)
 async def process_currency_to_update(message: types.Message, state: FSMContext):
     currency = message.text.upper()
+
+    try:
+        exists = await currency_exists(currency)
+    except requests.exceptions.RequestException:
+        await message.answer("❌ Сервис данных недоступен")
+        return
+
+    if exists is False:
+        await message.answer(f"❌ Валюта {currency} не найдена")
+        await state.clear()
+        return
+
     await state.update_data(currency_name=currency)
     await message.answer(f"Введите новый курс для {currency}:")
     await state.set_state(CurrencyStates.waiting_for_new_rate)
@@ -247,10 +421,9 @@ async def process_new_rate(message: types.Message, state: FSMContext):
         new_rate = float(message.text.replace(',', '.'))
         data = await state.get_data()
 
-        response = requests.post(
-            f"{CURRENCY_SERVICE_URL}/update_currency",
-            json={"currency_name": data['currency_name'], "rate": new_rate},
-            timeout=3
+        response = await currency_service.post(
+            "/update_currency",
+            json={"currency_name": data['currency_name'], "rate": new_rate}
         )
 
         if response.status_code == 200:
@@ -272,10 +445,9 @@ async def process_new_rate(message: types.Message, state: FSMContext):
 @dp.message(Command("get_currencies"))
 async def cmd_get_currencies(message: types.Message):
     try:
-        response = requests.get(f"{DATA_SERVICE_URL}/currencies", timeout=3)
+        currencies = await fetch_currencies()
 
-        if response.status_code == 200:
-            currencies = response.json().get('currencies', [])
+        if currencies is not None:
             if currencies:
                 text = "📊 Текущие курсы валют:\n" + "\n".join(
                     [f"{c['currency']}: {c['rate']} RUB" for c in currencies]
@@ -293,18 +465,24 @@ async def cmd_get_currencies(message: types.Message):
 @dp.message(Command("convert"))
 async def cmd_convert(message: types.Message, state: FSMContext):
     try:
-        response = requests.get(f"{DATA_SERVICE_URL}/currencies", timeout=3)
-        if response.status_code != 200:
+        # Роль для конвертации не нужна: список валют берется по ETag без обращения
+        # к role_manager, и /convert работает, даже если сервис ролей недоступен
+        currencies = await fetch_currencies()
+        if currencies is None:
             await message.answer("❌ Не удалось получить список валют")
             return
 
-        currencies = [c['currency'] for c in response.json().get('currencies', [])]
+        currencies = [c['currency'] for c in currencies]
         if not currencies:
             await message.answer("ℹ️ Нет доступных валют для конвертации")
             return
 
+        # Список сохраняется, чтобы проверить ввод пользователя без запроса к сервису
+        await state.update_data(currencies=currencies)
+
         await message.answer(
-            f"Введите название валюты ({', '.join(currencies)}):",
+            f"Введите название валюты ({', '.join(currencies)}).\n"
+            "Для конвертации не в рубли укажите две валюты, например: USD EUR",
             reply_markup=types.ReplyKeyboardRemove()
         )
         await state.set_state(ConvertStates.waiting_for_currency_to_convert)
@@ -313,8 +491,21 @@ async def cmd_convert(message: types.Message, state: FSMContext):
 
 @dp.message(ConvertStates.waiting_for_currency_to_convert)
 async def process_currency_to_convert(message: types.Message, state: FSMContext):
-    currency = message.text.upper()
-    await state.update_data(currency=currency)
+    # "USD" - конвертация в рубли, "USD EUR" - из одной валюты в другую
+    codes = message.text.upper().split()
+    currency = codes[0] if codes else message.text.upper()
+    target = codes[1] if len(codes) > 1 else "RUB"
+
+    available = (await state.get_data()).get('currencies', [])
+    unknown = [code for code in (currency, target) if code != "RUB" and code not in available]
+    if available and unknown:
+        await message.answer(
+            f"❌ Валюта {', '.join(unknown)} не найдена. Доступные: {', '.join(available)}\n"
+            "Попробуйте ещё раз:"
+        )
+        return
+
+    await state.update_data(currency=currency, target=target)
     await message.answer("Введите сумму для конвертации:")
     await state.set_state(ConvertStates.waiting_for_amount_to_convert)
 
@@ -324,18 +515,24 @@ async def process_amount_to_convert(message: types.Message, state: FSMContext):
         amount = float(message.text.replace(',', '.'))
         data = await state.get_data()
 
-        response = requests.get(
-            f"{DATA_SERVICE_URL}/convert",
-            params={"currency": data['currency'], "amount": amount},
-            timeout=3
+        response = await data_service.get(
+            "/convert",
+            params={"currency": data['currency'], "to": data['target'], "amount": amount}
         )
 
         if response.status_code == 200:
             result = response.json()
             await message.answer(
                 f"🔢 Результат конвертации:\n"
-                f"{amount} {data['currency']} = {result['converted_amount']:.2f} RUB\n"
-                f"Курс: 1 {data['currency']} = {result['rate']} RUB"
+                f"{amount} {data['currency']} = {result['converted_amount']:.2f} {data['target']}\n"
+                f"Курс: 1 {data['currency']} = {result['rate']} {data['target']}"
+            )
+        elif response.status_code == 404:
+            # Сервис проверяет валюту и сразу присылает список доступных
+            available = response.json().get('currencies', [])
+            await message.answer(
+                f"❌ Валюта не найдена. Доступные: {', '.join(available)}\n"
+                "Выберите валюту заново: /convert"
             )
         else:
             error = response.json().get('error', 'Неизвестная ошибка')
@@ -358,6 +555,8 @@ async def cancel_action(message: types.Message, state: FSMContext):
 
 # Запуск бота
 async def main():
+    if ROLE_SYNC:
+        role_sync.start()
     await dp.start_polling(bot)
 
 if __name__ == '__main__':
@@ -1,10 +1,24 @@
 from flask import Flask, request, jsonify
 import psycopg2
+import psycopg2.extras
 from psycopg2 import sql
+import math
 import os
+import sys
+
+# Общие модули лежат в каталоге common в корне репозитория
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common.db_routing import commit_lsn, init_lsn_headers
+from tracing import init_flask, traced_connect
 
 app = Flask(__name__)
 
+# Интервалы запросов от бота в журнал трассировки (TRACE_LOG)
+init_flask(app, 'currency-manager')
+# LSN записи в ответе (X-DB-LSN): по нему бот читает свои изменения через data_manager
+init_lsn_headers(app)
+
 # Настройки подключения к PostgreSQL из переменных окружения
 DB_CONFIG = {
     "host": os.getenv('DB_HOST'),
@@ -14,7 +28,22 @@ DB_CONFIG = {
 }
 
 def get_db_connection():
-    return psycopg2.connect(**DB_CONFIG)
+    return traced_connect(DB_CONFIG)
+
+# Ограничения столбцов currencies: currency_name VARCHAR(10), rate NUMERIC(10, 2)
+MAX_CURRENCY_NAME_LENGTH = 10
+MAX_RATE = 99999999.99
+
+def validate_currency(currency_name, rate):
+    """Проверяет валюту из запроса: название помещается в столбец, курс - конечное
+    положительное число, которое NUMERIC(10, 2) хранит без переполнения и не округляет до нуля"""
+    if not isinstance(currency_name, str) or not currency_name.strip() \
+            or len(currency_name) > MAX_CURRENCY_NAME_LENGTH:
+        raise ValueError(f"некорректное название валюты: {currency_name!r}")
+    if isinstance(rate, bool) or not isinstance(rate, (int, float)) \
+            or (isinstance(rate, float) and not math.isfinite(rate)) \
+            or not 0 < rate <= MAX_RATE or round(rate, 2) <= 0:
+        raise ValueError(f"некорректный курс {currency_name}: {rate!r}")
 
 @app.route('/load', methods=['POST'])
 def load_currency():
@@ -40,6 +69,7 @@ def load_currency():
             (currency_name, rate)
         )
         conn.commit()
+        commit_lsn(conn)
         return jsonify({"message": f"Валюта {currency_name} успешно добавлена"}), 200
 
     except Exception as e:
@@ -72,6 +102,7 @@ def update_currency():
             (new_rate, currency_name)
         )
         conn.commit()
+        commit_lsn(conn)
         return jsonify({"message": f"Курс валюты {currency_name} обновлен"}), 200
 
     except Exception as e:
@@ -100,6 +131,7 @@ def delete_currency():
         # Удаление валюты
         cursor.execute("DELETE FROM currencies WHERE currency_name = %s", (currency_name,))
         conn.commit()
+        commit_lsn(conn)
         return jsonify({"message": f"Валюта {currency_name} удалена"}), 200
 
     except Exception as e:
@@ -108,5 +140,74 @@ def delete_currency():
         if conn:
             conn.close()
 
+@app.route('/currencies/bulk', methods=['POST'])
+def bulk_upsert_currencies():
+    """
+    Массовая загрузка курсов одним запросом
+
+    Тело: {"currencies": [{"currency_name": "USD", "rate": 79.6}, ...]}
+    Все пары применяются в одной транзакции одним INSERT ... ON CONFLICT.
+    Возвращает списки добавленных, обновленных и неизменившихся валют.
+    """
+    data = request.json or {}
+    items = data.get('currencies')
+
+    if not isinstance(items, list) or not items:
+        return jsonify({"error": "Не передан список валют"}), 400
+
+    # При повторе валюты в запросе действует последнее значение
+    rates = {}
+    for item in items:
+        if not isinstance(item, dict):
+            return jsonify({"error": "Неверный формат элемента списка"}), 400
+
+        currency_name = item.get('currency_name')
+        rate = item.get('rate')
+        try:
+            validate_currency(currency_name, rate)
+        except ValueError as e:
+            return jsonify({"error": f"Неверные данные валюты: {e}"}), 400
+
+        rates[currency_name] = rate
+
+    conn = None
+    try:
+        conn = get_db_connection()
+        with conn.cursor() as cursor:
+            # Строка попадает в RETURNING, только если была добавлена (xmax = 0)
+            # или ее курс действительно изменился
+            changed = psycopg2.extras.execute_values(
+                cursor,
+                '''
+                INSERT INTO currencies (currency_name, rate) VALUES %s
+                ON CONFLICT (currency_name) DO UPDATE SET rate = EXCLUDED.rate
+                WHERE currencies.rate IS DISTINCT FROM EXCLUDED.rate
+                RETURNING currency_name, (xmax = 0) AS inserted
+                ''',
+                list(rates.items()),
+                page_size=len(rates),
+                fetch=True
+            )
+        conn.commit()
+        commit_lsn(conn)
+
+        inserted = sorted(name for name, is_new in changed if is_new)
+        updated = sorted(name for name, is_new in changed if not is_new)
+        unchanged = sorted(set(rates) - set(inserted) - set(updated))
+
+        return jsonify({
+            "inserted": inserted,
+            "updated": updated,
+            "unchanged": unchanged
+        }), 200
+
+    except Exception as e:
+        if conn:
+            conn.rollback()
+        return jsonify({"error": str(e)}), 500
+    finally:
+        if conn:
+            conn.close()
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5001)
\ No newline at end of file
@@ -1,10 +1,31 @@
-from flask import Flask, request, jsonify
-import psycopg2
+from bisect import bisect_right
+from datetime import datetime
+from flask import Flask, Response, request, jsonify
+import gzip
+import json
+import math
+import numpy as np
+import requests
 from psycopg2 import sql
 import os
+import sys
+import threading
+import time
+import zlib
+
+# Общие модули лежат в каталоге common в корне репозитория
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common.db_routing import LSN_HEADER, ReplicaRouter, connection_lsn, init_lsn_headers, lsn_value, required_lsn
+from tracing import TracingSession, init_flask, span, traced_connect
 
 app = Flask(__name__)
 
+# Интервалы запросов от бота в журнал трассировки (TRACE_LOG)
+init_flask(app, 'data_manager')
+# Минимальный LSN реплики из запроса (X-DB-LSN): бот видит валюты, только что измененные через currency-manager
+init_lsn_headers(app)
+
 # Настройки подключения к PostgreSQL
 DB_CONFIG = {
     "host": os.getenv('DB_HOST'),
@@ -15,14 +36,300 @@ DB_CONFIG = {
 }
 
 
+# Базовая валюта, к которой заданы курсы в таблице currencies
+BASE_CURRENCY = "RUB"
+
+# Как часто (в секундах) сверять версию таблицы currencies с БД
+CURRENCY_VERSION_TTL = float(os.getenv('CURRENCY_VERSION_TTL', '1'))
+
+# Поля элемента списка /currencies, доступные для выборки через fields
+CURRENCY_FIELDS = ("currency", "rate", "to_currency")
+
+# Ответы /currencies не меньше этого размера (в байтах) сжимаются gzip
+GZIP_MIN_SIZE = int(os.getenv('GZIP_MIN_SIZE', '1024'))
+
+MAX_PAGE_SIZE = 1000
+
+# Сколько разных вариантов ответа /currencies хранить для одной версии таблицы
+MAX_CACHED_RESPONSES = 256
+
+# Роли принадлежат role_manager: /bootstrap узнает роль через его API, а не из его таблицы
+ROLE_SERVICE_URL = os.getenv('ROLE_SERVICE_URL', "http://localhost:5003")
+ROLE_SERVICE_TIMEOUT = float(os.getenv('ROLE_SERVICE_TIMEOUT', '1'))
+
+
 def get_db_connection():
-    return psycopg2.connect(**DB_CONFIG)
+    return traced_connect(DB_CONFIG)
+
+
+# Чтение валют с реплик (DB_REPLICAS); сам сервис в БД не пишет
+db_router = ReplicaRouter(DB_CONFIG, traced_connect)
+
+
+def init_db():
+    """Создает счетчик версии таблицы currencies и триггер, увеличивающий его при каждом изменении"""
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cursor:
+            # Таблица валют нужна триггерам ниже; сервис может запуститься раньше бота, который ее создает
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS currencies (
+                    id SERIAL PRIMARY KEY,
+                    currency_name VARCHAR(10) UNIQUE NOT NULL,
+                    rate NUMERIC(10, 2) NOT NULL
+                )
+            ''')
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS table_versions (
+                    table_name VARCHAR(64) PRIMARY KEY,
+                    version BIGINT NOT NULL DEFAULT 0
+                )
+            ''')
+            cursor.execute(
+                "INSERT INTO table_versions (table_name) VALUES ('currencies') ON CONFLICT DO NOTHING"
+            )
+            cursor.execute('''
+                CREATE OR REPLACE FUNCTION bump_currencies_version() RETURNS trigger AS $$
+                BEGIN
+                    UPDATE table_versions SET version = version + 1 WHERE table_name = 'currencies';
+                    RETURN NULL;
+                END;
+                $$ LANGUAGE plpgsql
+            ''')
+            cursor.execute("DROP TRIGGER IF EXISTS currencies_version_trigger ON currencies")
+            cursor.execute('''
+                CREATE TRIGGER currencies_version_trigger
+                AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON currencies
+                FOR EACH STATEMENT EXECUTE FUNCTION bump_currencies_version()
+            ''')
+
+            # История курсов: одна строка на изменение (не чаще раза в день на валюту),
+            # удаление валюты отмечается строкой с rate = NULL
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS currency_rate_history (
+                    currency_name VARCHAR(10) NOT NULL,
+                    valid_from DATE NOT NULL,
+                    rate NUMERIC,
+                    PRIMARY KEY (currency_name, valid_from)
+                )
+            ''')
+            cursor.execute('''
+                CREATE OR REPLACE FUNCTION record_currency_rate() RETURNS trigger AS $$
+                BEGIN
+                    IF TG_OP = 'DELETE' THEN
+                        INSERT INTO currency_rate_history (currency_name, valid_from, rate)
+                        VALUES (OLD.currency_name, CURRENT_DATE, NULL)
+                        ON CONFLICT (currency_name, valid_from) DO UPDATE SET rate = NULL;
+                        RETURN NULL;
+                    END IF;
+                    IF TG_OP = 'UPDATE' AND OLD.rate IS NOT DISTINCT FROM NEW.rate THEN
+                        RETURN NULL;
+                    END IF;
+                    INSERT INTO currency_rate_history (currency_name, valid_from, rate)
+                    VALUES (NEW.currency_name, CURRENT_DATE, NEW.rate)
+                    ON CONFLICT (currency_name, valid_from) DO UPDATE SET rate = EXCLUDED.rate;
+                    RETURN NULL;
+                END;
+                $$ LANGUAGE plpgsql
+            ''')
+            cursor.execute("DROP TRIGGER IF EXISTS currencies_history_trigger ON currencies")
+            cursor.execute('''
+                CREATE TRIGGER currencies_history_trigger
+                AFTER INSERT OR UPDATE OR DELETE ON currencies
+                FOR EACH ROW EXECUTE FUNCTION record_currency_rate()
+            ''')
+
+            # Валюты, добавленные до появления истории, получают начальную запись
+            cursor.execute('''
+                INSERT INTO currency_rate_history (currency_name, valid_from, rate)
+                SELECT c.currency_name, CURRENT_DATE, c.rate FROM currencies c
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM currency_rate_history h WHERE h.currency_name = c.currency_name
+                )
+            ''')
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def valid_rate(rate):
+    """Курс как float или None, если он не число или не положительный"""
+    try:
+        value = float(rate)
+    except (TypeError, ValueError):
+        return None
+    return value if math.isfinite(value) and value > 0 else None
+
+
+class CurrencyTable:
+    """Снимок таблицы currencies вместе с матрицей кросс-курсов и историей курсов"""
+
+    def __init__(self, version, rows, history_rows):
+        self.version = version
+        # Валюта с нулевым, отрицательным или нечисловым курсом дала бы inf и nan
+        # в матрице кросс-курсов, поэтому в снимок она не попадает
+        invalid = [row for row in rows if valid_rate(row[1]) is None]
+        if invalid:
+            app.logger.warning("Валюты с неверным курсом пропущены: %s",
+                               ", ".join(f"{name}={rate}" for name, rate in invalid))
+            rows = [row for row in rows if valid_rate(row[1]) is not None]
+        # Порядок задается в Python, чтобы курсор пагинации сравнивался так же, как сортируется список
+        rows = sorted(rows)
+        # Валюты из таблицы (в порядке currency_name) и их курсы к рублю как в БД
+        self.names = [row[0] for row in rows]
+        self.rates = [row[1] for row in rows]
+
+        # Базовая валюта добавляется в конец, чтобы конвертировать и в рубли, и из рублей
+        codes = self.names + ([BASE_CURRENCY] if BASE_CURRENCY not in self.names else [])
+        self.index = {code: i for i, code in enumerate(codes)}
+        to_base = np.array([float(rate) for rate in self.rates] + [1.0] * (len(codes) - len(self.names)))
+
+        # cross[i, j] - сколько единиц валюты j стоит одна единица валюты i
+        self.cross = to_base[:, np.newaxis] / to_base[np.newaxis, :]
+
+        # Элементы списка валют в формате ответа /currencies
+        self.items = [
+            {"currency": name, "rate": str(rate), "to_currency": BASE_CURRENCY}
+            for name, rate in zip(self.names, self.rates)
+        ]
+
+        # Сериализованные варианты ответа /currencies для этой версии таблицы
+        self.responses = {}
+
+        # Индекс истории: по каждой валюте отсортированные даты изменений и курсы
+        self.history = {}
+        for currency_name, valid_from, rate in history_rows:
+            dates, rates = self.history.setdefault(currency_name, ([], []))
+            dates.append(valid_from)
+            # NULL - валюта удалена; неверный курс так же считается недоступным
+            rates.append(valid_rate(rate))
+
+    def rate(self, from_currency, to_currency):
+        """Кросс-курс или None, если какой-то из валют нет в таблице"""
+        i = self.index.get(from_currency)
+        j = self.index.get(to_currency)
+        if i is None or j is None:
+            return None
+        return float(self.cross[i, j])
+
+    def render_list(self, fields, after, limit, compress):
+        """Тело ответа /currencies (JSON, при compress - сжатое gzip) и признак сжатия.
+
+        Результат кэшируется в снимке, поэтому при неизменной таблице
+        повторные запросы не сериализуют список заново.
+        """
+        key = (fields, after, limit, compress)
+        cached = self.responses.get(key)
+        if cached is not None:
+            return cached
+
+        start = bisect_right(self.names, after) if after else 0
+        end = len(self.names) if limit is None else min(start + limit, len(self.names))
+        items = self.items[start:end]
+        if fields != CURRENCY_FIELDS:
+            items = [{field: item[field] for field in fields} for item in items]
+
+        payload = {"currencies": items, "version": self.version}
+        if limit is not None:
+            payload["next_cursor"] = self.names[end - 1] if end < len(self.names) else None
+
+        with span('serialize', 'currencies'):
+            body = json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+            compressed = compress and len(body) >= GZIP_MIN_SIZE
+            if compressed:
+                body = gzip.compress(body)
+
+        if len(self.responses) < MAX_CACHED_RESPONSES:
+            self.responses[key] = (body, compressed)
+        return body, compressed
+
+    def rate_to_base_as_of(self, currency, day):
+        """Курс валюты к рублю, действовавший на дату day (двоичный поиск по истории).
+
+        Для дат раньше первой записи курс неизвестен (None), как и в rgz: курс
+        не подставляется. Прошлые курсы добавляются строками в currency_rate_history.
+        """
+        if currency == BASE_CURRENCY:
+            return 1.0
+        if currency not in self.history:
+            return None
+        dates, rates = self.history[currency]
+        position = bisect_right(dates, day) - 1
+        if position < 0:
+            return None
+        return rates[position]
+
+    def rate_as_of(self, from_currency, to_currency, day):
+        """Кросс-курс на дату day или None, если валюта на эту дату не существовала"""
+        from_rate = self.rate_to_base_as_of(from_currency, day)
+        to_rate = self.rate_to_base_as_of(to_currency, day)
+        if from_rate is None or to_rate is None:
+            return None
+        return from_rate / to_rate
+
+
+_currency_table = None
+_currency_table_checked_at = 0.0
+# LSN, до которого БД была видна при последней сверке версии
+_currency_table_lsn = 0
+_currency_table_lock = threading.Lock()
+
+
+def _currency_table_fresh() -> bool:
+    if _currency_table is None or time.monotonic() - _currency_table_checked_at >= CURRENCY_VERSION_TTL:
+        return False
+    required = required_lsn.get()
+    return required is None or lsn_value(required) <= _currency_table_lsn
+
+
+def get_currency_table():
+    """Возвращает актуальный снимок таблицы currencies.
+
+    Версия таблицы сверяется с БД не чаще раза в CURRENCY_VERSION_TTL секунд
+    или сразу, если запрос требует записи (X-DB-LSN) новее последней сверки;
+    сама таблица и матрица кросс-курсов перестраиваются только при смене версии.
+    """
+    global _currency_table, _currency_table_checked_at, _currency_table_lsn
+
+    if _currency_table_fresh():
+        return _currency_table
+
+    with _currency_table_lock:
+        if _currency_table_fresh():
+            return _currency_table
+
+        conn = db_router.read_connection()
+        try:
+            checked_lsn = connection_lsn(conn)
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT version FROM table_versions WHERE table_name = 'currencies'")
+                version = cursor.fetchone()[0]
+
+                # Реплики отстают по-разному: снимок со старой версией не заменяет более новый
+                if _currency_table is None or version > _currency_table.version:
+                    cursor.execute(
+                        "SELECT currency_name, rate FROM currencies ORDER BY currency_name"
+                    )
+                    rows = cursor.fetchall()
+                    cursor.execute(
+                        "SELECT currency_name, valid_from, rate FROM currency_rate_history "
+                        "ORDER BY currency_name, valid_from"
+                    )
+                    _currency_table = CurrencyTable(version, rows, cursor.fetchall())
+        finally:
+            conn.close()
+
+        _currency_table_checked_at = time.monotonic()
+        _currency_table_lsn = checked_lsn
+        return _currency_table
 
 
 @app.route('/convert', methods=['GET'])
 def convert_currency():
     currency_name = request.args.get('currency')
+    target_currency = request.args.get('to', BASE_CURRENCY)
     amount = request.args.get('amount')
+    as_of = request.args.get('as_of')
 
     if not currency_name or not amount:
         return jsonify({"error": "Не указаны валюта или сумма"}), 400
@@ -32,60 +339,169 @@ def convert_currency():
     except ValueError:
         return jsonify({"error": "Сумма должна быть числом"}), 400
 
+    if as_of:
+        try:
+            as_of = datetime.strptime(as_of, "%Y-%m-%d").date()
+        except ValueError:
+            return jsonify({"error": "Дата as_of должна быть в формате ГГГГ-ММ-ДД"}), 400
+
     try:
-        conn = get_db_connection()
-        with conn.cursor() as cursor:
-            cursor.execute(
-                "SELECT rate FROM currencies WHERE currency_name = %s",
-                (currency_name,)
-            )
-            result = cursor.fetchone()
+        table = get_currency_table()
+        if as_of:
+            rate = table.rate_as_of(currency_name, target_currency, as_of)
+        else:
+            rate = table.rate(currency_name, target_currency)
 
-            if not result:
-                return jsonify({"error": "Валюта не найдена"}), 404
+        if rate is None:
+            if as_of and table.rate(currency_name, target_currency) is not None:
+                return jsonify({"error": "Нет курса валюты на эту дату"}), 404
+            # Список доступных валют позволяет клиенту сразу переспросить пользователя
+            return jsonify({"error": "Валюта не найдена", "currencies": table.names}), 404
 
-            # Преобразуем Decimal к float
-            rate = float(result[0])
-            converted_amount = amount * rate
+        converted_amount = amount * rate
 
-            return jsonify({
-                "original_amount": amount,
-                "currency": currency_name,
-                "rate": rate,
-                "converted_amount": round(converted_amount, 2),
-                "target_currency": "RUB"
-            }), 200
+        return jsonify({
+            "original_amount": amount,
+            "currency": currency_name,
+            "rate": rate,
+            "converted_amount": round(converted_amount, 2),
+            "target_currency": target_currency,
+            "as_of": as_of.isoformat() if as_of else None
+        }), 200
 
     except Exception as e:
         return jsonify({"error": str(e)}), 500
-    finally:
-        if 'conn' in locals():
-            conn.close()
 
 
 @app.route('/currencies', methods=['GET'])
 def get_all_currencies():
+    """
+    Список валют
+
+    Параметры (необязательные):
+    - fields: поля элементов через запятую (currency, rate, to_currency)
+    - after: курсор - код последней валюты предыдущей страницы
+    - limit: размер страницы; в ответе появляется next_cursor
+
+    Ответ содержит ETag, зависящий от версии таблицы; при совпадении
+    If-None-Match возвращается 304 без тела.
+    """
+    fields = CURRENCY_FIELDS
+    if request.args.get('fields'):
+        fields = tuple(field.strip() for field in request.args['fields'].split(','))
+        if not fields or any(field not in CURRENCY_FIELDS for field in fields):
+            return jsonify({"error": f"Допустимые поля: {', '.join(CURRENCY_FIELDS)}"}), 400
+
+    after = request.args.get('after') or None
+    limit = request.args.get('limit')
+    if limit is not None:
+        try:
+            limit = int(limit)
+        except ValueError:
+            return jsonify({"error": "limit должен быть числом"}), 400
+        if not 1 <= limit <= MAX_PAGE_SIZE:
+            return jsonify({"error": f"limit должен быть от 1 до {MAX_PAGE_SIZE}"}), 400
+
+    compress = request.accept_encodings['gzip'] > 0
+
     try:
-        conn = get_db_connection()
-        with conn.cursor() as cursor:
-            cursor.execute(
-                "SELECT currency_name, rate FROM currencies ORDER BY currency_name"
-            )
-            currencies = cursor.fetchall()
+        table = get_currency_table()
+        variant = f"{fields}|{after}|{limit}"
+        etag = f"{table.version}-{zlib.crc32(variant.encode('utf-8')):08x}"
 
-            result = [
-                {"currency": curr[0], "rate": curr[1], "to_currency": "RUB"}
-                for curr in currencies
-            ]
+        # Слабый ETag: сжатый и несжатый ответы семантически одинаковы
+        if request.if_none_match.contains_weak(etag):
+            response = Response(status=304)
+            response.set_etag(etag, weak=True)
+            return response
 
-            return jsonify({"currencies": result}), 200
+        body, compressed = table.render_list(fields, after, limit, compress)
+
+        response = Response(body, mimetype='application/json')
+        response.set_etag(etag, weak=True)
+        response.vary.add('Accept-Encoding')
+        if compressed:
+            response.headers['Content-Encoding'] = 'gzip'
+        return response
 
     except Exception as e:
         return jsonify({"error": str(e)}), 500
-    finally:
-        if 'conn' in locals():
-            conn.close()
+
+
+@app.route('/currencies/<currency_name>', methods=['GET'])
+def get_currency(currency_name):
+    """
+    Одна валюта из снимка таблицы (поиск по индексу, без запроса к списку)
+
+    HEAD на тот же адрес отвечает только статусом 200/404 - для проверки существования.
+    Возвращает {"currency", "rate", "to_currency", "version"} или 404.
+    """
+    try:
+        table = get_currency_table()
+        position = table.index.get(currency_name.upper())
+
+        if position is None or position >= len(table.names):
+            return jsonify({"error": "Валюта не найдена", "version": table.version}), 404
+
+        response = jsonify({**table.items[position], "version": table.version})
+        response.set_etag(str(table.version), weak=True)
+        return response
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+# Сессии к role_manager по одной на поток: requests.Session не рассчитана на работу из нескольких потоков
+_role_sessions = threading.local()
+
+
+def fetch_role(user_id) -> str:
+    """Роль пользователя из role_manager; LSN из запроса бота передается дальше"""
+    session = getattr(_role_sessions, 'session', None)
+    if session is None:
+        session = _role_sessions.session = TracingSession()
+    lsn = required_lsn.get()
+    response = session.get(
+        f"{ROLE_SERVICE_URL}/check_role",
+        params={"user_id": user_id},
+        headers={LSN_HEADER: lsn} if lsn else None,
+        timeout=ROLE_SERVICE_TIMEOUT
+    )
+    response.raise_for_status()
+    return response.json()['role']
+
+
+@app.route('/bootstrap', methods=['GET'])
+def bootstrap():
+    """
+    Данные для начала сценария бота одним запросом
+
+    Параметры:
+    - user_id: пользователь Telegram
+
+    Возвращает {"role": роль, "version": версия таблицы валют, "currencies": [...]}
+    """
+    user_id = request.args.get('user_id')
+
+    if not user_id:
+        return jsonify({"error": "Не указан user_id"}), 400
+
+    try:
+        table = get_currency_table()
+        role = fetch_role(user_id)
+
+        return jsonify({
+            "role": role,
+            "version": table.version,
+            "currencies": table.items
+        }), 200
+
+    except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+        return jsonify({"error": f"Сервис ролей недоступен: {e}"}), 502
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
 
 
 if __name__ == '__main__':
+    init_db()
     app.run(host='0.0.0.0', port=5002)
\ No newline at end of file
@@ -0,0 +1,238 @@
+"""
+Устойчивые вызовы сервисов lab-6: circuit breaker, бюджет повторов и hedged-запросы
+
+Методы клиента - корутины: запрос вместе с повторами и ожиданием hedged-запросов
+выполняется в отдельном пуле потоков и не блокирует цикл событий бота.
+
+Настройки (переменные окружения):
+- SERVICE_TIMEOUT: таймаут одной попытки запроса, секунды (1.0); с повтором
+  обработчик ждет ответа не дольше двух таймаутов
+- SERVICE_CLIENT_THREADS: сколько запросов к сервисам выполняется одновременно (32)
+- BREAKER_FAILURES: сколько ошибок или медленных ответов подряд открывают breaker (5)
+- BREAKER_SLOW_CALL: ответ дольше стольких секунд считается медленным (0.5)
+- BREAKER_RESET_TIMEOUT: через сколько секунд открытый breaker пропускает пробный запрос (10)
+- RETRY_BUDGET_RATIO: доля повторов от числа обычных запросов (0.1)
+- HEDGE_REQUESTS: дублировать медленные GET-запросы (false)
+- HEDGE_MIN_DELAY: минимальная задержка перед дублирующим запросом, секунды (0.05)
+"""
+import asyncio
+import contextvars
+import functools
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import requests
+
+SERVICE_TIMEOUT = float(os.getenv('SERVICE_TIMEOUT', '1.0'))
+SERVICE_CLIENT_THREADS = int(os.getenv('SERVICE_CLIENT_THREADS', '32'))
+BREAKER_FAILURES = int(os.getenv('BREAKER_FAILURES', '5'))
+BREAKER_SLOW_CALL = float(os.getenv('BREAKER_SLOW_CALL', '0.5'))
+BREAKER_RESET_TIMEOUT = float(os.getenv('BREAKER_RESET_TIMEOUT', '10'))
+RETRY_BUDGET_RATIO = float(os.getenv('RETRY_BUDGET_RATIO', '0.1'))
+HEDGE_REQUESTS = os.getenv('HEDGE_REQUESTS', 'false').lower() == 'true'
+HEDGE_MIN_DELAY = float(os.getenv('HEDGE_MIN_DELAY', '0.05'))
+
+# Сколько последних задержек хранить для расчета p95
+LATENCY_WINDOW = 200
+# Минимум замеров, после которого задержка hedged-запроса считается по p95
+HEDGE_MIN_SAMPLES = 20
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """Сервис временно считается недоступным, запрос не отправлялся"""
+
+
+class CircuitBreaker:
+    """Предохранитель: после серии ошибок запросы к сервису сразу отклоняются"""
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, name: str, failure_threshold: int = BREAKER_FAILURES,
+                 reset_timeout: float = BREAKER_RESET_TIMEOUT):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """Можно ли отправить запрос; в полуоткрытом состоянии пропускается один пробный"""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self._probe_in_flight = False
+            if self.state == self.HALF_OPEN and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self.state != self.CLOSED:
+                logger.info("Сервис %s снова доступен", self.name)
+            self.state = self.CLOSED
+            self.failures = 0
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    logger.warning("Сервис %s помечен недоступным после %d ошибок", self.name, self.failures)
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+                self._probe_in_flight = False
+
+
+class RetryBudget:
+    """Бюджет повторов: каждый запрос пополняет его на ratio, каждый повтор тратит единицу"""
+
+    def __init__(self, ratio: float = RETRY_BUDGET_RATIO, max_tokens: float = 10.0):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        with self._lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class ServiceClient:
+    """
+    Клиент одного сервиса
+
+    Все запросы проходят через circuit breaker. Идемпотентные GET и HEAD при сетевой
+    ошибке или ответе 5xx повторяются, пока позволяет бюджет повторов, а при
+    HEDGE_REQUESTS дублируются, если ответа нет дольше p95 задержки сервиса.
+    """
+
+    # Пулы потоков общие для всех клиентов: для запросов из обработчиков и для hedged-запросов
+    _io_executor = ThreadPoolExecutor(max_workers=SERVICE_CLIENT_THREADS, thread_name_prefix='service')
+    _executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='hedge')
+
+    def __init__(self, name: str, base_url: str, session_factory=requests.Session,
+                 timeout: float = SERVICE_TIMEOUT, hedge: bool = HEDGE_REQUESTS):
+        self.name = name
+        self.base_url = base_url
+        self.timeout = timeout
+        self.hedge = hedge
+        self.breaker = CircuitBreaker(name)
+        self.retry_budget = RetryBudget()
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self._session_factory = session_factory
+        # requests.Session не рассчитана на параллельное использование, поэтому у каждого потока своя
+        self._local = threading.local()
+
+    def _session(self) -> requests.Session:
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = self._session_factory()
+        return session
+
+    def p95(self) -> float | None:
+        if len(self.latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        values = sorted(self.latencies)
+        return values[int(0.95 * (len(values) - 1))]
+
+    def _send(self, method: str, path: str, **kwargs) -> requests.Response:
+        """Один запрос с учетом в breaker; ответ 5xx и медленный ответ считаются ошибками"""
+        if not self.breaker.allow():
+            raise CircuitOpenError(f"Сервис {self.name} временно недоступен")
+
+        kwargs.setdefault('timeout', self.timeout)
+        start = time.monotonic()
+        try:
+            response = self._session().request(method, f"{self.base_url}{path}", **kwargs)
+        except requests.exceptions.RequestException:
+            self.breaker.record_failure()
+            raise
+
+        elapsed = time.monotonic() - start
+        self.latencies.append(elapsed)
+        if response.status_code >= 500 or elapsed >= BREAKER_SLOW_CALL:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+        return response
+
+    def _hedged_send(self, method: str, path: str, **kwargs) -> requests.Response:
+        delay = self.p95() if self.hedge else None
+        if delay is None:
+            return self._send(method, path, **kwargs)
+
+        # Контекст копируется, чтобы запросы из пула учитывались в метриках текущего апдейта
+        context = contextvars.copy_context()
+        futures = [self._executor.submit(context.copy().run, self._send, method, path, **kwargs)]
+        done, _ = wait(futures, timeout=max(delay, HEDGE_MIN_DELAY))
+        if not done and self.retry_budget.withdraw():
+            futures.append(self._executor.submit(context.copy().run, self._send, method, path, **kwargs))
+
+        # Возвращается первый успешный ответ; ошибка - только если не удались все попытки
+        pending = set(futures)
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    return future.result()
+                except requests.exceptions.RequestException as e:
+                    error = e
+        raise error
+
+    def _idempotent(self, method: str, path: str, **kwargs) -> requests.Response:
+        self.retry_budget.deposit()
+        try:
+            response = self._hedged_send(method, path, **kwargs)
+            if response.status_code < 500 or not self.retry_budget.withdraw():
+                return response
+        except CircuitOpenError:
+            raise
+        except requests.exceptions.RequestException:
+            if not self.retry_budget.withdraw():
+                raise
+        logger.info("Повтор %s %s%s", method, self.name, path)
+        return self._send(method, path, **kwargs)
+
+    def _post(self, path: str, **kwargs) -> requests.Response:
+        # POST не повторяется и не дублируется: запрос может быть неидемпотентным
+        self.retry_budget.deposit()
+        return self._send('POST', path, **kwargs)
+
+    async def _in_thread(self, function, *args, **kwargs) -> requests.Response:
+        # Контекст копируется, чтобы запрос учитывался в метриках и трейсе текущего апдейта
+        context = contextvars.copy_context()
+        return await asyncio.get_running_loop().run_in_executor(
+            self._io_executor, functools.partial(context.run, function, *args, **kwargs)
+        )
+
+    async def get(self, path: str, **kwargs) -> requests.Response:
+        return await self._in_thread(self._idempotent, 'GET', path, **kwargs)
+
+    async def head(self, path: str, **kwargs) -> requests.Response:
+        return await self._in_thread(self._idempotent, 'HEAD', path, **kwargs)
+
+    async def post(self, path: str, **kwargs) -> requests.Response:
+        return await self._in_thread(self._post, path, **kwargs)
@@ -1,9 +1,26 @@
 from flask import Flask, request, jsonify
 import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
 import os
+import select
+import sys
+import threading
+import time
+
+# Общие модули лежат в каталоге common в корне репозитория
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common.db_routing import ReplicaRouter, commit_lsn, init_lsn_headers
+from tracing import init_flask, traced_connect
 
 app = Flask(__name__)
 
+# Интервалы запросов от бота в журнал трассировки (TRACE_LOG)
+init_flask(app, 'role_manager')
+# LSN записи в ответе и минимальный LSN реплики из запроса (X-DB-LSN)
+init_lsn_headers(app)
+
 # Настройки подключения к PostgreSQL
 DB_CONFIG = {
     "host": os.getenv('DB_HOST'),
@@ -14,8 +31,139 @@ DB_CONFIG = {
 }
 
 
+# Допустимые роли
+ROLES = ['admin', 'user']
+
+# Канал уведомлений PostgreSQL об изменении ролей
+ROLE_CHANGES_CHANNEL = 'user_roles_changes'
+
+# Ключ advisory-блокировки, упорядочивающей изменения ролей: версии
+# фиксируются строго по возрастанию и не обгоняют друг друга
+ROLE_VERSION_LOCK = 6003
+
+# Максимальное время ожидания изменений в /roles/changes (секунды)
+LONG_POLL_TIMEOUT = float(os.getenv('ROLES_LONG_POLL_TIMEOUT', '25'))
+
+
 def get_db_connection():
-    return psycopg2.connect(**DB_CONFIG)
+    return traced_connect(DB_CONFIG)
+
+
+# Чтение ролей с реплик (DB_REPLICAS); роли пользователя, измененные этим сервисом,
+# читаются только с реплик, уже получивших изменение
+db_router = ReplicaRouter(DB_CONFIG, traced_connect)
+
+
+def init_db():
+    """Создает таблицу ролей, если ее еще нет, или добавляет в старую первичный ключ (user_id) для upsert и поиска"""
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS user_roles (
+                    user_id VARCHAR(50) PRIMARY KEY,
+                    role VARCHAR(10) NOT NULL
+                )
+            ''')
+
+            # Таблица, созданная раньше без ключа, могла накопить повторы user_id, а upsert
+            # (ON CONFLICT) требует уникальности: остается последняя записанная строка
+            # пользователя, после чего добавляется первичный ключ
+            cursor.execute("LOCK TABLE user_roles IN ACCESS EXCLUSIVE MODE")
+            cursor.execute('''
+                SELECT 1 FROM pg_index i
+                JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = i.indkey[0]
+                WHERE i.indrelid = 'user_roles'::regclass AND i.indisunique
+                  AND i.indnkeyatts = 1 AND i.indpred IS NULL AND a.attname = 'user_id'
+            ''')
+            if cursor.fetchone() is None:
+                cursor.execute('''
+                    DELETE FROM user_roles older USING user_roles newer
+                    WHERE older.user_id = newer.user_id AND older.ctid < newer.ctid
+                ''')
+                print(f"Удалено повторяющихся ролей: {cursor.rowcount}")
+                cursor.execute("DELETE FROM user_roles WHERE user_id IS NULL")
+                cursor.execute("ALTER TABLE user_roles ADD PRIMARY KEY (user_id)")
+
+            # Версия изменения: монотонно растет при каждой смене роли
+            cursor.execute("CREATE SEQUENCE IF NOT EXISTS user_roles_version_seq")
+            cursor.execute("ALTER TABLE user_roles ADD COLUMN IF NOT EXISTS version BIGINT")
+            cursor.execute(
+                "UPDATE user_roles SET version = nextval('user_roles_version_seq') WHERE version IS NULL"
+            )
+            cursor.execute(
+                "ALTER TABLE user_roles ALTER COLUMN version SET DEFAULT nextval('user_roles_version_seq')"
+            )
+            cursor.execute("ALTER TABLE user_roles ALTER COLUMN version SET NOT NULL")
+            cursor.execute("CREATE INDEX IF NOT EXISTS user_roles_version_idx ON user_roles (version)")
+
+            # Уведомление слушателей после каждого изменения таблицы
+            cursor.execute(f'''
+                CREATE OR REPLACE FUNCTION notify_user_roles_changes() RETURNS trigger AS $$
+                BEGIN
+                    PERFORM pg_notify('{ROLE_CHANGES_CHANNEL}', '');
+                    RETURN NULL;
+                END;
+                $$ LANGUAGE plpgsql
+            ''')
+            cursor.execute("DROP TRIGGER IF EXISTS user_roles_changes_trigger ON user_roles")
+            cursor.execute('''
+                CREATE TRIGGER user_roles_changes_trigger
+                AFTER INSERT OR UPDATE ON user_roles
+                FOR EACH STATEMENT EXECUTE FUNCTION notify_user_roles_changes()
+            ''')
+        conn.commit()
+    finally:
+        conn.close()
+
+
+# Ожидающие /roles/changes запросы ждут на этом условии; счетчик
+# увеличивается при каждом уведомлении от PostgreSQL
+_roles_changed = threading.Condition()
+_roles_notifications = 0
+
+
+def listen_role_changes():
+    """Фоновый поток: подписка LISTEN на изменения ролей, будит ожидающие long-poll запросы"""
+    global _roles_notifications
+
+    while True:
+        conn = None
+        try:
+            conn = get_db_connection()
+            conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            with conn.cursor() as cursor:
+                cursor.execute(f"LISTEN {ROLE_CHANGES_CHANNEL}")
+
+            while True:
+                if select.select([conn], [], [], 60) == ([], [], []):
+                    continue
+                conn.poll()
+                if conn.notifies:
+                    conn.notifies.clear()
+                    with _roles_changed:
+                        _roles_notifications += 1
+                        _roles_changed.notify_all()
+        except Exception as e:
+            print(f"Ошибка подписки на изменения ролей: {e}")
+            time.sleep(1)
+        finally:
+            if conn:
+                conn.close()
+
+
+def fetch_role_changes(since):
+    # Изменения читаются с основной БД: уведомление приходит от нее, а реплика могла их еще не применить
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "SELECT user_id, role, version FROM user_roles WHERE version > %s ORDER BY version",
+                (since,)
+            )
+            return cursor.fetchall()
+    finally:
+        conn.close()
 
 
 @app.route('/check_role', methods=['GET'])
@@ -26,7 +174,7 @@ def check_role():
         return jsonify({"error": "Не указан user_id"}), 400
 
     try:
-        conn = get_db_connection()
+        conn = db_router.read_connection(user_id)
         with conn.cursor() as cursor:
             # Проверяем существование пользователя и его роль
             cursor.execute(
@@ -48,38 +196,63 @@ def check_role():
             conn.close()
 
 
+@app.route('/check_roles', methods=['POST'])
+def check_roles():
+    """Роли списка пользователей одним запросом: {"user_ids": [...]} -> {"roles": {user_id: role}}"""
+    data = request.json or {}
+    user_ids = data.get('user_ids')
+
+    if not isinstance(user_ids, list) or not user_ids:
+        return jsonify({"error": "Не указан список user_ids"}), 400
+
+    user_ids = [str(user_id) for user_id in user_ids]
+
+    try:
+        conn = db_router.read_connection(*user_ids)
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "SELECT user_id, role FROM user_roles WHERE user_id IN %s",
+                (tuple(user_ids),)
+            )
+            found = {str(user_id): role for user_id, role in cursor.fetchall()}
+
+        # Пользователи, которых нет в таблице, считаются обычными пользователями
+        return jsonify({"roles": {user_id: found.get(user_id, "user") for user_id in user_ids}}), 200
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+    finally:
+        if 'conn' in locals():
+            conn.close()
+
+
 @app.route('/set_role', methods=['POST'])
 def set_role():
     data = request.json
     user_id = data.get('user_id')
     role = data.get('role')
 
-    if not user_id or not role or role not in ['admin', 'user']:
+    if not user_id or not role or role not in ROLES:
         return jsonify({"error": "Неверные параметры"}), 400
 
     try:
         conn = get_db_connection()
         with conn.cursor() as cursor:
-            # Проверяем существование пользователя
+            cursor.execute("SELECT pg_advisory_xact_lock(%s)", (ROLE_VERSION_LOCK,))
+
+            # Добавляем пользователя или обновляем его роль одним запросом
             cursor.execute(
-                "SELECT 1 FROM user_roles WHERE user_id = %s",
-                (user_id,)
+                """
+                INSERT INTO user_roles (user_id, role) VALUES (%s, %s)
+                ON CONFLICT (user_id) DO UPDATE
+                SET role = EXCLUDED.role, version = nextval('user_roles_version_seq')
+                WHERE user_roles.role IS DISTINCT FROM EXCLUDED.role
+                """,
+                (str(user_id), role)
             )
 
-            if cursor.fetchone():
-                # Обновляем роль, если пользователь существует
-                cursor.execute(
-                    "UPDATE user_roles SET role = %s WHERE user_id = %s",
-                    (role, user_id)
-                )
-            else:
-                # Добавляем нового пользователя с ролью
-                cursor.execute(
-                    "INSERT INTO user_roles (user_id, role) VALUES (%s, %s)",
-                    (user_id, role)
-                )
-
             conn.commit()
+            db_router.wrote(str(user_id), commit_lsn(conn))
             return jsonify({"message": f"Роль пользователя {user_id} установлена как {role}"}), 200
 
     except Exception as e:
@@ -89,5 +262,95 @@ def set_role():
             conn.close()
 
 
+@app.route('/set_roles', methods=['POST'])
+def set_roles():
+    """Массовая установка ролей: {"roles": [{"user_id": ..., "role": ...}, ...]}"""
+    data = request.json or {}
+    items = data.get('roles')
+
+    if not isinstance(items, list) or not items:
+        return jsonify({"error": "Не указан список ролей"}), 400
+
+    # При повторе пользователя в запросе действует последняя роль
+    roles = {}
+    for item in items:
+        if not isinstance(item, dict) or not item.get('user_id') or item.get('role') not in ROLES:
+            return jsonify({"error": "Неверные параметры"}), 400
+        roles[str(item['user_id'])] = item['role']
+
+    try:
+        conn = get_db_connection()
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT pg_advisory_xact_lock(%s)", (ROLE_VERSION_LOCK,))
+            psycopg2.extras.execute_values(
+                cursor,
+                """
+                INSERT INTO user_roles (user_id, role) VALUES %s
+                ON CONFLICT (user_id) DO UPDATE
+                SET role = EXCLUDED.role, version = nextval('user_roles_version_seq')
+                WHERE user_roles.role IS DISTINCT FROM EXCLUDED.role
+                """,
+                list(roles.items()),
+                page_size=len(roles)
+            )
+
+            conn.commit()
+            lsn = commit_lsn(conn)
+            for user_id in roles:
+                db_router.wrote(user_id, lsn)
+            return jsonify({"message": f"Установлено ролей: {len(roles)}"}), 200
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+    finally:
+        if 'conn' in locals():
+            conn.close()
+
+
+@app.route('/roles/changes', methods=['GET'])
+def role_changes():
+    """
+    Лента изменений ролей (long-poll)
+
+    Параметры:
+    - since: версия, полученная в прошлом ответе (0 - все роли)
+    - timeout: сколько секунд ждать изменений, если их еще нет
+
+    Возвращает {"version": новая версия, "changes": [{"user_id", "role"}, ...]}
+    """
+    try:
+        since = int(request.args.get('since', '0'))
+        timeout = min(float(request.args.get('timeout', LONG_POLL_TIMEOUT)), LONG_POLL_TIMEOUT)
+    except ValueError:
+        return jsonify({"error": "Неверные параметры"}), 400
+
+    deadline = time.monotonic() + timeout
+
+    try:
+        while True:
+            # Номер уведомления запоминается до запроса, чтобы не пропустить
+            # изменение, зафиксированное между запросом и ожиданием
+            with _roles_changed:
+                seen_notifications = _roles_notifications
+
+            rows = fetch_role_changes(since)
+            remaining = deadline - time.monotonic()
+            if rows or remaining <= 0:
+                break
+
+            with _roles_changed:
+                _roles_changed.wait_for(lambda: _roles_notifications != seen_notifications, timeout=remaining)
+
+        return jsonify({
+            "version": rows[-1][2] if rows else since,
+            "changes": [{"user_id": str(user_id), "role": role} for user_id, role, _ in rows]
+        }), 200
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
 if __name__ == '__main__':
+    init_db()
+    threading.Thread(target=listen_role_changes, name='role-changes-listener', daemon=True).start()
     app.run(host='0.0.0.0', port=5003)
\ No newline at end of file
@@ -0,0 +1,183 @@
+"""
+Разбор журнала трассировки lab-6: из чего складывается время апдейта
+
+Команды:
+    python trace_report.py                      # последние 5 трейсов из TRACE_LOG
+    python trace_report.py --last 20 bot.jsonl data.jsonl
+    python trace_report.py --slowest 10 --handler process_amount_to_convert
+    python trace_report.py --trace 3f2a9c       # один трейс по началу trace id
+    python trace_report.py --summary            # сводка по обработчикам
+
+Для каждого трейса выводится дерево интервалов (смещение от начала, длительность,
+сервис, вид, имя) и разбивка времени апдейта по видам и сервисам. Разбивка
+считается по собственному времени интервала - длительности за вычетом вложенных
+интервалов, поэтому части складываются во время обработчика: например, для
+http собственное время - это сеть и очередь сервиса, а не вся обработка запроса.
+
+Журналы нескольких процессов можно передать списком файлов или писать в один
+файл (TRACE_LOG у бота и сервисов).
+"""
+import argparse
+import json
+import os
+import sys
+from collections import defaultdict
+
+TRACE_LOG = os.getenv('TRACE_LOG', '')
+
+KINDS = ('handler', 'http', 'server', 'db', 'serialize')
+
+
+def load_traces(paths) -> dict:
+    """Интервалы из журналов, сгруппированные по trace id"""
+    traces = defaultdict(list)
+    for path in paths:
+        with open(path, encoding='utf-8') as trace_file:
+            for line in trace_file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Строка, дописываемая в этот момент, или поврежденная запись
+                    continue
+                traces[record['trace']].append(record)
+    return traces
+
+
+class Trace:
+    """Дерево интервалов одного апдейта"""
+
+    def __init__(self, trace_id: str, spans: list):
+        self.trace_id = trace_id
+        self.spans = sorted(spans, key=lambda item: item['start'])
+        ids = {item['span'] for item in self.spans}
+        self.children = defaultdict(list)
+        self.roots = []
+        for item in self.spans:
+            if item.get('parent') in ids:
+                self.children[item['parent']].append(item)
+            else:
+                self.roots.append(item)
+
+        self.start = self.spans[0]['start']
+        end = max(item['start'] + item['ms'] / 1000 for item in self.spans)
+        self.duration_ms = (end - self.start) * 1000
+        root = self.roots[0]
+        self.name = root['name'] if root['kind'] == 'handler' else f"{root['service']} {root['name']}"
+
+    def self_ms(self, item) -> float:
+        # Параллельные вложенные интервалы (hedged-запросы) могут перекрываться
+        nested = sum(child['ms'] for child in self.children[item['span']])
+        return max(item['ms'] - nested, 0.0)
+
+    def breakdown(self) -> tuple:
+        """Собственное время по видам интервалов и по сервисам"""
+        by_kind = defaultdict(float)
+        by_service = defaultdict(float)
+        for item in self.spans:
+            own = self.self_ms(item)
+            by_kind[item['kind']] += own
+            by_service[item['service']] += own
+        return by_kind, by_service
+
+
+def _format_parts(parts: dict, order=()) -> str:
+    keys = [key for key in order if key in parts] + sorted(key for key in parts if key not in order)
+    return ", ".join(f"{key} {parts[key]:.1f}" for key in keys)
+
+
+def _format_attrs(item) -> str:
+    extra = [
+        f"{key}={value}" for key, value in item.items()
+        if key not in ('trace', 'span', 'parent', 'service', 'kind', 'name', 'start', 'ms')
+    ]
+    return f" [{' '.join(extra)}]" if extra else ""
+
+
+def print_trace(trace: Trace, out=sys.stdout):
+    by_kind, by_service = trace.breakdown()
+    print(f"Трейс {trace.trace_id}: {trace.name} {trace.duration_ms:.1f} мс", file=out)
+    print(f"  по видам, мс: {_format_parts(by_kind, KINDS)}", file=out)
+    print(f"  по сервисам, мс: {_format_parts(by_service, ('bot',))}", file=out)
+
+    def walk(item, depth):
+        offset = (item['start'] - trace.start) * 1000
+        print(
+            f"  {offset:8.1f} {item['ms']:8.1f}  {'  ' * depth}{item['service']} {item['kind']} "
+            f"{item['name']}{_format_attrs(item)}",
+            file=out
+        )
+        for child in trace.children[item['span']]:
+            walk(child, depth + 1)
+
+    for root in trace.roots:
+        walk(root, 0)
+    print(file=out)
+
+
+def _percentile(sorted_values, quantile: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(quantile * len(sorted_values)))]
+
+
+def print_summary(traces: list, out=sys.stdout):
+    """Сводка по обработчикам: перцентили времени и среднее собственное время по видам"""
+    groups = defaultdict(list)
+    for trace in traces:
+        groups[trace.name].append(trace)
+
+    for name, group in sorted(groups.items(), key=lambda item: -len(item[1])):
+        durations = sorted(trace.duration_ms for trace in group)
+        kinds = defaultdict(float)
+        for trace in group:
+            for kind, value in trace.breakdown()[0].items():
+                kinds[kind] += value
+        average = {kind: value / len(group) for kind, value in kinds.items()}
+        print(
+            f"{name}: {len(group)} апдейтов, p50 {_percentile(durations, 0.5):.1f} мс, "
+            f"p95 {_percentile(durations, 0.95):.1f} мс, max {durations[-1]:.1f} мс",
+            file=out
+        )
+        print(f"  в среднем по видам, мс: {_format_parts(average, KINDS)}", file=out)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Разбивка времени апдейтов по журналу трассировки")
+    parser.add_argument('files', nargs='*', help="журналы трассировки (по умолчанию TRACE_LOG)")
+    parser.add_argument('--trace', help="показать трейс, trace id которого начинается с этой строки")
+    parser.add_argument('--handler', help="только апдейты этого обработчика")
+    parser.add_argument('--last', type=int, default=5, help="показать последние N трейсов")
+    parser.add_argument('--slowest', type=int, help="показать N самых медленных трейсов")
+    parser.add_argument('--summary', action='store_true', help="сводка по обработчикам")
+    args = parser.parse_args()
+
+    paths = args.files or [TRACE_LOG or 'trace.jsonl']
+    missing = [path for path in paths if not os.path.exists(path)]
+    if missing:
+        parser.error(f"нет журнала: {', '.join(missing)}")
+
+    traces = [Trace(trace_id, spans) for trace_id, spans in load_traces(paths).items()]
+    if args.trace:
+        traces = [trace for trace in traces if trace.trace_id.startswith(args.trace)]
+    if args.handler:
+        traces = [trace for trace in traces if trace.name == args.handler]
+    if not traces:
+        print("Трейсов не найдено")
+        return
+
+    if args.summary:
+        print_summary(traces)
+        return
+
+    if args.slowest:
+        selected = sorted(traces, key=lambda trace: trace.duration_ms, reverse=True)[:args.slowest]
+    elif args.trace:
+        selected = traces
+    else:
+        selected = sorted(traces, key=lambda trace: trace.start)[-args.last:]
+    for trace in selected:
+        print_trace(trace)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,242 @@
+"""
+Трассировка апдейтов бота через сервисы lab-6
+
+Каждый апдейт в боте получает trace id. Он передается в заголовках
+X-Trace-Id и X-Parent-Span-Id во все запросы к currency-manager,
+data_manager и role_manager. Бот и сервисы записывают интервалы (span)
+в журнал TRACE_LOG, по одной JSON-строке на интервал:
+    {"trace": ..., "span": ..., "parent": ..., "service": ..., "kind": ...,
+     "name": ..., "start": <unix time>, "ms": <длительность>, ...}
+
+Виды интервалов:
+- handler - обработчик апдейта в боте (корень трейса);
+- http - исходящий запрос бота к сервису;
+- server - обработка запроса сервисом;
+- db - подключение к PostgreSQL и запросы;
+- serialize - сериализация ответа в JSON.
+
+Подключение в боте:
+    tracer = UpdateTracer()
+    tracer.setup(dp)
+    ServiceClient(..., session_factory=TracingSession)
+
+Подключение в сервисе:
+    init_flask(app, 'data_manager')
+    traced_connect(DB_CONFIG)   # psycopg2.connect с курсорами TracingCursor
+
+Журнал разбирается командой python trace_report.py.
+
+Настройки (переменные окружения):
+- TRACE_LOG: путь к журналу трассировки; не задан - трассировка выключена.
+  Бот и сервисы на одной машине могут писать в один файл
+- TRACE_SAMPLE: доля апдейтов, которые трассируются (1.0)
+"""
+import json
+import os
+import random
+import threading
+import time
+from contextvars import ContextVar
+
+import psycopg2.extensions
+import requests
+
+TRACE_LOG = os.getenv('TRACE_LOG', '')
+TRACE_SAMPLE = float(os.getenv('TRACE_SAMPLE', '1.0'))
+
+TRACE_HEADER = 'X-Trace-Id'
+PARENT_HEADER = 'X-Parent-Span-Id'
+
+# Сколько символов запроса сохранять в имени интервала БД
+SQL_NAME_LENGTH = 80
+
+# Текущий интервал: (trace id, span id); у каждой задачи asyncio и потока свое значение
+_current_span = ContextVar('trace_span', default=None)
+
+_log_fd = None
+_log_lock = threading.Lock()
+_service = 'bot'
+
+
+def _new_id(size: int) -> str:
+    return os.urandom(size).hex()
+
+
+def _write(record: dict):
+    global _log_fd
+    if _log_fd is None:
+        with _log_lock:
+            if _log_fd is None:
+                # O_APPEND: строка дописывается одним вызовом write, поэтому
+                # несколько процессов могут вести общий журнал
+                _log_fd = os.open(TRACE_LOG, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    line = json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n'
+    os.write(_log_fd, line.encode('utf-8'))
+
+
+class Span:
+    """Интервал трейса; вне трейса (или при выключенной трассировке) ничего не записывает"""
+    __slots__ = ('kind', 'name', 'attrs', 'trace_id', 'parent_id', 'span_id', '_token', '_start', '_wall')
+
+    def __init__(self, kind: str, name: str, trace_id=None, parent_id=None, **attrs):
+        self.kind = kind
+        self.name = name
+        self.attrs = attrs
+        if trace_id is None and TRACE_LOG:
+            current = _current_span.get()
+            if current is not None:
+                trace_id, parent_id = current
+        self.trace_id = trace_id
+        self.parent_id = parent_id
+        self.span_id = None
+        self._token = None
+
+    def __enter__(self):
+        if self.trace_id is not None:
+            self.span_id = _new_id(8)
+            self._token = _current_span.set((self.trace_id, self.span_id))
+            self._wall = time.time()
+            self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.span_id is None:
+            return False
+        elapsed_ms = (time.perf_counter() - self._start) * 1000
+        _current_span.reset(self._token)
+        if exc_type is not None:
+            self.attrs['error'] = exc_type.__name__
+        _write({
+            'trace': self.trace_id, 'span': self.span_id, 'parent': self.parent_id,
+            'service': _service, 'kind': self.kind, 'name': self.name,
+            'start': round(self._wall, 6), 'ms': round(elapsed_ms, 3), **self.attrs
+        })
+        return False
+
+
+def span(kind: str, name: str, **attrs) -> Span:
+    """Дочерний интервал текущего трейса: with span('db', 'connect'): ..."""
+    return Span(kind, name, **attrs)
+
+
+def trace_headers() -> dict:
+    """Заголовки для передачи текущего трейса в исходящий запрос"""
+    current = _current_span.get()
+    if current is None:
+        return {}
+    return {TRACE_HEADER: current[0], PARENT_HEADER: current[1]}
+
+
+class TracingSession(requests.Session):
+    """Сессия requests: исходящий запрос - интервал http, трейс передается в заголовках"""
+
+    def request(self, method, url, *args, **kwargs):
+        path = requests.utils.urlparse(url).path
+        with span('http', f"{method} {path}") as current:
+            if current.span_id is not None:
+                kwargs['headers'] = {**(kwargs.get('headers') or {}), **trace_headers()}
+            response = super().request(method, url, *args, **kwargs)
+            current.attrs['status'] = response.status_code
+            return response
+
+
+class UpdateTracer:
+    """Middleware бота: новый трейс на каждый апдейт с корневым интервалом обработчика"""
+
+    def __init__(self, sample: float = TRACE_SAMPLE):
+        self.sample = sample
+
+    def setup(self, dp):
+        """Регистрирует middleware, если задан TRACE_LOG"""
+        if not TRACE_LOG:
+            return
+        dp.message.middleware(self)
+        dp.callback_query.middleware(self)
+
+    async def __call__(self, handler, event, data):
+        if self.sample < 1.0 and random.random() >= self.sample:
+            return await handler(event, data)
+        handler_object = data.get('handler')
+        name = handler_object.callback.__name__ if handler_object else 'unknown'
+        with Span('handler', name, trace_id=_new_id(16), update_type=type(event).__name__):
+            return await handler(event, data)
+
+
+class TracingCursor(psycopg2.extensions.cursor):
+    """Курсор psycopg2, записывающий каждый запрос как интервал db"""
+
+    def execute(self, query, vars=None):
+        if _current_span.get() is None:
+            return super().execute(query, vars)
+        with span('db', _sql_name(self, query)) as current:
+            result = super().execute(query, vars)
+            current.attrs['rows'] = self.rowcount
+            return result
+
+    def executemany(self, query, vars_list):
+        if _current_span.get() is None:
+            return super().executemany(query, vars_list)
+        with span('db', _sql_name(self, query)) as current:
+            result = super().executemany(query, vars_list)
+            current.attrs['rows'] = self.rowcount
+            return result
+
+
+def _sql_name(cursor, query) -> str:
+    if isinstance(query, bytes):
+        query = query.decode('utf-8', 'replace')
+    elif not isinstance(query, str):
+        # Запрос, собранный через psycopg2.sql
+        query = query.as_string(cursor)
+    return ' '.join(query.split())[:SQL_NAME_LENGTH]
+
+
+def traced_connect(config: dict):
+    """psycopg2.connect с интервалом на подключение и курсорами TracingCursor"""
+    with span('db', 'connect'):
+        return psycopg2.connect(**config, cursor_factory=TracingCursor)
+
+
+def init_flask(app, service: str):
+    """Продолжает трейс из заголовков входящих запросов и замеряет сериализацию JSON.
+
+    Запросы без X-Trace-Id (не от бота) не записываются.
+    """
+    global _service
+    if not TRACE_LOG:
+        return
+    _service = service
+
+    from flask import g, request
+    from flask.json.provider import DefaultJSONProvider
+
+    class TracingJSONProvider(DefaultJSONProvider):
+        def dumps(self, obj, **kwargs):
+            with span('serialize', 'json') as current:
+                body = super().dumps(obj, **kwargs)
+                current.attrs['bytes'] = len(body)
+                return body
+
+    app.json = TracingJSONProvider(app)
+
+    @app.before_request
+    def start_trace_span():
+        trace_id = request.headers.get(TRACE_HEADER)
+        if not trace_id:
+            return
+        g.trace_span = Span('server', f"{request.method} {request.path}",
+                            trace_id=trace_id, parent_id=request.headers.get(PARENT_HEADER))
+        g.trace_span.__enter__()
+
+    @app.after_request
+    def record_status(response):
+        current = g.get('trace_span')
+        if current is not None:
+            current.attrs['status'] = response.status_code
+        return response
+
+    @app.teardown_request
+    def finish_trace_span(exc):
+        current = g.pop('trace_span', None)
+        if current is not None:
+            current.__exit__(type(exc) if exc else None, exc, None)
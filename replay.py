@@ -0,0 +1,295 @@
+"""
+Воспроизведение записанных апдейтов на боте для регрессионных замеров
+
+Апдейты, записанные UpdateRecorder (RECORD_UPDATES), подаются прямо в
+диспетчер бота. Запросы к Telegram Bot API перехватываются: они не уходят
+в сеть, а сохраняются как ответ бота на апдейт. БД и сервисы бота
+используются настоящие, поэтому запускать воспроизведение нужно на
+тестовой БД; для сравнения поведения двух прогонов - на одинаковой копии.
+
+Апдейты одного чата обрабатываются по очереди (как ответы пользователю
+и состояния FSM в реальной переписке), разные чаты - параллельно.
+
+Команды:
+    python replay.py rgz/bot.py updates.jsonl.gz                    # в исходном темпе
+    python replay.py rgz/bot.py updates.jsonl.gz --speed 10         # в 10 раз быстрее
+    python replay.py lab-5/bot1.py updates.jsonl --speed 0 --output run1.jsonl
+    python replay.py lab-5/bot1.py updates.jsonl --speed 0 --compare run1.jsonl
+
+Выводится пропускная способность, перцентили времени обработки апдейта и
+число вызовов Bot API по методам. С --output результаты прогона (время и
+вызовы Bot API на каждый апдейт) сохраняются, с --compare сравниваются с
+сохраненным прогоном: разница перцентилей и апдейты, на которые бот ответил
+иначе.
+
+Переменные окружения бота (DB_*, адреса сервисов) задаются как обычно;
+TELEGRAM_BOT_TOKEN, если не задан, подставляется фиктивный. Если у бота
+включен антифлуд (ANTIFLOOD=true), при ускоренном воспроизведении апдейты
+одного чата идут чаще, чем в записи, и часть из них будет отброшена.
+"""
+import argparse
+import asyncio
+import gzip
+import importlib.util
+import itertools
+import json
+import logging
+import os
+import sys
+import time
+from collections import Counter, defaultdict
+from contextvars import ContextVar
+
+from aiogram.client.session.base import BaseSession
+from aiogram.types import Update
+
+REPLAY_TOKEN = '123456:replay'
+REPLAY_BOT_ID = 123456
+
+# Сколько различий в поведении выводить при сравнении
+MAX_DIFFS = 20
+
+# Вызовы Bot API, сделанные при обработке текущего апдейта
+_current_calls = ContextVar('replay_calls', default=None)
+
+logger = logging.getLogger(__name__)
+
+
+def load_recording(path: str) -> list:
+    """Записанные апдейты в порядке поступления: [(ts, update), ...]"""
+    opener = gzip.open if path.endswith('.gz') else open
+    records = []
+    with opener(path, 'rt', encoding='utf-8') as recording:
+        for line in recording:
+            line = line.strip()
+            if line:
+                record = json.loads(line)
+                records.append((record['ts'], record['update']))
+    records.sort(key=lambda record: record[0])
+    return records
+
+
+def load_bot(path: str):
+    """Импортирует модуль бота из файла; каталог бота добавляется в sys.path для его модулей"""
+    path = os.path.abspath(path)
+    sys.path.insert(0, os.path.dirname(path))
+    os.environ.setdefault('TELEGRAM_BOT_TOKEN', REPLAY_TOKEN)
+    spec = importlib.util.spec_from_file_location('replayed_bot', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def update_chat(update: dict):
+    """Чат апдейта - по нему апдейты упорядочиваются при воспроизведении"""
+    for kind in ('message', 'edited_message', 'callback_query', 'inline_query', 'my_chat_member'):
+        event = update.get(kind)
+        if not event:
+            continue
+        if kind == 'callback_query' and event.get('message'):
+            return event['message']['chat']['id']
+        if 'chat' in event:
+            return event['chat']['id']
+        return event.get('from', {}).get('id')
+    return None
+
+
+def update_summary(update: dict) -> str:
+    if 'message' in update:
+        return update['message'].get('text', '<не текст>')
+    if 'callback_query' in update:
+        return f"callback {update['callback_query'].get('data')}"
+    return next((key for key in update if key != 'update_id'), 'update')
+
+
+class ReplaySession(BaseSession):
+    """Сессия Bot API без сети: запоминает вызовы и возвращает правдоподобные ответы"""
+
+    def __init__(self, latency_ms: float = 0.0):
+        super().__init__()
+        self.latency = latency_ms / 1000
+        self.calls = Counter()
+        self._message_ids = itertools.count(1)
+
+    def _fake_result(self, name: str, params: dict):
+        if name == 'getMe':
+            return {"id": REPLAY_BOT_ID, "is_bot": True, "first_name": "Replay", "username": "replay_bot"}
+        if name.startswith(('send', 'edit', 'forward')):
+            chat_id = params.get('chat_id')
+            message = {
+                "message_id": params.get('message_id') or next(self._message_ids),
+                "date": int(time.time()),
+                "chat": {"id": chat_id if isinstance(chat_id, int) else 0, "type": "private"},
+            }
+            if 'text' in params:
+                message['text'] = params['text']
+            return message
+        return True
+
+    async def make_request(self, bot, method, timeout=None):
+        name = method.__api_method__
+        params = {
+            key: value for key, value in (
+                (key, self.prepare_value(value, bot=bot, files={}, _dumps_json=False))
+                for key, value in method.model_dump(warnings=False).items()
+            ) if value is not None
+        }
+        self.calls[name] += 1
+        calls = _current_calls.get()
+        if calls is not None:
+            calls.append({'method': name, **params})
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        content = json.dumps({"ok": True, "result": self._fake_result(name, params)})
+        return self.check_response(bot, method, 200, content).result
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        raise RuntimeError("Скачивание файлов при воспроизведении не поддерживается")
+        yield b''
+
+    async def close(self):
+        pass
+
+
+async def replay(module, records: list, speed: float, concurrency: int, api_latency_ms: float = 0.0):
+    """Подает апдейты в диспетчер бота; возвращает результаты по апдейтам и общее время"""
+    bot, dp = module.bot, module.dp
+    session = bot.session = ReplaySession(api_latency_ms)
+    semaphore = asyncio.Semaphore(concurrency)
+    results = []
+
+    async def process(update: dict):
+        calls = []
+        token = _current_calls.set(calls)
+        error = None
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                await dp.feed_update(bot, Update.model_validate(update, context={"bot": bot}))
+            except Exception as e:
+                error = f"{type(e).__name__}: {e}"
+            elapsed_ms = (time.perf_counter() - start) * 1000
+        _current_calls.reset(token)
+        results.append({
+            'update_id': update['update_id'], 'chat': update_chat(update), 'input': update_summary(update),
+            'ms': round(elapsed_ms, 3), 'calls': calls, 'error': error
+        })
+
+    chats = defaultdict(list)
+    for ts, update in records:
+        chats[update_chat(update)].append((ts, update))
+    first_ts = records[0][0] if records else 0.0
+
+    async def run_chat(chat_records):
+        for ts, update in chat_records:
+            if speed > 0:
+                delay = started + (ts - first_ts) / speed - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            await process(update)
+
+    await dp.emit_startup(bot=bot, bots=[bot], dispatcher=dp)
+    try:
+        started = time.monotonic()
+        await asyncio.gather(*(run_chat(chat_records) for chat_records in chats.values()))
+        wall = time.monotonic() - started
+    finally:
+        await dp.emit_shutdown(bot=bot, bots=[bot], dispatcher=dp)
+
+    results.sort(key=lambda result: result['update_id'])
+    return results, wall, session.calls
+
+
+def _percentile(sorted_values, quantile: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(quantile * len(sorted_values)))]
+
+
+def latency_stats(results: list) -> dict:
+    durations = sorted(result['ms'] for result in results)
+    return {
+        'p50': _percentile(durations, 0.5), 'p95': _percentile(durations, 0.95),
+        'p99': _percentile(durations, 0.99), 'max': durations[-1] if durations else 0.0,
+    }
+
+
+def print_report(results: list, wall: float, calls: Counter):
+    stats = latency_stats(results)
+    errors = sum(1 for result in results if result['error'])
+    print(f"Апдейтов: {len(results)} за {wall:.2f} с, {len(results) / wall if wall else 0:.1f} апдейтов/с")
+    print("Время обработки, мс: " + ", ".join(f"{key} {value:.1f}" for key, value in stats.items()))
+    print(f"Ошибок: {errors}")
+    print("Вызовы Bot API: " + (", ".join(f"{name} {count}" for name, count in calls.most_common()) or "нет"))
+
+
+def _behavior(result: dict) -> list:
+    # Идентификаторы сообщений, выданные ReplaySession, зависят от порядка обработки чатов
+    return [
+        {key: value for key, value in call.items() if not (call['method'].startswith('send') and key == 'message_id')}
+        for call in result['calls']
+    ] + ([{'error': result['error']}] if result['error'] else [])
+
+
+def compare(results: list, prior: list):
+    """Сравнивает прогон с сохраненным: время обработки и ответы бота на те же апдейты"""
+    current_stats, prior_stats = latency_stats(results), latency_stats(prior)
+    print("Изменение времени обработки, мс: " + ", ".join(
+        f"{key} {prior_stats[key]:.1f} -> {current_stats[key]:.1f} ({current_stats[key] - prior_stats[key]:+.1f})"
+        for key in current_stats
+    ))
+
+    prior_by_id = {result['update_id']: result for result in prior}
+    diffs = []
+    for result in results:
+        before = prior_by_id.get(result['update_id'])
+        if before is not None and _behavior(before) != _behavior(result):
+            diffs.append((before, result))
+    missing = len(prior_by_id.keys() - {result['update_id'] for result in results})
+
+    print(f"Апдейтов с другим ответом бота: {len(diffs)} из {len(results)}"
+          + (f", нет в прогоне: {missing}" if missing else ""))
+    for before, after in diffs[:MAX_DIFFS]:
+        print(f"- update {after['update_id']} (чат {after['chat']}): {after['input']!r}")
+        print(f"    было:  {json.dumps(_behavior(before), ensure_ascii=False)}")
+        print(f"    стало: {json.dumps(_behavior(after), ensure_ascii=False)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Воспроизведение записанных апдейтов на боте")
+    parser.add_argument('bot', help="файл бота: rgz/bot.py, lab-5/bot1.py, lab-6/bot.py")
+    parser.add_argument('recording', help="журнал апдейтов (RECORD_UPDATES), .jsonl или .jsonl.gz")
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help="темп относительно записи; 0 - так быстро, как возможно (1.0)")
+    parser.add_argument('--concurrency', type=int, default=100, help="сколько апдейтов обрабатывать одновременно")
+    parser.add_argument('--api-latency', type=float, default=0.0, help="задержка ответа Bot API, мс")
+    parser.add_argument('--limit', type=int, help="воспроизвести только первые N апдейтов")
+    parser.add_argument('--output', help="сохранить результаты прогона в файл")
+    parser.add_argument('--compare', help="сравнить с сохраненным прогоном")
+    args = parser.parse_args()
+
+    records = load_recording(args.recording)[:args.limit]
+    if not records:
+        parser.error("в записи нет апдейтов")
+    prior = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as prior_file:
+            prior = [json.loads(line) for line in prior_file if line.strip()]
+
+    module = load_bot(args.bot)
+    # Бот включает подробный лог; при воспроизведении нужен только отчет
+    logging.getLogger('aiogram.event').setLevel(logging.WARNING)
+    results, wall, calls = asyncio.run(replay(module, records, args.speed, args.concurrency, args.api_latency))
+
+    print_report(results, wall, calls)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as output:
+            for result in results:
+                output.write(json.dumps(result, ensure_ascii=False) + '\n')
+    if prior is not None:
+        compare(results, prior)
+
+
+if __name__ == '__main__':
+    main()
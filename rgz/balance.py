@@ -0,0 +1,135 @@
+"""
+Баланс пользователя и его изменение по дням
+
+Ряд считается в БД за один проход оконной функцией: суммы операций
+группируются по дням, а нарастающий итог дает баланс на конец каждого дня.
+Результат кэшируется на пользователя. Если с прошлого расчета добавились
+только операции не раньше последнего дня ряда, досчитывается лишь новый
+хвост; если появилась операция задним числом или число операций не сходится,
+ряд пересчитывается целиком.
+
+Операции, убранные в архив (partitioning.py archive), учитываются остатком на
+начало из operations_opening_balance: ряд начинается с него, а не с нуля.
+
+Настройки (переменные окружения):
+- BALANCE_CACHE_SIZE: для скольких пользователей хранить рассчитанный ряд (1000)
+"""
+import os
+import threading
+from collections import OrderedDict
+from decimal import Decimal
+
+from partitioning import OPENING_BALANCE_TABLE
+
+BALANCE_CACHE_SIZE = int(os.getenv('BALANCE_CACHE_SIZE', '1000'))
+
+# Нарастающий итог по дням; доход учитывается со знаком плюс, расход - минус
+BALANCE_SERIES_QUERY = '''
+    SELECT date,
+           SUM(SUM(CASE WHEN type_operation = 'ДОХОД' THEN sum ELSE -sum END))
+               OVER (ORDER BY date) AS balance,
+           MAX(id) AS last_id,
+           COUNT(*) AS operations
+    FROM operations
+    WHERE chat_id = %s AND id > %s
+    GROUP BY date
+    ORDER BY date
+'''
+
+# Что изменилось с прошлого расчета: всего операций, сколько новых и самая ранняя дата среди новых
+BALANCE_CHANGES_QUERY = '''
+    SELECT COUNT(*),
+           COUNT(*) FILTER (WHERE id > %s),
+           MIN(date) FILTER (WHERE id > %s)
+    FROM operations
+    WHERE chat_id = %s
+'''
+
+# Остаток на начало: баланс архивных операций и дата последней из них
+OPENING_BALANCE_QUERY = f'''
+    SELECT date, balance FROM {OPENING_BALANCE_TABLE} WHERE chat_id = %s
+'''
+
+
+class BalanceSeries:
+    """Баланс на конец каждого дня, в который были операции"""
+
+    def __init__(self):
+        self.dates = []
+        self.balances = []
+        self.last_id = 0
+        self.operations = 0
+
+    @property
+    def balance(self) -> Decimal:
+        return self.balances[-1] if self.balances else Decimal(0)
+
+    def extend(self, rows, start_balance: Decimal):
+        """Добавляет к ряду точки, посчитанные с нарастающим итогом от start_balance"""
+        for day, balance, last_id, operations in rows:
+            balance += start_balance
+            if self.dates and self.dates[-1] == day:
+                self.balances[-1] = balance
+            else:
+                self.dates.append(day)
+                self.balances.append(balance)
+            self.last_id = max(self.last_id, last_id)
+            self.operations += operations
+
+    def open(self, day, balance: Decimal):
+        """Начинает ряд с остатка на начало на дату day"""
+        self.dates.append(day)
+        self.balances.append(balance)
+
+    def monthly(self, months: int) -> list:
+        """Баланс на конец месяца для последних months месяцев, в которые были операции"""
+        result = OrderedDict()
+        for day, balance in zip(self.dates, self.balances):
+            result[(day.year, day.month)] = balance
+        return list(result.items())[-months:]
+
+
+class BalanceCache:
+    """Кэш рядов баланса по chat_id с вытеснением давно не запрашиваемых"""
+
+    def __init__(self, connect, size: int = BALANCE_CACHE_SIZE):
+        self._connect = connect
+        self.size = size
+        self._series = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, chat_id: int) -> BalanceSeries:
+        with self._lock:
+            series = self._series.pop(chat_id, None)
+
+        conn = self._connect(chat_id)
+        try:
+            cursor = conn.cursor()
+            if series is not None:
+                cursor.execute(BALANCE_CHANGES_QUERY, (series.last_id, series.last_id, chat_id))
+                total, new, first_new_date = cursor.fetchone()
+                if total != series.operations + new or (
+                        first_new_date is not None and series.dates and first_new_date < series.dates[-1]):
+                    # Операция задним числом, удаление или архивирование - ряд пересчитывается целиком
+                    series = None
+                elif new:
+                    cursor.execute(BALANCE_SERIES_QUERY, (chat_id, series.last_id))
+                    series.extend(cursor.fetchall(), series.balance)
+
+            if series is None:
+                series = BalanceSeries()
+                cursor.execute(OPENING_BALANCE_QUERY, (chat_id,))
+                opening = cursor.fetchone()
+                if opening is not None:
+                    series.open(*opening)
+                cursor.execute(BALANCE_SERIES_QUERY, (chat_id, 0))
+                series.extend(cursor.fetchall(), series.balance)
+            cursor.close()
+        finally:
+            conn.close()
+
+        with self._lock:
+            self._series[chat_id] = series
+            while len(self._series) > self.size:
+                self._series.popitem(last=False)
+        return series
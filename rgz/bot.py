@@ -1,18 +1,37 @@
 import asyncio
 import logging
 import os
+import sys
+import time
+from bisect import bisect_right
 from datetime import datetime
-from typing import Optional
+from typing import NamedTuple, Optional
 import aiohttp
 import psycopg2
 import psycopg2.extras
 from aiogram import Bot, Dispatcher, F
-from aiogram.filters import Command
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.filters import Command, CommandObject
 from aiogram.types import Message, CallbackQuery, InlineKeyboardButton, InlineKeyboardMarkup
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.storage.memory import MemoryStorage
 
+# Общие модули ботов лежат в каталоге common в корне репозитория
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common.antiflood import AntiFlood
+from common.db_routing import ReplicaRouter
+from common.metrics import CountingConnection, HandlerMetrics, http_trace_config
+from common.recorder import UpdateRecorder
+from common.watchdog import LoopWatchdog
+from balance import BalanceCache
+from page_cache import PageCache
+from partitioning import create_opening_balance_table, ensure_partitions
+from sharding import router_from_env
+from write_buffer import WRITE_BUFFER, OperationWriteBuffer
+
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
 
@@ -33,14 +52,98 @@ DB_CONFIG = {
     'database': db_name
 }
 
-# URL внешнего сервиса для курсов валют
-CURRENCY_SERVICE_URL = f"http://{os.getenv('CURRENCY_SERVICE_HOST', '127.0.0.1')}:{os.getenv('CURRENCY_SERVICE_PORT', '5000')}/rate"
+# URL внешнего сервиса для истории курсов валют
+CURRENCY_HISTORY_URL = f"http://{os.getenv('CURRENCY_SERVICE_HOST', '127.0.0.1')}:{os.getenv('CURRENCY_SERVICE_PORT', '5000')}/history"
+
+# Сколько секунд использовать полученную историю курса без повторного запроса
+RATE_HISTORY_TTL = float(os.getenv('RATE_HISTORY_TTL', '30'))
+
+# Валюты, операции в которых пересчитываются по курсу
+RATE_CURRENCIES = ("EUR", "USD")
+
+# Как часто проверять, что секции operations созданы на ближайшие месяцы, секунд
+PARTITION_CHECK_INTERVAL = float(os.getenv('PARTITION_CHECK_INTERVAL', '86400'))
+
+# Адрес Bot API; для нагрузочных замеров - локальный сервер (fake_telegram.py)
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL')
 
 # Создание бота и диспетчера
-bot = Bot(token=BOT_TOKEN)
+bot = Bot(token=BOT_TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL))
+          if TELEGRAM_API_URL else None)
 storage = MemoryStorage()
 dp = Dispatcher(storage=storage)
 
+# Метрики обработчиков (время, запросы к БД, HTTP-вызовы)
+metrics = HandlerMetrics()
+metrics.setup(dp)
+
+# Сторож цикла событий: задержка цикла и блокирующие вызовы (LOOP_WATCHDOG=true)
+watchdog = LoopWatchdog()
+watchdog.setup(dp)
+
+# Запись входящих апдейтов для replay.py (RECORD_UPDATES)
+recorder = UpdateRecorder()
+recorder.setup(dp)
+
+# Лимит апдейтов на чат и подавление дубликатов до обработчиков и БД (ANTIFLOOD)
+antiflood = AntiFlood()
+antiflood.setup(dp)
+
+
+# Шардирование пользователей по узлам БД (DB_SHARDS); без него все данные в DB_CONFIG
+shard_router = router_from_env(lambda dsn: psycopg2.connect(dsn, connection_factory=CountingConnection))
+
+
+# Подключение к БД; при шардировании - к узлу, на котором хранятся данные chat_id
+def get_db_connection(chat_id: Optional[int] = None):
+    if shard_router is not None:
+        if chat_id is None:
+            raise ValueError("При шардировании подключение к БД требует chat_id")
+        return shard_router.connect(shard_router.shard_for(chat_id))
+    return psycopg2.connect(**DB_CONFIG, connection_factory=CountingConnection)
+
+
+# Реплики для чтения (DB_REPLICAS); используются без шардирования
+db_router = ReplicaRouter(DB_CONFIG, lambda config: psycopg2.connect(**config, connection_factory=CountingConnection))
+
+
+# Подключение для чтения данных chat_id: реплика, если она не отстает и пользователь
+# только что ничего не записывал, иначе основная БД
+def get_db_read_connection(chat_id: Optional[int] = None):
+    if shard_router is None and db_router.replicas:
+        return db_router.read_connection(chat_id)
+    return get_db_connection(chat_id)
+
+
+# Отрисованные страницы истории операций
+operations_pages = PageCache()
+
+
+# Операции пользователя изменились: читать их с основной БД и строить страницы заново
+def operations_changed(chat_id: int):
+    db_router.wrote(chat_id)
+    operations_pages.invalidate_chat(chat_id)
+
+
+def operations_written(chat_ids):
+    for chat_id in chat_ids:
+        operations_changed(chat_id)
+
+
+# Отложенная пакетная запись операций (WRITE_BUFFER=true)
+write_buffer = OperationWriteBuffer(
+    get_db_connection, shard_router.shard_for if shard_router else None, on_written=operations_written
+) if WRITE_BUFFER else None
+if write_buffer:
+    write_buffer.setup(dp)
+
+
+# Рассчитанные ряды баланса пользователей
+balance_cache = BalanceCache(get_db_read_connection)
+
+# Сколько последних месяцев показывать в /balance
+BALANCE_MONTHS = int(os.getenv('BALANCE_MONTHS', '12'))
+
 
 # Состояния для FSM
 class RegistrationStates(StatesGroup):
@@ -52,14 +155,43 @@ class OperationStates(StatesGroup):
     waiting_for_date = State()
 
 
-# Подключение к БД
-def get_db_connection():
-    return psycopg2.connect(**DB_CONFIG)
-
-
-# Инициализация БД
+# Инициализация БД: таблицы создаются на каждом узле
 def init_db():
-    conn = get_db_connection()
+    if shard_router is None:
+        init_schema(get_db_connection())
+        return
+
+    shard_router.init_directory()
+    for shard in shard_router.shards:
+        init_schema(shard_router.connect(shard))
+        # id операций разных узлов не пересекаются: при переносе пользователя они сохраняются
+        shard_router.init_sequence(shard)
+
+
+# Создание секций operations на ближайшие месяцы на каждом узле
+def maintain_partitions():
+    for shard in (shard_router.shards if shard_router else [None]):
+        conn = shard_router.connect(shard) if shard_router else get_db_connection()
+        try:
+            created = ensure_partitions(conn)
+        finally:
+            conn.close()
+        if created:
+            logging.info(f"Создано секций operations: {created}")
+
+
+# Секции создаются заранее и в работающем боте, иначе с наступлением месяца
+# без секции операции попадают в operations_default
+async def maintain_partitions_periodically():
+    while True:
+        await asyncio.sleep(PARTITION_CHECK_INTERVAL)
+        try:
+            await asyncio.to_thread(maintain_partitions)
+        except Exception as e:
+            logging.error(f"Ошибка создания секций operations: {e}")
+
+
+def init_schema(conn):
     cursor = conn.cursor()
 
     # Создание таблиц
@@ -83,14 +215,33 @@ def init_db():
         )
     ''')
 
+    # Индексы под выборки /operations: по пользователю в порядке дат
+    # и по пользователю с типом операции
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS operations_chat_date_idx
+        ON operations (chat_id, date DESC, id DESC)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS operations_chat_type_date_idx
+        ON operations (chat_id, type_operation, date DESC, id DESC)
+    ''')
+
+    # Остаток на начало для /balance после архивирования старых операций
+    create_opening_balance_table(cursor)
+
     conn.commit()
     cursor.close()
+
+    # Если operations секционирована (partitioning.py migrate), создаем секции на ближайшие месяцы
+    created = ensure_partitions(conn)
+    if created:
+        logging.info(f"Создано секций operations: {created}")
     conn.close()
 
 
 # Проверка регистрации пользователя
 def is_user_registered(chat_id: int) -> bool:
-    conn = get_db_connection()
+    conn = get_db_read_connection(chat_id)
     cursor = conn.cursor()
 
     cursor.execute(
@@ -101,23 +252,74 @@ def is_user_registered(chat_id: int) -> bool:
 
     cursor.close()
     conn.close()
+
+    # Пользователь мог только что переехать на другой узел: справочник перечитывается досрочно
+    if not result and shard_router is not None and shard_router.reload():
+        return is_user_registered(chat_id)
     return result
 
 
-# Получение курса валюты
-async def get_currency_rate(currency: str) -> Optional[float]:
+# История курса валюты: даты изменений и курсы (по возрастанию дат) и версия курсов сервиса
+class RateHistory(NamedTuple):
+    dates: list
+    rates: list
+    version: int
+
+
+# Полученные истории курсов: валюта -> (время получения, RateHistory)
+_rate_histories = {}
+
+
+# Получение истории курса валюты; в течение RATE_HISTORY_TTL используется уже полученная
+async def get_rate_history(currency: str) -> Optional[RateHistory]:
+    cached = _rate_histories.get(currency)
+    if cached and time.monotonic() - cached[0] < RATE_HISTORY_TTL:
+        return cached[1]
+    return await fetch_rate_history(currency)
+
+
+# Запрос истории курса валюты у сервиса; если история изменилась, страницы операций
+# в этой валюте сбрасываются
+async def fetch_rate_history(currency: str) -> Optional[RateHistory]:
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(f"{CURRENCY_SERVICE_URL}?currency={currency}") as response:
-                if response.status == 200:
-                    data = await response.json()
-                    return data.get('rate')
-                return None
+        async with aiohttp.ClientSession(trace_configs=[http_trace_config()]) as session:
+            async with session.get(CURRENCY_HISTORY_URL, params={"currency": currency}) as response:
+                if response.status != 200:
+                    return None
+                data = await response.json()
+                dates = [datetime.strptime(day, "%Y-%m-%d").date() for day, _ in data['history']]
+                rates = [rate for _, rate in data['history']]
+                if not dates:
+                    return None
+                history = RateHistory(dates, rates, data.get('version', 0))
+                previous = _rate_histories.get(currency)
+                _rate_histories[currency] = (time.monotonic(), history)
+                if previous and previous[1] != history:
+                    operations_pages.invalidate_currency(currency)
+                return history
     except Exception as e:
-        logging.error(f"Ошибка получения курса валюты: {e}")
+        logging.error(f"Ошибка получения истории курса валюты: {e}")
         return None
 
 
+# Истории курсов обновляются в фоне раз в RATE_HISTORY_TTL, чтобы страницы операций
+# из кэша сбрасывались при смене курсов, даже если их никто не запрашивает заново
+async def refresh_rate_histories():
+    while True:
+        await asyncio.sleep(RATE_HISTORY_TTL)
+        for currency in RATE_CURRENCIES:
+            await fetch_rate_history(currency)
+
+
+# Курс, действовавший на дату операции, или None, если дата раньше начала истории.
+# Правило то же, что у /rate?date= сервиса курсов и у /convert?as_of= в lab-6: курс до первой
+# записи не подставляется. Прошлые курсы загружаются в историю командой
+# "python currency_service.py seed-history <файл.csv>"
+def rate_on(history: RateHistory, day) -> Optional[float]:
+    position = bisect_right(history.dates, day) - 1
+    return history.rates[position] if position >= 0 else None
+
+
 # Конвертация суммы в другую валюту
 def convert_amount(amount: float, rate: float) -> float:
     return round(amount / rate, 2)
@@ -132,6 +334,7 @@ async def cmd_start(message: Message):
         "/reg - Регистрация\n"
         "/add_operation - Добавить операцию\n"
         "/operations - Просмотр операций\n"
+        "/balance - Баланс\n"
         "/lk - Личный кабинет"
     )
 
@@ -158,7 +361,7 @@ async def process_registration(message: Message, state: FSMContext):
     registration_date = datetime.now().date()
 
     try:
-        conn = get_db_connection()
+        conn = get_db_connection(chat_id)
         cursor = conn.cursor()
 
         # Сохраняем логин, chat_id и дату регистрации в БД
@@ -167,6 +370,7 @@ async def process_registration(message: Message, state: FSMContext):
             (username, chat_id, registration_date)
         )
         conn.commit()
+        db_router.wrote(chat_id)
 
         cursor.close()
         conn.close()
@@ -180,9 +384,110 @@ async def process_registration(message: Message, state: FSMContext):
         await state.clear()
 
 
+# Типы операций, которые можно указать прямо в команде /add_operation
+OPERATION_TYPES = {
+    'expense': 'РАСХОД',
+    'расход': 'РАСХОД',
+    'income': 'ДОХОД',
+    'доход': 'ДОХОД',
+}
+
+# Максимальная сумма, которая помещается в DECIMAL(10, 2)
+MAX_OPERATION_SUM = 99999999.99
+
+
+# Сумма операции из текста: положительное число, которое помещается в DECIMAL(10, 2).
+# Одна проверка для команды и пошагового ввода; ValueError содержит текст для пользователя
+def parse_amount(text: str) -> float:
+    try:
+        amount = float(text.replace(',', '.'))
+    except ValueError:
+        raise ValueError(f"неверный формат суммы \"{text}\"")
+    # Колонка DECIMAL(10, 2) хранит копейки: 0.001 записалась бы как 0.00.
+    # nan не проходит ни одно сравнение, inf больше максимума
+    amount = round(amount, 2)
+    if not 0 < amount <= MAX_OPERATION_SUM:
+        raise ValueError(f"сумма должна быть не меньше 0.01 и не больше {MAX_OPERATION_SUM:.2f}")
+    return amount
+
+
+# Разбор операций из текста команды: по одной на строку, "тип сумма ДД.ММ.ГГГГ"
+def parse_operations(text: str) -> tuple:
+    operations = []
+    errors = []
+    for line_number, line in enumerate(text.splitlines(), start=1):
+        parts = line.split()
+        if not parts:
+            continue
+        if len(parts) != 3:
+            errors.append(f"Строка {line_number}: ожидается \"тип сумма дата\"")
+            continue
+
+        type_str, amount_str, date_str = parts
+        operation_type = OPERATION_TYPES.get(type_str.lower())
+        if operation_type is None:
+            errors.append(f"Строка {line_number}: неизвестный тип операции \"{type_str}\"")
+            continue
+        try:
+            amount = parse_amount(amount_str)
+        except ValueError as e:
+            errors.append(f"Строка {line_number}: {e}")
+            continue
+        try:
+            operation_date = datetime.strptime(date_str, "%d.%m.%Y").date()
+        except ValueError:
+            errors.append(f"Строка {line_number}: неверный формат даты \"{date_str}\", используйте ДД.ММ.ГГГГ")
+            continue
+
+        operations.append((operation_date, amount, operation_type))
+    return operations, errors
+
+
+# Пользователь мог переехать на другой узел, пока справочник узлов в памяти бота старый:
+# запись на прежнем узле отклоняется внешним ключом, т.к. строки users там уже нет.
+# Тогда справочник перечитывается и запись повторяется (см. sharding.py)
+def reroute_after_move(error: Exception) -> bool:
+    if shard_router is None or not isinstance(error, psycopg2.errors.ForeignKeyViolation):
+        return False
+    shard_router.reload()
+    return True
+
+
+def insert_operations(chat_id: int, operations: list):
+    conn = get_db_connection(chat_id)
+    try:
+        cursor = conn.cursor()
+        rows = [(operation_date, amount, chat_id, operation_type) for operation_date, amount, operation_type in operations]
+        # page_size по числу строк: все операции уходят одним INSERT, а не пачками по 100
+        psycopg2.extras.execute_values(
+            cursor,
+            "INSERT INTO operations (date, sum, chat_id, type_operation) VALUES %s",
+            rows,
+            page_size=len(rows)
+        )
+        conn.commit()
+        cursor.close()
+    finally:
+        conn.close()
+
+
+# Сохранение нескольких операций одним запросом
+def save_operations(chat_id: int, operations: list):
+    try:
+        insert_operations(chat_id, operations)
+    except psycopg2.Error as e:
+        if not reroute_after_move(e):
+            raise
+        insert_operations(chat_id, operations)
+    operations_changed(chat_id)
+
+
 # Обработчик команды /add_operation (2.1.3 Добавление новой операции)
+# С аргументами операции добавляются сразу, например:
+#   /add_operation expense 1500 15.11.2024
+# или по одной на строку в многострочном сообщении
 @dp.message(Command("add_operation"))
-async def cmd_add_operation(message: Message, state: FSMContext):
+async def cmd_add_operation(message: Message, state: FSMContext, command: CommandObject):
     chat_id = message.chat.id
 
     # Проверяем регистрацию
@@ -190,6 +495,33 @@ async def cmd_add_operation(message: Message, state: FSMContext):
         await message.answer("Сначала необходимо зарегистрироваться. Используйте команду /reg")
         return
 
+    if command.args:
+        operations, errors = parse_operations(command.args)
+        if errors:
+            # Все операции проверяются вместе: при любой ошибке не сохраняется ни одна
+            await message.answer(
+                "Операции не добавлены:\n" + "\n".join(errors) +
+                "\n\nФормат: /add_operation expense|income сумма ДД.ММ.ГГГГ, по одной операции на строку"
+            )
+            return
+        if not operations:
+            await message.answer("Не найдено ни одной операции.")
+            return
+
+        try:
+            save_operations(chat_id, operations)
+        except Exception as e:
+            logging.error(f"Ошибка добавления операций: {e}")
+            await message.answer("Произошла ошибка при добавлении операций.")
+            return
+
+        await state.clear()
+        if len(operations) == 1:
+            await message.answer("Операция успешно добавлена!")
+        else:
+            await message.answer(f"Добавлено операций: {len(operations)}")
+        return
+
     # Создаем кнопки для выбора типа операции
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [
@@ -216,19 +548,26 @@ async def process_operation_type(callback: CallbackQuery, state: FSMContext):
 @dp.message(OperationStates.waiting_for_amount) # Ловит сообщения только в состоянии waiting_for_amount
 async def process_operation_amount(message: Message, state: FSMContext):
     try:
-        amount = float(message.text.replace(',', '.'))
-        if amount <= 0:
-            await message.answer("Сумма должна быть положительной. Введите сумму заново:")
-            return
+        amount = parse_amount(message.text or "")
+    except ValueError as e:
+        await message.answer(f"{str(e).capitalize()}. Введите сумму заново:")
+        return
 
-        # Сохраняем сумму в состоянии
-        await state.update_data(amount=amount)
+    # Сохраняем сумму в состоянии
+    await state.update_data(amount=amount)
 
-        await message.answer("Введите дату операции в формате ДД.ММ.ГГГГ (например, 15.11.2024):")
-        await state.set_state(OperationStates.waiting_for_date)
+    await message.answer("Введите дату операции в формате ДД.ММ.ГГГГ (например, 15.11.2024):")
+    await state.set_state(OperationStates.waiting_for_date)
 
-    except ValueError:
-        await message.answer("Неверный формат суммы. Введите числовое значение:")
+
+# Сохранение операции в БД: через буфер - вместе с другими операциями пакетом
+async def store_operation(operation_date, amount, chat_id: int, operation_type: str):
+    if write_buffer:
+        # О записанном пакете буфер сообщает сам (on_written -> operations_written)
+        await write_buffer.add(operation_date, amount, chat_id, operation_type)
+    else:
+        insert_operations(chat_id, [(operation_date, amount, operation_type)])
+        operations_changed(chat_id)
 
 
 @dp.message(OperationStates.waiting_for_date) # Обработчик ввода даты
@@ -244,18 +583,12 @@ async def process_operation_date(message: Message, state: FSMContext):
         amount = data['amount']
         chat_id = message.chat.id
 
-        # Сохраняем операцию в БД
-        conn = get_db_connection()
-        cursor = conn.cursor()
-
-        cursor.execute(
-            "INSERT INTO operations (date, sum, chat_id, type_operation) VALUES (%s, %s, %s, %s)",
-            (operation_date, amount, chat_id, operation_type)
-        )
-        conn.commit()
-
-        cursor.close()
-        conn.close()
+        try:
+            await store_operation(operation_date, amount, chat_id, operation_type)
+        except psycopg2.Error as e:
+            if not reroute_after_move(e):
+                raise
+            await store_operation(operation_date, amount, chat_id, operation_type)
 
         await message.answer("Операция успешно добавлена!")
         await state.clear()
@@ -268,9 +601,155 @@ async def process_operation_date(message: Message, state: FSMContext):
         await state.clear()
 
 
+# Размер страницы в /operations
+OPERATIONS_PAGE_SIZE = int(os.getenv('OPERATIONS_PAGE_SIZE', '10'))
+
+
+# Сумма без лишних нулей: 1500.0 -> "1500", 0.5 -> "0.5"
+def format_sum(value: float) -> str:
+    return f"{value:.2f}".rstrip('0').rstrip('.')
+
+
+# Telegram ограничивает callback_data 64 байтами; кнопка страницы - "ops:RUB:<страница>:<фильтр>",
+# на префикс с номером страницы до 99999 оставляется 14 байт
+MAX_ENCODED_FILTER = 64 - len("ops:RUB:99999:")
+
+
+# Фильтр операций; пустое поле - условие не применяется
+class OperationFilter(NamedTuple):
+    date_from: Optional[object] = None
+    date_to: Optional[object] = None
+    operation_type: Optional[str] = None
+    min_sum: Optional[float] = None
+    max_sum: Optional[float] = None
+
+    # Компактная запись для callback_data (Telegram ограничивает ее 64 байтами)
+    def encode(self) -> str:
+        return ",".join([
+            self.date_from.strftime("%Y%m%d") if self.date_from else "",
+            self.date_to.strftime("%Y%m%d") if self.date_to else "",
+            {"ДОХОД": "I", "РАСХОД": "E"}.get(self.operation_type, ""),
+            format_sum(self.min_sum) if self.min_sum is not None else "",
+            format_sum(self.max_sum) if self.max_sum is not None else "",
+        ])
+
+    @classmethod
+    def decode(cls, value: str) -> "OperationFilter":
+        if not value:
+            return cls()
+        if len(value.encode()) > MAX_ENCODED_FILTER:
+            raise ValueError("слишком длинный фильтр")
+        date_from, date_to, operation_type, min_sum, max_sum = value.split(",")
+        return cls(
+            datetime.strptime(date_from, "%Y%m%d").date() if date_from else None,
+            datetime.strptime(date_to, "%Y%m%d").date() if date_to else None,
+            {"I": "ДОХОД", "E": "РАСХОД"}.get(operation_type),
+            float(min_sum) if min_sum else None,
+            float(max_sum) if max_sum else None,
+        )
+
+    def describe(self) -> str:
+        conditions = []
+        if self.date_from:
+            conditions.append(f"с {self.date_from.strftime('%d.%m.%Y')}")
+        if self.date_to:
+            conditions.append(f"по {self.date_to.strftime('%d.%m.%Y')}")
+        if self.operation_type:
+            conditions.append(self.operation_type)
+        if self.min_sum is not None:
+            conditions.append(f"от {format_sum(self.min_sum)} руб.")
+        if self.max_sum is not None:
+            conditions.append(f"до {format_sum(self.max_sum)} руб.")
+        return ", ".join(conditions)
+
+
+# Разбор фильтра из аргументов /operations:
+#   /operations from=01.01.2024 to=31.12.2024 type=расход min=100 max=5000
+# Тип можно указать и без ключа: /operations доход
+def parse_operation_filter(text: str) -> OperationFilter:
+    values = {}
+    for token in text.split():
+        key, _, value = token.partition("=")
+        key = key.lower()
+        if not value and key in OPERATION_TYPES:
+            key, value = "type", key
+
+        if key in ("from", "to"):
+            try:
+                values["date_" + key] = datetime.strptime(value, "%d.%m.%Y").date()
+            except ValueError:
+                raise ValueError(f"неверный формат даты \"{value}\", используйте ДД.ММ.ГГГГ")
+        elif key == "type":
+            if value.lower() not in OPERATION_TYPES:
+                raise ValueError(f"неизвестный тип операции \"{value}\"")
+            values["operation_type"] = OPERATION_TYPES[value.lower()]
+        elif key in ("min", "max"):
+            try:
+                amount = float(value.replace(',', '.'))
+            except ValueError:
+                raise ValueError(f"неверный формат суммы \"{value}\"")
+            # Суммы операций лежат в этих пределах; заодно граница не раздувает callback_data
+            if not 0 <= amount <= MAX_OPERATION_SUM:
+                raise ValueError(f"сумма в фильтре должна быть от 0 до {MAX_OPERATION_SUM:.2f}")
+            # В кнопках сумма записывается с точностью до копеек: иначе со второй
+            # страницы применялся бы уже округленный фильтр
+            if round(amount, 2) != amount:
+                raise ValueError(f"сумма в фильтре \"{value}\" должна быть с точностью до копеек")
+            values[key + "_sum"] = amount
+        else:
+            raise ValueError(f"неизвестный параметр \"{token}\"")
+
+    operation_filter = OperationFilter(**values)
+    # Фильтр передается в кнопках страниц и должен поместиться в callback_data
+    if len(operation_filter.encode().encode()) > MAX_ENCODED_FILTER:
+        raise ValueError("слишком длинный фильтр")
+    return operation_filter
+
+
+# Страница операций пользователя по фильтру и общее число подходящих операций.
+# Условия передаются в SQL, чтобы выборка шла по индексам, а не через Python
+def fetch_operations_page(chat_id: int, operation_filter: OperationFilter, page: int) -> tuple:
+    conditions = ["chat_id = %s"]
+    params = [chat_id]
+    if operation_filter.operation_type:
+        conditions.append("type_operation = %s")
+        params.append(operation_filter.operation_type)
+    if operation_filter.date_from:
+        conditions.append("date >= %s")
+        params.append(operation_filter.date_from)
+    if operation_filter.date_to:
+        conditions.append("date <= %s")
+        params.append(operation_filter.date_to)
+    if operation_filter.min_sum is not None:
+        conditions.append("sum >= %s")
+        params.append(operation_filter.min_sum)
+    if operation_filter.max_sum is not None:
+        conditions.append("sum <= %s")
+        params.append(operation_filter.max_sum)
+    where = " AND ".join(conditions)
+
+    conn = get_db_read_connection(chat_id)
+    cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+
+    cursor.execute(f"SELECT COUNT(*) FROM operations WHERE {where}", params)
+    total = cursor.fetchone()[0]
+
+    cursor.execute(
+        f"SELECT id, date, sum, type_operation FROM operations WHERE {where} "
+        "ORDER BY date DESC, id DESC LIMIT %s OFFSET %s",
+        params + [OPERATIONS_PAGE_SIZE, page * OPERATIONS_PAGE_SIZE]
+    )
+    operations = cursor.fetchall()
+
+    cursor.close()
+    conn.close()
+    return operations, total
+
+
 # Обработчик команды /operations (2.1.4 Просмотр операций пользователя)
+# Необязательные аргументы задают фильтр
 @dp.message(Command("operations"))
-async def cmd_operations(message: Message, state: FSMContext):
+async def cmd_operations(message: Message, state: FSMContext, command: CommandObject):
     chat_id = message.chat.id
 
     # Проверяем регистрацию
@@ -278,67 +757,125 @@ async def cmd_operations(message: Message, state: FSMContext):
         await message.answer("Сначала необходимо зарегистрироваться. Используйте команду /reg")
         return
 
+    try:
+        operation_filter = parse_operation_filter(command.args or "")
+    except ValueError as e:
+        await message.answer(
+            f"Ошибка в фильтре: {e}\n\n"
+            "Формат: /operations from=ДД.ММ.ГГГГ to=ДД.ММ.ГГГГ type=доход|расход min=сумма max=сумма"
+        )
+        return
+
+    # Фильтр передается в callback_data, чтобы его не приходилось хранить в состоянии
+    encoded_filter = operation_filter.encode()
+
     # Создаем кнопки для выбора валюты
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [
-            InlineKeyboardButton(text="RUB", callback_data="currency_RUB"),
-            InlineKeyboardButton(text="EUR", callback_data="currency_EUR"),
-            InlineKeyboardButton(text="USD", callback_data="currency_USD")
+            InlineKeyboardButton(text=currency, callback_data=f"ops:{currency}:0:{encoded_filter}")
+            for currency in ("RUB", "EUR", "USD")
         ]
     ])
 
     await message.answer("Выберите валюту для отображения операций:", reply_markup=keyboard)
 
 
-@dp.callback_query(F.data.in_(["currency_RUB", "currency_EUR", "currency_USD"]))
-async def process_currency_selection(callback: CallbackQuery):
-    currency = callback.data.split("_")[1] # разделяет callback_data и берет второй элемент
-    chat_id = callback.message.chat.id
+OPERATION_TEMPLATE = "📅 {date:%d.%m.%Y}\n💰 {amount}\n📊 {type}\n🆔 ID: {id}\n\n"
 
-    try:
-        # Получаем курс валюты, если не RUB
-        rate = 1.0 # для RUB
-        if currency in ["EUR", "USD"]:
-            rate = await get_currency_rate(currency)
-            if rate is None:
-                await callback.message.edit_text("Ошибка получения курса валюты. Попробуйте позже.")
-                await callback.answer()
-                return
-
-        # Получаем операции пользователя
-        conn = get_db_connection()
-        cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
 
-        cursor.execute(
-            "SELECT id, date, sum, type_operation FROM operations WHERE chat_id = %s ORDER BY date DESC",
-            (chat_id,)
+# Сумма операции в выбранной валюте; если курс на дату операции неизвестен - в рублях
+def operation_amount(operation, currency: str, history: Optional[RateHistory]) -> str:
+    amount = float(operation['sum'])
+    if history is None:
+        return f"{amount:.2f} {currency}"
+    rate = rate_on(history, operation['date'])
+    if rate is None:
+        return f"{amount:.2f} RUB (курс {currency} на эту дату неизвестен)"
+    return f"{convert_amount(amount, rate):.2f} {currency}"
+
+
+# Текст и кнопки страницы операций
+def render_operations_page(operations, total: int, currency: str, page: int,
+                           operation_filter: OperationFilter, history: Optional[RateHistory]) -> tuple:
+    if not total:
+        if operation_filter != OperationFilter():
+            return f"Нет операций по фильтру: {operation_filter.describe()}.", None
+        return "У вас пока нет операций.", None
+
+    pages = (total + OPERATIONS_PAGE_SIZE - 1) // OPERATIONS_PAGE_SIZE
+
+    header = f"Ваши операции (в {currency}):\n"
+    if operation_filter != OperationFilter():
+        header += f"Фильтр: {operation_filter.describe()}\n"
+    header += f"Найдено: {total}, страница {page + 1} из {pages}\n\n"
+
+    # Строки операций собираются одним join по общему шаблону
+    response = header + "".join(
+        OPERATION_TEMPLATE.format(
+            date=operation['date'],
+            amount=operation_amount(operation, currency, history),
+            type=operation['type_operation'],
+            id=operation['id'],
         )
-        operations = cursor.fetchall()
+        for operation in operations
+    )
 
-        cursor.close()
-        conn.close()
+    # Ограничиваем длину сообщения
+    if len(response) > 4000:
+        response = response[:4000] + "\n... (уменьшите OPERATIONS_PAGE_SIZE)"
 
-        if not operations:
-            await callback.message.edit_text("У вас пока нет операций.")
-            await callback.answer()
-            return
+    # Кнопки перехода между страницами
+    encoded_filter = operation_filter.encode()
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton(text="⬅️ Назад", callback_data=f"ops:{currency}:{page - 1}:{encoded_filter}"))
+    if page + 1 < pages:
+        buttons.append(InlineKeyboardButton(text="Далее ➡️", callback_data=f"ops:{currency}:{page + 1}:{encoded_filter}"))
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[buttons]) if buttons else None
 
-        # Формируем сообщение с операциями
-        response = f"Ваши операции (в {currency}):\n\n"
+    return response, keyboard
 
-        for operation in operations:
-            converted_amount = convert_amount(float(operation['sum']), rate) if currency != "RUB" else float(
-                operation['sum'])
-            response += f"📅 {operation['date'].strftime('%d.%m.%Y')}\n"
-            response += f"💰 {converted_amount:.2f} {currency}\n"
-            response += f"📊 {operation['type_operation']}\n"
-            response += f"🆔 ID: {operation['id']}\n\n"
 
-        # Ограничиваем длину сообщения
-        if len(response) > 4000:
-            response = response[:4000] + "\n... (показаны последние операции)"
+@dp.callback_query(F.data.startswith("ops:") | F.data.in_(["currency_RUB", "currency_EUR", "currency_USD"]))
+async def process_currency_selection(callback: CallbackQuery):
+    # Кнопки старых сообщений (currency_XXX) открывают первую страницу без фильтра
+    if callback.data.startswith("currency_"):
+        currency, page, operation_filter = callback.data.split("_")[1], 0, OperationFilter()
+    else:
+        try:
+            _, currency, page, encoded_filter = callback.data.split(":", 3)
+            page, operation_filter = int(page), OperationFilter.decode(encoded_filter)
+        except ValueError:
+            # Кнопку сформировал не бот или старая версия бота
+            await callback.answer("Кнопка устарела, запросите /operations заново")
+            return
+    chat_id = callback.message.chat.id
 
-        await callback.message.edit_text(response)
+    try:
+        # Страница из кэша показывается без запросов к БД и сервису курсов:
+        # при записи операций и смене курсов она сбрасывается
+        key = (chat_id, currency, page, operation_filter)
+        rendered = operations_pages.get(key)
+        if rendered is None:
+            # Получаем историю курса валюты, если не RUB: каждая операция
+            # конвертируется по курсу на дату операции
+            history = None
+            if currency in RATE_CURRENCIES:
+                history = await get_rate_history(currency)
+                if history is None:
+                    await callback.message.edit_text("Ошибка получения курса валюты. Попробуйте позже.")
+                    await callback.answer()
+                    return
+
+            operations, total = fetch_operations_page(chat_id, operation_filter, page)
+            # Пусто может быть потому, что пользователь только что переехал на другой узел
+            if not total and shard_router is not None and shard_router.reload():
+                operations, total = fetch_operations_page(chat_id, operation_filter, page)
+            rendered = render_operations_page(operations, total, currency, page, operation_filter, history)
+            operations_pages.put(key, rendered)
+
+        response, keyboard = rendered
+        await callback.message.edit_text(response, reply_markup=keyboard)
         await callback.answer()
 
     except Exception as e:
@@ -347,6 +884,35 @@ async def process_currency_selection(callback: CallbackQuery):
         await callback.answer()
 
 
+# Обработчик команды /balance: текущий баланс и баланс на конец месяца
+@dp.message(Command("balance"))
+async def cmd_balance(message: Message):
+    chat_id = message.chat.id
+
+    # Проверяем регистрацию
+    if not is_user_registered(chat_id):
+        await message.answer("Сначала необходимо зарегистрироваться. Используйте команду /reg")
+        return
+
+    try:
+        series = balance_cache.get(chat_id)
+
+        if not series.dates:
+            await message.answer("У вас пока нет операций.")
+            return
+
+        response = f"💼 Текущий баланс: {series.balance:.2f} RUB\n\n"
+        response += "Баланс на конец месяца:\n"
+        for (year, month), balance in series.monthly(BALANCE_MONTHS):
+            response += f"📅 {month:02d}.{year}: {balance:.2f} RUB\n"
+
+        await message.answer(response)
+
+    except Exception as e:
+        logging.error(f"Ошибка расчета баланса: {e}")
+        await message.answer("Произошла ошибка при расчете баланса.")
+
+
 # Обработчик команды /lk (Личный кабинет - Вариант 11)
 @dp.message(Command("lk"))
 async def cmd_personal_cabinet(message: Message):
@@ -358,7 +924,7 @@ async def cmd_personal_cabinet(message: Message):
         return
 
     try:
-        conn = get_db_connection()
+        conn = get_db_read_connection(chat_id)
         cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
 
         # Получаем информацию о пользователе
@@ -399,6 +965,23 @@ async def cmd_personal_cabinet(message: Message):
         await message.answer("Произошла ошибка при получении информации.")
 
 
+# Фоновые задачи бота: обновление курсов и обслуживание секций operations
+_background_tasks = []
+
+
+@dp.startup()
+async def start_background_tasks():
+    _background_tasks.append(asyncio.create_task(refresh_rate_histories()))
+    _background_tasks.append(asyncio.create_task(maintain_partitions_periodically()))
+
+
+@dp.shutdown()
+async def stop_background_tasks():
+    for task in _background_tasks:
+        task.cancel()
+    _background_tasks.clear()
+
+
 # Главная функция
 async def main():
     # Проверка наличия обязательных переменных окружения
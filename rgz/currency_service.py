@@ -1,14 +1,351 @@
+import asyncio
+import csv
+import io
+import json
+import math
 import os
-from flask import Flask, request, jsonify
+import sys
+import threading
+import time
+import urllib.request
+from bisect import bisect_right
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime
+from types import MappingProxyType
+from urllib.parse import unquote
+from flask import Flask, Response, request, jsonify
+
+# Быстрый JSON-кодировщик, если установлен
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 app = Flask(__name__)
 
-# Статические курсы валют
+# Статические курсы валют (используются, пока источник курсов не задан или недоступен)
 CURRENCY_RATES = {
     'USD': 79.60,
     'EUR': 89.71
 }
 
+# Файл истории курсов (CSV со столбцами currency,date,rate; дата в формате ГГГГ-ММ-ДД).
+# Загружается при запуске, обновленные курсы дописываются в него; пустое значение - история только в памяти.
+# Курсы прошлых дат загружаются командой seed-history (см. seed_history)
+RATE_HISTORY_FILE = os.getenv('RATE_HISTORY_FILE', 'rate_history.csv')
+
+# Источник актуальных курсов: путь к JSON-файлу или http(s)-адрес.
+# Формат: {"USD": 79.6, "EUR": 89.71} или {"date": "ГГГГ-ММ-ДД", "rates": {...}}
+RATES_SOURCE = os.getenv('RATES_SOURCE')
+RATES_REFRESH_INTERVAL = float(os.getenv('RATES_REFRESH_INTERVAL', '60'))
+
+# Режим запуска: development - встроенный сервер Flask, production - gunicorn
+SERVICE_MODE = os.getenv('CURRENCY_SERVICE_MODE', 'development')
+SERVICE_WORKERS = int(os.getenv('CURRENCY_SERVICE_WORKERS', str((os.cpu_count() or 1) * 2 + 1)))
+SERVICE_THREADS = int(os.getenv('CURRENCY_SERVICE_THREADS', '4'))
+SERVICE_KEEPALIVE = int(os.getenv('CURRENCY_SERVICE_KEEPALIVE', '5'))
+
+# В режиме production курсы обновляет один процесс (master gunicorn) и записывает
+# снимок в этот файл; воркеры сверяют время изменения файла не чаще раза в
+# SNAPSHOT_CHECK_INTERVAL секунд и загружают новый снимок
+RATES_SNAPSHOT_FILE = os.getenv('RATES_SNAPSHOT_FILE', 'rates_snapshot.json')
+SNAPSHOT_CHECK_INTERVAL = float(os.getenv('SNAPSHOT_CHECK_INTERVAL', '1'))
+
+
+class RateHistory:
+    """
+    История курсов в виде временного ряда
+
+    По каждой валюте хранятся отсортированные даты изменения курса и сами курсы,
+    одна запись на изменение. Курс на дату ищется двоичным поиском.
+    """
+
+    def __init__(self):
+        self.dates = {}
+        self.rates = {}
+
+    def add(self, currency, day, rate) -> bool:
+        """Добавляет курс, действующий с даты day (повтор предыдущего курса не сохраняется).
+
+        Возвращает True, если история изменилась.
+        """
+        dates = self.dates.setdefault(currency, [])
+        rates = self.rates.setdefault(currency, [])
+        position = bisect_right(dates, day)
+
+        if position > 0 and dates[position - 1] == day:
+            changed = rates[position - 1] != rate
+            rates[position - 1] = rate
+            return changed
+        if position > 0 and rates[position - 1] == rate:
+            return False
+
+        dates.insert(position, day)
+        rates.insert(position, rate)
+        return True
+
+    def rate_on(self, currency, day):
+        """Курс на дату day или None, если дата вне истории: раньше первой записи или в будущем"""
+        dates = self.dates.get(currency)
+        if not dates or day > max(date.today(), dates[-1]):
+            return None
+        position = bisect_right(dates, day) - 1
+        if position < 0:
+            return None
+        return self.rates[currency][position]
+
+    def series(self, currency):
+        """Весь ряд валюты: [[дата ISO, курс], ...]"""
+        return [
+            [day.isoformat(), rate]
+            for day, rate in zip(self.dates.get(currency, []), self.rates.get(currency, []))
+        ]
+
+    def copy(self):
+        history = RateHistory()
+        history.dates = {currency: list(dates) for currency, dates in self.dates.items()}
+        history.rates = {currency: list(rates) for currency, rates in self.rates.items()}
+        return history
+
+    def load_csv(self, path):
+        with open(path, newline='', encoding='utf-8') as f:
+            for row in csv.DictReader(f):
+                day = datetime.strptime(row['date'], "%Y-%m-%d").date()
+                self.add(row['currency'].upper(), day, float(row['rate']))
+
+
+def write_history(path, history):
+    """Записывает всю историю в файл заново (через временный файл)"""
+    temporary = f"{path}.tmp"
+    with open(temporary, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(['currency', 'date', 'rate'])
+        for currency in sorted(history.dates):
+            for day, rate in zip(history.dates[currency], history.rates[currency]):
+                writer.writerow([currency, day.isoformat(), rate])
+    os.replace(temporary, path)
+
+
+def seed_history(source, path=RATE_HISTORY_FILE) -> int:
+    """Добавляет в файл истории курсы прошлых дат из CSV (currency,date,rate).
+
+    Без этого история статических курсов начинается с первого запуска сервиса, и
+    на более ранние даты курс неизвестен. Запускать, пока сервис остановлен.
+    Возвращает число добавленных или измененных записей.
+    """
+    history = RateHistory()
+    if os.path.exists(path):
+        history.load_csv(path)
+    new_file = not history.dates
+
+    added = 0
+    with open(source, newline='', encoding='utf-8') as f:
+        for line_number, row in enumerate(csv.DictReader(f), start=2):
+            try:
+                day = datetime.strptime(row['date'], "%Y-%m-%d").date()
+                rate = float(row['rate'])
+                ((currency, rate),) = validate_rates({row['currency']: rate}).items()
+            except (KeyError, TypeError, ValueError) as e:
+                raise ValueError(f"{source}, строка {line_number}: {e}")
+            added += history.add(currency, day, rate)
+
+    # Файла еще не было: статические курсы действуют с сегодняшнего дня, как при первом запуске,
+    # иначе текущими курсами сервиса стали бы последние загруженные
+    if new_file:
+        for currency, rate in CURRENCY_RATES.items():
+            dates = history.dates.get(currency)
+            if not dates or dates[-1] < date.today():
+                added += history.add(currency, date.today(), rate)
+
+    write_history(path, history)
+    return added
+
+
+def append_history(path, day, rates, new_file: bool):
+    """Дописывает курсы в файл истории, чтобы они пережили перезапуск сервиса"""
+    with open(path, 'a', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        if new_file:
+            writer.writerow(['currency', 'date', 'rate'])
+        for currency, rate in rates.items():
+            writer.writerow([currency, day.isoformat(), rate])
+
+
+def render(payload) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(payload, option=orjson.OPT_APPEND_NEWLINE)
+    return json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode('utf-8') + b'\n'
+
+
+UNKNOWN_CURRENCY_RESPONSE = render({"message": "UNKNOWN CURRENCY"})
+
+# Неизменяемый снимок курсов: текущие курсы, история и заранее
+# сериализованные ответы. Заменяется целиком при каждом обновлении.
+RatesSnapshot = namedtuple(
+    'RatesSnapshot',
+    ['version', 'rates', 'history', 'rate_responses', 'history_responses', 'index_response']
+)
+
+
+def build_snapshot(version, rates, history):
+    """Собирает снимок и один раз сериализует все ответы, не зависящие от запроса"""
+    return RatesSnapshot(
+        version=version,
+        rates=MappingProxyType(dict(rates)),
+        history=history,
+        rate_responses=MappingProxyType({
+            currency: render({"rate": rate}) for currency, rate in rates.items()
+        }),
+        history_responses=MappingProxyType({
+            currency: render({"currency": currency, "version": version, "history": history.series(currency)})
+            for currency in rates
+        }),
+        index_response=render(index_payload(version, rates))
+    )
+
+
+def validate_rates(rates) -> dict:
+    """Проверяет курсы из источника: непустой словарь "код из 3 букв" -> положительное число"""
+    if not isinstance(rates, dict) or not rates:
+        raise ValueError("ожидается непустой словарь курсов")
+
+    result = {}
+    for currency, rate in rates.items():
+        if not isinstance(currency, str) or len(currency) != 3 or not currency.isalpha():
+            raise ValueError(f"некорректный код валюты: {currency!r}")
+        if isinstance(rate, bool) or not isinstance(rate, (int, float)) or not math.isfinite(rate) or rate <= 0:
+            raise ValueError(f"некорректный курс {currency}: {rate!r}")
+        result[currency.upper()] = float(rate)
+    return result
+
+
+def load_rates(source):
+    """Загружает курсы из файла или по HTTP, возвращает (дата курсов, курсы)"""
+    if source.startswith(('http://', 'https://')):
+        with urllib.request.urlopen(source, timeout=10) as response:
+            data = json.load(response)
+    else:
+        with open(source, encoding='utf-8') as f:
+            data = json.load(f)
+
+    day = date.today()
+    if isinstance(data, dict) and 'rates' in data:
+        if data.get('date'):
+            day = datetime.strptime(data['date'], "%Y-%m-%d").date()
+        data = data['rates']
+    return day, validate_rates(data)
+
+
+def refresh_rates():
+    """Загружает курсы из RATES_SOURCE и атомарно подменяет снимок, если курсы изменились"""
+    global SNAPSHOT
+
+    day, rates = load_rates(RATES_SOURCE)
+    current = SNAPSHOT
+    if dict(current.rates) == rates:
+        return False
+
+    history = current.history.copy()
+    changed = {currency: rate for currency, rate in rates.items() if history.add(currency, day, rate)}
+
+    # Сначала история сохраняется: при ошибке записи снимок не меняется, и обновление повторится.
+    # Новый файл получает все курсы, дальше дописываются только изменившиеся
+    if RATE_HISTORY_FILE:
+        new_file = not os.path.exists(RATE_HISTORY_FILE) or os.path.getsize(RATE_HISTORY_FILE) == 0
+        if new_file or changed:
+            append_history(RATE_HISTORY_FILE, day, rates if new_file else changed, new_file)
+
+    SNAPSHOT = build_snapshot(current.version + 1, rates, history)
+    if _shared_snapshot_file:
+        write_snapshot(SNAPSHOT, _shared_snapshot_file)
+    return True
+
+
+# Файл общего снимка курсов (только в режиме production)
+_shared_snapshot_file = None
+_snapshot_checked_at = 0.0
+_snapshot_mtime = None
+
+
+def write_snapshot(snapshot, path):
+    """Атомарно записывает снимок курсов в файл: читатели видят старый или новый файл целиком"""
+    payload = {
+        "version": snapshot.version,
+        "rates": dict(snapshot.rates),
+        "history": {currency: snapshot.history.series(currency) for currency in snapshot.history.dates},
+    }
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(payload, f, ensure_ascii=False)
+    os.replace(temp_path, path)
+
+
+def read_snapshot(path):
+    with open(path, encoding='utf-8') as f:
+        payload = json.load(f)
+    history = RateHistory()
+    for currency, series in payload['history'].items():
+        for day, rate in series:
+            history.add(currency, datetime.strptime(day, "%Y-%m-%d").date(), rate)
+    return build_snapshot(payload['version'], payload['rates'], history)
+
+
+def current_snapshot():
+    """Актуальный снимок курсов; в воркере production сверяется с общим файлом снимка"""
+    global SNAPSHOT, _snapshot_checked_at, _snapshot_mtime
+
+    if _shared_snapshot_file is None or time.monotonic() - _snapshot_checked_at < SNAPSHOT_CHECK_INTERVAL:
+        return SNAPSHOT
+    _snapshot_checked_at = time.monotonic()
+
+    try:
+        mtime = os.stat(_shared_snapshot_file).st_mtime_ns
+        if mtime != _snapshot_mtime:
+            snapshot = read_snapshot(_shared_snapshot_file)
+            _snapshot_mtime = mtime
+            if snapshot.version > SNAPSHOT.version:
+                SNAPSHOT = snapshot
+    except (OSError, ValueError, KeyError) as e:
+        # Продолжаем отдавать текущий снимок
+        print(f"Ошибка чтения снимка курсов {_shared_snapshot_file}: {e}")
+    return SNAPSHOT
+
+
+def refresh_loop(stop_event: threading.Event):
+    while not stop_event.is_set():
+        try:
+            if refresh_rates():
+                print(f"📊 Курсы обновлены, версия {SNAPSHOT.version}: {dict(SNAPSHOT.rates)}")
+        except Exception as e:
+            # При ошибке продолжаем отдавать предыдущий снимок
+            print(f"Ошибка обновления курсов из {RATES_SOURCE}: {e}")
+        stop_event.wait(RATES_REFRESH_INTERVAL)
+
+
+def start_refresher():
+    """Запускает фоновое обновление курсов, если задан RATES_SOURCE"""
+    stop_event = threading.Event()
+    if RATES_SOURCE:
+        threading.Thread(target=refresh_loop, args=(stop_event,), name='rates-refresher', daemon=True).start()
+    return stop_event
+
+
+def initial_snapshot():
+    history = RateHistory()
+    if RATE_HISTORY_FILE and os.path.exists(RATE_HISTORY_FILE):
+        history.load_csv(RATE_HISTORY_FILE)
+    if history.rates:
+        # Текущие курсы - последние записи истории
+        rates = {currency: values[-1] for currency, values in history.rates.items()}
+    else:
+        rates = CURRENCY_RATES
+        # Статические курсы известны только с момента запуска: на прошлые даты курс неизвестен,
+        # пока их не загрузят командой seed-history
+        for currency, rate in rates.items():
+            history.add(currency, date.today(), rate)
+    return build_snapshot(1, rates, history)
+
 
 @app.route('/rate', methods=['GET'])
 def get_currency_rate():
@@ -17,10 +354,12 @@ def get_currency_rate():
 
     Параметры:
     - currency: валюта (USD или EUR)
+    - date: дата в формате ГГГГ-ММ-ДД, на которую нужен курс (необязательно)
 
     Возвращает:
     - 200: {"rate": курс}
     - 400: {"message": "UNKNOWN CURRENCY"}
+    - 404: {"message": "RATE NOT AVAILABLE"} - дата вне истории курсов
     - 500: {"message": "UNEXPECTED ERROR"}
     """
 
@@ -30,18 +369,32 @@ def get_currency_rate():
 
         # Проверяем, что параметр передан
         if not currency:
-            return jsonify({"message": "UNKNOWN CURRENCY"}), 400
+            return Response(UNKNOWN_CURRENCY_RESPONSE, status=400, mimetype='application/json')
 
         # Приводим к верхнему регистру
         currency = currency.upper()
 
+        # Снимок читается один раз, чтобы весь запрос обслуживался одной версией курсов
+        snapshot = current_snapshot()
+
         # Проверяем, что валюта поддерживается
-        if currency not in CURRENCY_RATES:
-            return jsonify({"message": "UNKNOWN CURRENCY"}), 400
+        if currency not in snapshot.rates:
+            return Response(UNKNOWN_CURRENCY_RESPONSE, status=400, mimetype='application/json')
+
+        # Курс на указанную дату
+        day = request.args.get('date')
+        if day:
+            try:
+                day = datetime.strptime(day, "%Y-%m-%d").date()
+            except ValueError:
+                return jsonify({"message": "INVALID DATE"}), 400
+            rate = snapshot.history.rate_on(currency, day)
+            if rate is None:
+                return jsonify({"message": "RATE NOT AVAILABLE", "date": day.isoformat()}), 404
+            return jsonify({"rate": rate, "date": day.isoformat()}), 200
 
-        # Возвращаем курс валюты
-        rate = CURRENCY_RATES[currency]
-        return jsonify({"rate": rate}), 200
+        # Возвращаем заранее сериализованный ответ с курсом валюты
+        return Response(snapshot.rate_responses[currency], mimetype='application/json')
 
     except Exception as e:
         # Логируем ошибку (в продакшене нужно использовать proper logging)
@@ -49,6 +402,26 @@ def get_currency_rate():
         return jsonify({"message": "UNEXPECTED ERROR"}), 500
 
 
+@app.route('/history', methods=['GET'])
+def get_currency_history():
+    """
+    Получение истории курса валюты
+
+    Параметры:
+    - currency: валюта (USD или EUR)
+
+    Возвращает:
+    - 200: {"currency": валюта, "version": версия курсов, "history": [[дата, курс], ...]}
+    - 400: {"message": "UNKNOWN CURRENCY"}
+    """
+    currency = (request.args.get('currency') or '').upper()
+    body = current_snapshot().history_responses.get(currency)
+    if body is None:
+        return Response(UNKNOWN_CURRENCY_RESPONSE, status=400, mimetype='application/json')
+
+    return Response(body, mimetype='application/json')
+
+
 @app.route('/health', methods=['GET'])
 def health_check():
     """Проверка работоспособности сервиса"""
@@ -58,30 +431,362 @@ def health_check():
 @app.route('/', methods=['GET'])
 def index():
     """Главная страница с документацией"""
-    return jsonify({
+    return Response(current_snapshot().index_response, mimetype='application/json')
+
+
+def index_payload(version, rates):
+    """Содержимое главной страницы для снимка курсов"""
+    return {
         "service": "Currency Rate Service",
         "version": "1.0.0",
         "endpoints": {
             "/rate": {
                 "method": "GET",
                 "parameters": {
-                    "currency": "USD или EUR"
+                    "currency": "USD или EUR",
+                    "date": "ГГГГ-ММ-ДД (необязательно)"
                 },
                 "example": "/rate?currency=USD",
                 "responses": {
                     "200": {"rate": "число"},
                     "400": {"message": "UNKNOWN CURRENCY"},
+                    "404": {"message": "RATE NOT AVAILABLE"},
                     "500": {"message": "UNEXPECTED ERROR"}
                 }
             },
+            "/history": {
+                "method": "GET",
+                "parameters": {
+                    "currency": "USD или EUR"
+                },
+                "example": "/history?currency=USD",
+                "responses": {
+                    "200": {"currency": "валюта", "version": "версия курсов", "history": "[[дата, курс], ...]"},
+                    "400": {"message": "UNKNOWN CURRENCY"}
+                }
+            },
             "/health": {
                 "method": "GET",
                 "description": "Проверка работоспособности сервиса"
             }
         },
-        "supported_currencies": list(CURRENCY_RATES.keys()),
-        "current_rates": CURRENCY_RATES
-    }), 200
+        "supported_currencies": list(rates.keys()),
+        "current_rates": dict(rates),
+        "rates_version": version
+    }
+
+
+SNAPSHOT = initial_snapshot()
+
+
+class RateFastPath:
+    """
+    WSGI-обертка для горячего пути GET /rate?currency=XXX
+
+    Ответ берется из снимка курсов без маршрутизации и контекста запроса Flask.
+    Остальные запросы (в том числе /rate с параметром date) передаются приложению.
+    """
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        currency = hot_rate_currency(environ.get('REQUEST_METHOD'), environ.get('PATH_INFO'),
+                                     environ.get('QUERY_STRING', ''))
+        if currency is not None:
+            status, body = rate_response(current_snapshot(), currency)
+            start_response(status, [
+                ('Content-Type', 'application/json'),
+                ('Content-Length', str(len(body)))
+            ])
+            return [body]
+
+        return self.wsgi_app(environ, start_response)
+
+
+app.wsgi_app = RateFastPath(app.wsgi_app)
+
+
+def hot_rate_currency(method, path, query):
+    """Код валюты, если запрос - горячий путь GET /rate?currency=XXX, иначе None"""
+    if path == '/rate' and method == 'GET' and query.startswith('currency=') and '&' not in query:
+        return unquote(query[len('currency='):]).upper()
+    return None
+
+
+def rate_response(snapshot, currency):
+    """Статус и тело ответа горячего пути /rate"""
+    body = snapshot.rate_responses.get(currency)
+    if body is None:
+        return '400 BAD REQUEST', UNKNOWN_CURRENCY_RESPONSE
+    return '200 OK', body
+
+
+# Предел размера строки запроса и заголовков в RateHTTPServer
+MAX_REQUEST_HEAD = 16 * 1024
+
+
+def http_response(status, headers, body, keep_alive, http_10=False):
+    """Ответ HTTP/1.1 целиком: строка статуса, заголовки и тело"""
+    lines = [f"HTTP/1.1 {status}"]
+    has_length = False
+    for name, value in headers:
+        lowered = name.lower()
+        if lowered in ('connection', 'keep-alive', 'transfer-encoding'):
+            continue
+        has_length = has_length or lowered == 'content-length'
+        lines.append(f"{name}: {value}")
+    if not has_length:
+        lines.append(f"Content-Length: {len(body)}")
+    if not keep_alive:
+        lines.append("Connection: close")
+    elif http_10:
+        lines.append("Connection: keep-alive")
+    return ("\r\n".join(lines) + "\r\n\r\n").encode('latin-1') + body
+
+
+class RateHTTPServer:
+    """
+    HTTP/1.1-сервер воркера production на asyncio
+
+    Горячий путь GET /rate?currency=XXX обслуживается прямо в цикле событий:
+    ответ целиком (строка статуса, заголовки и тело) собирается один раз на
+    валюту и версию снимка курсов и дальше только записывается в сокет.
+    Остальные запросы передаются WSGI-приложению Flask в пуле потоков.
+    Соединения keep-alive; простаивающие дольше keepalive секунд закрываются.
+    """
+
+    def __init__(self, wsgi_app, threads, keepalive):
+        self.wsgi_app = wsgi_app
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='wsgi')
+        self.keepalive = keepalive
+        self.connections = set()
+        self._snapshot = None
+        self._rate_responses = {}
+        self._unknown_currency = http_response('400 BAD REQUEST', [('Content-Type', 'application/json')],
+                                               UNKNOWN_CURRENCY_RESPONSE, True)
+
+    def rate_response(self, currency):
+        """Готовый ответ keep-alive горячего пути для валюты"""
+        snapshot = current_snapshot()
+        if snapshot is not self._snapshot:
+            self._snapshot = snapshot
+            self._rate_responses = {}
+        response = self._rate_responses.get(currency)
+        if response is None:
+            body = snapshot.rate_responses.get(currency)
+            if body is None:
+                # Неизвестные коды не кэшируем: их может быть сколько угодно
+                return self._unknown_currency
+            response = http_response('200 OK', [('Content-Type', 'application/json')], body, True)
+            self._rate_responses[currency] = response
+        return response
+
+    def call_wsgi(self, environ):
+        """Вызывает WSGI-приложение (в потоке пула); возвращает статус, заголовки и тело"""
+        response = []
+        chunks = []
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and response:
+                raise exc_info[1].with_traceback(exc_info[2])
+            response[:] = [status, headers]
+            return chunks.append
+
+        result = self.wsgi_app(environ, start_response)
+        try:
+            chunks.extend(result)
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        return response[0], response[1], b''.join(chunks)
+
+    def close_idle(self):
+        now = time.monotonic()
+        for connection in list(self.connections):
+            if not connection.busy and now - connection.last_active > self.keepalive:
+                connection.transport.close()
+
+    async def shutdown(self, timeout):
+        """Дожидается запросов в обработке (не дольше timeout) и закрывает соединения"""
+        deadline = time.monotonic() + timeout
+        while any(connection.busy for connection in self.connections) and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        for connection in list(self.connections):
+            connection.transport.close()
+        self.executor.shutdown(wait=False)
+
+
+class RateHTTPProtocol(asyncio.Protocol):
+    """Одно соединение RateHTTPServer; запросы одного соединения обрабатываются по очереди"""
+
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+        self.buffer = b''
+        self.busy = False
+        self.last_active = time.monotonic()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.server.connections.add(self)
+
+    def connection_lost(self, exc):
+        self.server.connections.discard(self)
+
+    def data_received(self, data):
+        self.buffer += data
+        self.last_active = time.monotonic()
+        if not self.busy:
+            self.process()
+
+    def fail(self, status):
+        self.transport.write(http_response(status, [], b'', False))
+        self.transport.close()
+        self.buffer = b''
+
+    def process(self):
+        while not self.busy and not self.transport.is_closing():
+            end = self.buffer.find(b'\r\n\r\n')
+            if end < 0:
+                if len(self.buffer) > MAX_REQUEST_HEAD:
+                    self.fail('431 Request Header Fields Too Large')
+                return
+
+            lines = self.buffer[:end].decode('latin-1').split('\r\n')
+            try:
+                method, target, version = lines[0].split(' ')
+                headers = [tuple(part.strip() for part in line.split(':', 1)) for line in lines[1:]]
+                fields = {name.lower(): value for name, value in headers}
+                length = int(fields.get('content-length', '0'))
+                if length < 0:
+                    raise ValueError(length)
+            except ValueError:
+                self.fail('400 Bad Request')
+                return
+            if 'transfer-encoding' in fields:
+                self.fail('501 Not Implemented')
+                return
+            if len(self.buffer) < end + 4 + length:
+                return
+            body = self.buffer[end + 4:end + 4 + length]
+            self.buffer = self.buffer[end + 4 + length:]
+
+            connection = fields.get('connection', '').lower()
+            http_10 = version == 'HTTP/1.0'
+            keep_alive = connection == 'keep-alive' if http_10 else connection != 'close'
+            path, _, query = target.partition('?')
+
+            currency = hot_rate_currency(method, path, query)
+            if currency is not None and keep_alive and not http_10:
+                self.transport.write(self.server.rate_response(currency))
+                continue
+
+            self.busy = True
+            self.transport.pause_reading()
+            environ = self.environ(method, path, query, version, headers, body)
+            future = asyncio.get_running_loop().run_in_executor(self.server.executor, self.server.call_wsgi, environ)
+            future.add_done_callback(lambda done: self.finish(done, keep_alive, http_10))
+
+    def environ(self, method, path, query, version, headers, body):
+        sockname = self.transport.get_extra_info('sockname')
+        peername = self.transport.get_extra_info('peername')
+        environ = {
+            'REQUEST_METHOD': method,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': unquote(path, encoding='latin-1'),
+            'QUERY_STRING': query,
+            'SERVER_NAME': str(sockname[0]) if isinstance(sockname, tuple) else '',
+            'SERVER_PORT': str(sockname[1]) if isinstance(sockname, tuple) else '',
+            'SERVER_PROTOCOL': version,
+            'REMOTE_ADDR': str(peername[0]) if isinstance(peername, tuple) else '',
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False,
+        }
+        for name, value in headers:
+            key = name.upper().replace('-', '_')
+            if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                key = 'HTTP_' + key
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+        return environ
+
+    def finish(self, future, keep_alive, http_10):
+        self.busy = False
+        if self.transport.is_closing():
+            return
+        try:
+            status, headers, body = future.result()
+        except Exception as e:
+            print(f"Ошибка обработки запроса: {e!r}")
+            status, headers, body = '500 INTERNAL SERVER ERROR', [], b''
+        self.transport.write(http_response(status, headers, body, keep_alive, http_10))
+        self.last_active = time.monotonic()
+        if not keep_alive:
+            self.transport.close()
+            return
+        self.transport.resume_reading()
+        self.process()
+
+
+def serve_production(host, port):
+    """Запуск под gunicorn: несколько процессов с RateHTTPServer и keep-alive.
+
+    Курсы обновляет только master: у всех воркеров одна версия курсов и одна история,
+    а источник курсов опрашивается один раз за интервал, а не в каждом процессе.
+    """
+    global _shared_snapshot_file
+    from gunicorn.app.base import BaseApplication
+    from gunicorn.workers.base import Worker
+
+    # Воркеры, запущенные позже (в том числе после перезапуска), получают снимок master при fork,
+    # а уже работающие - из файла
+    _shared_snapshot_file = RATES_SNAPSHOT_FILE
+    write_snapshot(SNAPSHOT, _shared_snapshot_file)
+
+    class RateWorker(Worker):
+        """Воркер gunicorn: RateHTTPServer в цикле событий asyncio"""
+
+        def run(self):
+            asyncio.run(self.serve())
+
+        async def serve(self):
+            loop = asyncio.get_running_loop()
+            server = RateHTTPServer(self.wsgi, self.cfg.threads, self.cfg.keepalive)
+            listeners = [
+                await loop.create_server(lambda: RateHTTPProtocol(server), sock=listener.sock)
+                for listener in self.sockets
+            ]
+            while self.alive:
+                self.notify()
+                if self.ppid != os.getppid():
+                    self.log.info("Parent changed, shutting down: %s", self)
+                    break
+                server.close_idle()
+                await asyncio.sleep(1)
+
+            for listener in listeners:
+                listener.close()
+            await server.shutdown(self.cfg.graceful_timeout)
+
+    class CurrencyServiceApplication(BaseApplication):
+        def load_config(self):
+            self.cfg.set('bind', f"{host}:{port}")
+            self.cfg.set('workers', SERVICE_WORKERS)
+            self.cfg.set('worker_class', RateWorker)
+            self.cfg.set('threads', SERVICE_THREADS)
+            self.cfg.set('keepalive', SERVICE_KEEPALIVE)
+            # Поток обновления работает в master; воркеры его не наследуют
+            self.cfg.set('when_ready', lambda server: start_refresher())
+
+        def load(self):
+            return app
+
+    CurrencyServiceApplication().run()
 
 
 @app.errorhandler(404)
@@ -97,13 +802,25 @@ def method_not_allowed(error):
 
 
 if __name__ == '__main__':
+    # python currency_service.py seed-history <файл.csv> - загрузить прошлые курсы в RATE_HISTORY_FILE
+    if sys.argv[1:2] == ['seed-history']:
+        if len(sys.argv) != 3 or not RATE_HISTORY_FILE:
+            raise SystemExit("Использование: RATE_HISTORY_FILE=<файл> python currency_service.py seed-history <файл.csv>")
+        print(f"Добавлено записей истории: {seed_history(sys.argv[2])}")
+        raise SystemExit(0)
+
     # Получаем порт из переменных окружения или используем 5000 по умолчанию
     port = int(os.getenv('CURRENCY_SERVICE_PORT', 5000))
     host = os.getenv('CURRENCY_SERVICE_HOST', '127.0.0.1')
     debug = os.getenv('FLASK_DEBUG', 'False').lower() == 'true'
 
     print(f"🚀 Запуск сервиса курсов валют на {host}:{port}")
-    print(f"📊 Доступные валюты: {', '.join(CURRENCY_RATES.keys())}")
+    print(f"📊 Доступные валюты: {', '.join(SNAPSHOT.rates.keys())}")
     print(f"🔗 Пример запроса: http://{host}:{port}/rate?currency=USD")
 
-    app.run(host=host, port=port, debug=debug)
\ No newline at end of file
+    if SERVICE_MODE == 'production':
+        print(f"⚙️ Режим production: {SERVICE_WORKERS} процессов по {SERVICE_THREADS} потоков")
+        serve_production(host, port)
+    else:
+        start_refresher()
+        app.run(host=host, port=port, debug=debug)
\ No newline at end of file
@@ -0,0 +1,65 @@
+"""
+Кэш отрисованных страниц истории операций
+
+Ключ страницы - (chat_id, валюта, номер страницы, фильтр). Страница из кэша
+отдается без обращений к БД и сервису курсов, поэтому бот сбрасывает страницы
+явно: страницы пользователя - после записи его операций, страницы валюты -
+после смены курсов (см. invalidate_chat и invalidate_currency).
+
+Операции могут измениться и мимо бота (архивирование, перенос пользователя
+между узлами БД), поэтому страница живет не дольше OPERATIONS_PAGE_CACHE_TTL.
+
+Настройки (переменные окружения):
+- OPERATIONS_PAGE_CACHE_SIZE: сколько страниц хранить (2000)
+- OPERATIONS_PAGE_CACHE_TTL: сколько секунд страница считается актуальной (60)
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+
+OPERATIONS_PAGE_CACHE_SIZE = int(os.getenv('OPERATIONS_PAGE_CACHE_SIZE', '2000'))
+OPERATIONS_PAGE_CACHE_TTL = float(os.getenv('OPERATIONS_PAGE_CACHE_TTL', '60'))
+
+
+class PageCache:
+    """LRU-кэш страниц с явной инвалидацией по пользователю и по валюте"""
+
+    def __init__(self, size: int = OPERATIONS_PAGE_CACHE_SIZE, ttl: float = OPERATIONS_PAGE_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self._pages = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Страница для key, если она есть и не устарела, иначе None"""
+        with self._lock:
+            entry = self._pages.get(key)
+            if entry is None or time.monotonic() - entry[0] >= self.ttl:
+                self.misses += 1
+                return None
+            self._pages.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, page):
+        with self._lock:
+            self._pages[key] = (time.monotonic(), page)
+            self._pages.move_to_end(key)
+            while len(self._pages) > self.size:
+                self._pages.popitem(last=False)
+
+    def _invalidate(self, matches):
+        with self._lock:
+            for key in [key for key in self._pages if matches(key)]:
+                del self._pages[key]
+
+    def invalidate_chat(self, chat_id: int):
+        """Сбрасывает страницы пользователя: его операции изменились"""
+        self._invalidate(lambda key: key[0] == chat_id)
+
+    def invalidate_currency(self, currency: str):
+        """Сбрасывает страницы в валюте: изменились ее курсы"""
+        self._invalidate(lambda key: key[1] == currency)
@@ -0,0 +1,362 @@
+"""
+Секционирование таблицы operations по месяцам и архивирование старых секций
+
+Команды:
+    python partitioning.py migrate                  # перевести operations на секции по месяцам
+    python partitioning.py maintain                 # создать секции на ближайшие месяцы
+    python partitioning.py archive --before 2024-01 # убрать в архив секции до января 2024
+    python partitioning.py archive --before 2024-01 --dir /var/backups/operations
+
+После миграции operations - таблица, секционированная по date:
+- operations_YYYY_MM - секция одного месяца;
+- operations_before - все, что раньше первой месячной секции;
+- operations_default - даты, для которых секции еще нет.
+Запросы с условием на дату читают только нужные секции, а VACUUM и
+обслуживание индексов идут по небольшим таблицам.
+
+Архивирование отсоединяет секции целиком; operations_before - как только
+ее граница не позже --before, независимо от месячных секций. Строки секции
+по умолчанию с датами раньше --before переносятся без отсоединения секции.
+Без --dir строки переносятся в таблицу operations_archive, с --dir -
+выгружаются в файлы operations_YYYY_MM.csv.gz. operations_archive - обычная
+таблица без сжатия: она лишь убирает строки из рабочих секций и их индексов,
+а места на диске не экономит; сжатый архив дает только --dir. Архивные операции не показываются в /operations,
+а /balance учитывает их остатком на начало: в той же транзакции, что и
+отсоединение секции, сумма ее операций по каждому пользователю добавляется
+в таблицу operations_opening_balance.
+
+Бот создает секции на ближайшие месяцы при запуске и затем раз в
+PARTITION_CHECK_INTERVAL; maintain нужен, только если бот не запущен.
+
+Настройки (переменные окружения):
+- DB_HOST, DB_PORT, DB_NAME, DB_USER, DB_PASSWORD: подключение к БД, как у бота
+- PARTITION_MONTHS_AHEAD: на сколько месяцев вперед создавать секции (3)
+- PARTITION_HISTORY_MONTHS: сколько прошлых месяцев при миграции получают
+  собственные секции, более ранние операции попадают в operations_before (24)
+"""
+import argparse
+import gzip
+import logging
+import os
+import re
+from datetime import date
+
+import psycopg2
+
+DB_CONFIG = {
+    'host': os.getenv('DB_HOST', 'localhost'),
+    'port': int(os.getenv('DB_PORT', '5432')),
+    'user': os.getenv('DB_USER', 'postgres'),
+    'password': os.getenv('DB_PASSWORD'),
+    'database': os.getenv('DB_NAME', 'finance_bot')
+}
+
+PARTITION_MONTHS_AHEAD = int(os.getenv('PARTITION_MONTHS_AHEAD', '3'))
+PARTITION_HISTORY_MONTHS = int(os.getenv('PARTITION_HISTORY_MONTHS', '24'))
+
+BEFORE_PARTITION = 'operations_before'
+DEFAULT_PARTITION = 'operations_default'
+ARCHIVE_TABLE = 'operations_archive'
+OPENING_BALANCE_TABLE = 'operations_opening_balance'
+
+logger = logging.getLogger(__name__)
+
+
+def month_start(day: date) -> date:
+    return day.replace(day=1)
+
+
+def add_months(day: date, months: int) -> date:
+    month = day.year * 12 + day.month - 1 + months
+    return date(month // 12, month % 12 + 1, 1)
+
+
+def partition_name(month: date) -> str:
+    return f"operations_{month.year:04d}_{month.month:02d}"
+
+
+def create_opening_balance_table(cursor):
+    """Остаток на начало по пользователям: баланс и последняя дата архивных операций"""
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS {OPENING_BALANCE_TABLE} (
+            chat_id BIGINT PRIMARY KEY,
+            date DATE NOT NULL,
+            balance DECIMAL(14, 2) NOT NULL
+        )
+    ''')
+
+
+def carry_forward(cursor, name: str, condition: str = ""):
+    """Добавляет операции таблицы name (подходящие под condition) к остатку на начало их пользователей"""
+    cursor.execute(f'''
+        INSERT INTO {OPENING_BALANCE_TABLE} AS opening (chat_id, date, balance)
+        SELECT chat_id, MAX(date), SUM(CASE WHEN type_operation = 'ДОХОД' THEN sum ELSE -sum END)
+        FROM {name} {condition}
+        GROUP BY chat_id
+        ON CONFLICT (chat_id) DO UPDATE
+        SET date = GREATEST(opening.date, EXCLUDED.date),
+            balance = opening.balance + EXCLUDED.balance
+    ''')
+
+
+def partition_upper_bound(cursor, name: str):
+    """Верхняя граница диапазона секции name или None, если секции нет"""
+    cursor.execute("SELECT pg_get_expr(relpartbound, oid) FROM pg_class WHERE oid = to_regclass(%s)", (name,))
+    row = cursor.fetchone()
+    # Граница в виде "FOR VALUES FROM (MINVALUE) TO ('2024-01-01')"
+    match = re.search(r"TO \('(\d{4})-(\d{2})-(\d{2})'\)", row[0] or "") if row else None
+    return date(*map(int, match.groups())) if match else None
+
+
+def is_partitioned(cursor) -> bool:
+    cursor.execute('''
+        SELECT EXISTS(
+            SELECT 1 FROM pg_partitioned_table
+            WHERE partrelid = to_regclass('operations')
+        )
+    ''')
+    return cursor.fetchone()[0]
+
+
+def monthly_partitions(cursor) -> dict:
+    """Месячные секции operations: начало месяца -> имя таблицы"""
+    cursor.execute('''
+        SELECT child.relname
+        FROM pg_inherits
+        JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+        WHERE pg_inherits.inhparent = to_regclass('operations')
+    ''')
+    result = {}
+    for (name,) in cursor.fetchall():
+        parts = name.split('_')
+        if len(parts) == 3 and parts[1].isdigit() and parts[2].isdigit():
+            result[date(int(parts[1]), int(parts[2]), 1)] = name
+    return result
+
+
+def create_month_partition(cursor, month: date):
+    """Создает секцию месяца, перенося в нее строки этого месяца из секции по умолчанию"""
+    name = partition_name(month)
+    next_month = add_months(month, 1)
+    cursor.execute(f"CREATE TABLE {name} (LIKE operations INCLUDING DEFAULTS INCLUDING CONSTRAINTS)")
+    cursor.execute(f'''
+        WITH moved AS (
+            DELETE FROM {DEFAULT_PARTITION} WHERE date >= %s AND date < %s RETURNING *
+        )
+        INSERT INTO {name} SELECT * FROM moved
+    ''', (month, next_month))
+    cursor.execute(
+        f"ALTER TABLE operations ATTACH PARTITION {name} FOR VALUES FROM (%s) TO (%s)",
+        (month, next_month)
+    )
+    logger.info("Создана секция %s", name)
+
+
+def ensure_partitions(conn, months_ahead: int = PARTITION_MONTHS_AHEAD) -> int:
+    """Создает недостающие секции от текущего месяца на months_ahead вперед.
+
+    Возвращает число созданных секций; для несекционированной таблицы ничего не делает.
+    """
+    cursor = conn.cursor()
+    if not is_partitioned(cursor):
+        cursor.close()
+        return 0
+
+    existing = monthly_partitions(cursor)
+    first = min(existing) if existing else None
+    created = 0
+    current = month_start(date.today())
+    for offset in range(months_ahead + 1):
+        month = add_months(current, offset)
+        # Месяцы раньше первой секции покрывает operations_before
+        if month in existing or (first and month < first):
+            continue
+        create_month_partition(cursor, month)
+        created += 1
+
+    conn.commit()
+    cursor.close()
+    return created
+
+
+def migrate(conn, months_ahead: int = PARTITION_MONTHS_AHEAD,
+            history_months: int = PARTITION_HISTORY_MONTHS):
+    """Переводит operations на секции по месяцам одной транзакцией.
+
+    Строки копируются в новую секционированную таблицу, после чего старая удаляется;
+    идентификаторы операций и последовательность сохраняются.
+    """
+    cursor = conn.cursor()
+    if is_partitioned(cursor):
+        logger.info("Таблица operations уже секционирована")
+        cursor.close()
+        return
+
+    cursor.execute("LOCK TABLE operations IN ACCESS EXCLUSIVE MODE")
+    cursor.execute("SELECT MIN(date) FROM operations")
+    oldest = cursor.fetchone()[0]
+
+    current = month_start(date.today())
+    first = max(month_start(oldest or current), add_months(current, -history_months))
+    first = min(first, current)
+
+    # Старая таблица переименовывается; имена ее индексов освобождаются для новой
+    cursor.execute("ALTER TABLE operations RENAME TO operations_unpartitioned")
+    cursor.execute("ALTER TABLE operations_unpartitioned RENAME CONSTRAINT operations_pkey TO operations_unpartitioned_pkey")
+    cursor.execute("DROP INDEX IF EXISTS operations_chat_date_idx, operations_chat_type_date_idx")
+    cursor.execute("ALTER SEQUENCE operations_id_seq OWNED BY NONE")
+
+    # Первичный ключ секционированной таблицы обязан включать ключ секционирования
+    cursor.execute('''
+        CREATE TABLE operations (
+            id INTEGER NOT NULL DEFAULT nextval('operations_id_seq'),
+            date DATE NOT NULL,
+            sum DECIMAL(10, 2) NOT NULL,
+            chat_id BIGINT NOT NULL,
+            type_operation VARCHAR(10) NOT NULL CHECK (type_operation IN ('ДОХОД', 'РАСХОД')),
+            PRIMARY KEY (id, date),
+            FOREIGN KEY (chat_id) REFERENCES users(chat_id) ON DELETE CASCADE
+        ) PARTITION BY RANGE (date)
+    ''')
+    cursor.execute("ALTER SEQUENCE operations_id_seq OWNED BY operations.id")
+    cursor.execute("CREATE INDEX operations_chat_date_idx ON operations (chat_id, date DESC, id DESC)")
+    cursor.execute("CREATE INDEX operations_chat_type_date_idx ON operations (chat_id, type_operation, date DESC, id DESC)")
+
+    cursor.execute(
+        f"CREATE TABLE {BEFORE_PARTITION} PARTITION OF operations FOR VALUES FROM (MINVALUE) TO (%s)",
+        (first,)
+    )
+    month = first
+    while month <= add_months(current, months_ahead):
+        next_month = add_months(month, 1)
+        cursor.execute(
+            f"CREATE TABLE {partition_name(month)} PARTITION OF operations FOR VALUES FROM (%s) TO (%s)",
+            (month, next_month)
+        )
+        month = next_month
+    cursor.execute(f"CREATE TABLE {DEFAULT_PARTITION} PARTITION OF operations DEFAULT")
+
+    cursor.execute('''
+        INSERT INTO operations (id, date, sum, chat_id, type_operation)
+        SELECT id, date, sum, chat_id, type_operation FROM operations_unpartitioned
+    ''')
+    moved = cursor.rowcount
+    cursor.execute("DROP TABLE operations_unpartitioned")
+
+    conn.commit()
+    cursor.close()
+    logger.info("Таблица operations секционирована с %s, перенесено операций: %d", first, moved)
+
+
+def _archive_rows(cursor, name: str, directory: str, file_name: str, condition: str = "") -> tuple:
+    """Копирует строки таблицы name в таблицу архива или в файл file_name.csv.gz в directory
+    и добавляет их к остатку на начало. Возвращает, куда они перенесены, и их число"""
+    select = f"SELECT id, date, sum, chat_id, type_operation FROM {name} {condition}"
+    if directory is None:
+        cursor.execute(f"INSERT INTO {ARCHIVE_TABLE} (id, date, sum, chat_id, type_operation) {select}")
+        target = ARCHIVE_TABLE
+    else:
+        target = os.path.join(directory, f"{file_name}.csv.gz")
+        with gzip.open(target, 'wb') as archive_file:
+            cursor.copy_expert(f"COPY ({select} ORDER BY date, id) TO STDOUT WITH CSV HEADER", archive_file)
+    rows = cursor.rowcount
+    carry_forward(cursor, name, condition)
+    return target, rows
+
+
+def archive(conn, before: date, directory: str = None) -> list:
+    """Отсоединяет секции, целиком лежащие раньше месяца before, и переносит их в архив"""
+    cursor = conn.cursor()
+    if not is_partitioned(cursor):
+        cursor.close()
+        raise RuntimeError("Таблица operations не секционирована, сначала выполните migrate")
+
+    partitions = sorted(
+        (month, name) for month, name in monthly_partitions(cursor).items() if month < before
+    )
+    # operations_before архивируется по своей границе, даже если месячных секций раньше before нет
+    before_bound = partition_upper_bound(cursor, BEFORE_PARTITION)
+    if before_bound is not None and before_bound <= before:
+        partitions.insert(0, (None, BEFORE_PARTITION))
+
+    create_opening_balance_table(cursor)
+    if directory is None:
+        cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS {ARCHIVE_TABLE} (
+                id INTEGER NOT NULL,
+                date DATE NOT NULL,
+                sum DECIMAL(10, 2) NOT NULL,
+                chat_id BIGINT NOT NULL,
+                type_operation VARCHAR(10) NOT NULL
+            )
+        ''')
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS {ARCHIVE_TABLE}_chat_date_idx ON {ARCHIVE_TABLE} (chat_id, date)")
+    conn.commit()
+
+    archived = []
+    for month, name in partitions:
+        # Каждая секция архивируется своей транзакцией: сбой не затрагивает уже перенесенные
+        cursor.execute(f"ALTER TABLE operations DETACH PARTITION {name}")
+        target, rows = _archive_rows(cursor, name, directory, name)
+        cursor.execute(f"DROP TABLE {name}")
+        conn.commit()
+
+        archived.append(name)
+        logger.info("Секция %s перенесена в %s (%d строк)", name, target, rows)
+
+    # Операции с датами раньше первой секции после архивирования operations_before попадают
+    # в секцию по умолчанию; ее старые строки архивируются без отсоединения секции
+    cursor.execute("SELECT to_regclass(%s) IS NOT NULL", (DEFAULT_PARTITION,))
+    if cursor.fetchone()[0]:
+        condition = cursor.mogrify("WHERE date < %s", (before,)).decode()
+        # Вставки в секцию по умолчанию ждут окончания переноса
+        cursor.execute(f"LOCK TABLE {DEFAULT_PARTITION} IN EXCLUSIVE MODE")
+        cursor.execute(f"SELECT EXISTS(SELECT 1 FROM {DEFAULT_PARTITION} {condition})")
+        if cursor.fetchone()[0]:
+            target, rows = _archive_rows(
+                cursor, DEFAULT_PARTITION, directory, f"{DEFAULT_PARTITION}_before_{before:%Y_%m}", condition
+            )
+            cursor.execute(f"DELETE FROM {DEFAULT_PARTITION} {condition}")
+            archived.append(DEFAULT_PARTITION)
+            logger.info("Старые строки %s перенесены в %s (%d строк)", DEFAULT_PARTITION, target, rows)
+        conn.commit()
+
+    cursor.close()
+    return archived
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Секционирование и архивирование таблицы operations")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    migrate_parser = commands.add_parser('migrate', help="перевести operations на секции по месяцам")
+    migrate_parser.add_argument('--months-ahead', type=int, default=PARTITION_MONTHS_AHEAD)
+    migrate_parser.add_argument('--history-months', type=int, default=PARTITION_HISTORY_MONTHS)
+
+    maintain_parser = commands.add_parser('maintain', help="создать секции на ближайшие месяцы")
+    maintain_parser.add_argument('--months-ahead', type=int, default=PARTITION_MONTHS_AHEAD)
+
+    archive_parser = commands.add_parser('archive', help="убрать в архив старые секции")
+    archive_parser.add_argument('--before', required=True, help="первый месяц, который остается, ГГГГ-ММ")
+    archive_parser.add_argument('--dir', help="выгрузить секции в .csv.gz в этот каталог вместо таблицы архива")
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    conn = psycopg2.connect(**DB_CONFIG)
+    try:
+        if args.command == 'migrate':
+            migrate(conn, args.months_ahead, args.history_months)
+        elif args.command == 'maintain':
+            created = ensure_partitions(conn, args.months_ahead)
+            logger.info("Создано секций: %d", created)
+        else:
+            year, month = args.before.split('-')
+            archived = archive(conn, date(int(year), int(month), 1), args.dir)
+            logger.info("Архивировано секций: %d", len(archived))
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,213 @@
+"""
+Отложенная пакетная запись операций (write-behind)
+
+Обработчик ставит операцию в очередь и ждет, пока пакет, в который она попала,
+будет записан одним многострочным INSERT и закоммичен. Пакет сбрасывается, когда
+набралось WRITE_BUFFER_MAX_BATCH операций или прошло WRITE_BUFFER_MAX_DELAY_MS
+миллисекунд с момента поступления первой из них. Так на один коммит приходится
+много операций, и пропускная способность записи растет вместе с размером пакета.
+
+Подключение:
+    write_buffer = OperationWriteBuffer(get_db_connection)
+    write_buffer.setup(dp)
+    ...
+    await write_buffer.add(operation_date, amount, chat_id, operation_type)
+
+Настройки (переменные окружения):
+- WRITE_BUFFER: включить отложенную запись (false)
+- WRITE_BUFFER_MAX_BATCH: максимальный размер пакета (100)
+- WRITE_BUFFER_MAX_DELAY_MS: максимальное ожидание пакета в миллисекундах (20)
+"""
+import asyncio
+import logging
+import os
+import time
+
+import psycopg2
+import psycopg2.extras
+
+WRITE_BUFFER = os.getenv('WRITE_BUFFER', 'false').lower() == 'true'
+WRITE_BUFFER_MAX_BATCH = int(os.getenv('WRITE_BUFFER_MAX_BATCH', '100'))
+WRITE_BUFFER_MAX_DELAY_MS = float(os.getenv('WRITE_BUFFER_MAX_DELAY_MS', '20'))
+
+INSERT_OPERATIONS = "INSERT INTO operations (date, sum, chat_id, type_operation) VALUES %s"
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBufferClosed(RuntimeError):
+    """Буфер остановлен и новые операции не принимает"""
+
+
+class OperationWriteBuffer:
+    """Очередь операций, записываемых в БД пакетами в отдельном потоке"""
+
+    def __init__(self, connect, shard_of=None, max_batch: int = WRITE_BUFFER_MAX_BATCH,
+                 max_delay_ms: float = WRITE_BUFFER_MAX_DELAY_MS, on_written=None):
+        # connect(chat_id) открывает соединение с БД пользователя; при шардировании
+        # shard_of(chat_id) дает узел, и пакет записывается отдельно на каждый узел.
+        # on_written(chat_ids) вызывается после коммита с пользователями записанных операций
+        self._connect = connect
+        self._shard_of = shard_of or (lambda chat_id: None)
+        self._on_written = on_written
+        self.max_batch = max_batch
+        self.max_delay = max_delay_ms / 1000
+        self._queue = None
+        self._task = None
+        self._conns = {}
+        self._closed = False
+        self.batches = 0
+        self.rows = 0
+
+    def setup(self, dp):
+        """Запускает и останавливает сброс пакетов вместе с диспетчером"""
+        dp.startup.register(self.on_startup)
+        dp.shutdown.register(self.on_shutdown)
+
+    async def add(self, operation_date, amount, chat_id: int, operation_type: str):
+        """Ставит операцию в очередь и возвращается после коммита ее пакета.
+
+        Ошибка записи пакета пробрасывается каждому из ожидающих обработчиков.
+        """
+        if self._closed or self._queue is None:
+            raise WriteBufferClosed("Буфер записи операций не запущен")
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put(((operation_date, amount, chat_id, operation_type), future))
+        await future
+
+    async def _collect(self) -> tuple:
+        """Ждет первую операцию и добирает пакет до max_batch или до истечения max_delay.
+
+        Возвращает пакет и признак того, что из очереди получен сигнал остановки.
+        """
+        batch = []
+        item = await self._queue.get()
+        deadline = time.monotonic() + self.max_delay
+        while item is not None:
+            batch.append(item)
+            timeout = deadline - time.monotonic()
+            if len(batch) >= self.max_batch or timeout <= 0:
+                return batch, False
+            try:
+                item = await asyncio.wait_for(self._queue.get(), timeout)
+            except asyncio.TimeoutError:
+                return batch, False
+        return batch, True
+
+    def _connection(self, shard, chat_id: int):
+        conn = self._conns.get(shard)
+        if conn is None or conn.closed:
+            conn = self._conns[shard] = self._connect(chat_id)
+        return conn
+
+    def _write(self, shard, rows: list):
+        """Записывает пакет одной транзакцией; выполняется в потоке, чтобы не блокировать цикл событий"""
+        conn = self._connection(shard, rows[0][2])
+        try:
+            with conn.cursor() as cursor:
+                psycopg2.extras.execute_values(cursor, INSERT_OPERATIONS, rows, page_size=len(rows))
+            conn.commit()
+        except Exception:
+            # После ошибки соединение могло остаться в прерванной транзакции - открываем новое
+            self._close(shard)
+            raise
+
+    def _close(self, shard):
+        conn = self._conns.pop(shard, None)
+        if conn is not None and not conn.closed:
+            conn.close()
+
+    def _write_each(self, shard, rows: list) -> list:
+        """Записывает операции по одной под точками сохранения, чтобы ошибка одной
+        не отменяла остальные. Возвращает ошибку (или None) для каждой операции."""
+        conn = self._connection(shard, rows[0][2])
+        errors = []
+        try:
+            with conn.cursor() as cursor:
+                for row in rows:
+                    cursor.execute("SAVEPOINT operation")
+                    try:
+                        cursor.execute(INSERT_OPERATIONS % "(%s, %s, %s, %s)", row)
+                        errors.append(None)
+                    except psycopg2.Error as e:
+                        cursor.execute("ROLLBACK TO SAVEPOINT operation")
+                        errors.append(e)
+            conn.commit()
+        except Exception:
+            self._close(shard)
+            raise
+        return errors
+
+    async def _flush(self, batch: list):
+        # Операции пакета группируются по узлам БД; без шардирования группа одна
+        groups = {}
+        for item in batch:
+            groups.setdefault(self._shard_of(item[0][2]), []).append(item)
+        for shard, group in groups.items():
+            await self._flush_group(shard, group)
+
+    async def _flush_group(self, shard, batch: list):
+        rows = [row for row, _ in batch]
+        try:
+            await asyncio.to_thread(self._write, shard, rows)
+            errors = [None] * len(rows)
+        except psycopg2.Error as e:
+            logger.error(f"Ошибка пакетной записи {len(rows)} операций: {e}")
+            # Пакет откатился целиком; операции записываются заново по одной,
+            # и ошибку получают только те обработчики, чьи операции не прошли
+            try:
+                errors = await asyncio.to_thread(self._write_each, shard, rows)
+            except Exception as e:
+                errors = [e] * len(rows)
+        except Exception as e:
+            logger.error(f"Ошибка пакетной записи {len(rows)} операций: {e}")
+            errors = [e] * len(rows)
+
+        self.batches += 1
+        self.rows += errors.count(None)
+        written = {row[2] for row, error in zip(rows, errors) if error is None}
+        if written and self._on_written:
+            # До пробуждения обработчиков: следующее чтение уже видит записанные операции.
+            # Ошибка обработчика не должна остановить сброс пакетов и оставить ждущих без ответа
+            try:
+                self._on_written(written)
+            except Exception:
+                logger.exception("Ошибка обработчика записанных операций")
+        for (_, future), error in zip(batch, errors):
+            if future.done():
+                continue
+            if error is None:
+                future.set_result(None)
+            else:
+                future.set_exception(error)
+
+    async def _run(self):
+        stopping = False
+        while not stopping:
+            batch, stopping = await self._collect()
+            if batch:
+                await self._flush(batch)
+
+    async def on_startup(self):
+        self._queue = asyncio.Queue()
+        self._closed = False
+        self._task = asyncio.create_task(self._run())
+        logger.info(
+            "Отложенная запись операций включена: пакет до %d операций, ожидание до %.0f мс",
+            self.max_batch, self.max_delay * 1000
+        )
+
+    async def on_shutdown(self):
+        """Перестает принимать операции и дописывает все, что уже стоит в очереди"""
+        if self._task is None:
+            return
+        self._closed = True
+        # Сигнал остановки встает в очередь после всех принятых операций,
+        # поэтому задача сбрасывает их и только затем завершается
+        await self._queue.put(None)
+        await self._task
+        self._task = None
+
+        for shard in list(self._conns):
+            self._close(shard)
+        logger.info("Буфер записи остановлен: %d пакетов, %d операций", self.batches, self.rows)